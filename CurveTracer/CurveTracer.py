@@ -39,6 +39,9 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
 
+    # Keep one logic so that locators are cached across updates
+    self.logic = CurveTracerLogic()
+
     # Instantiate and connect widgets ...
     
     ####################
@@ -55,7 +58,7 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
     #  your module to users)
     self.reloadButton = qt.QPushButton("Reload")
     self.reloadButton.toolTip = "Reload this module."
-    self.reloadButton.name = "CurveMaker Reload"
+    self.reloadButton.name = "CurveTracer Reload"
     reloadFormLayout.addWidget(self.reloadButton)
     self.reloadButton.connect('clicked()', self.onReload)
     #
@@ -127,16 +130,18 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
     distanceFormLayout.addWidget(self.targetFiducialsSelector)
 
     self.targetFiducialsNode = None
+    self.targetTag = None
+    self.errorVectorsModelNode = None
     self.tagDestinationDispNode = None
     
     self.targetFiducialsSelector.connect("currentNodeChanged(vtkMRMLNode*)",
                                          self.onTargetFiducialsSelected)
 
 
-    self.fiducialsTable = qt.QTableWidget(1, 4)
+    self.fiducialsTable = qt.QTableWidget(1, 5)
     self.fiducialsTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
     self.fiducialsTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
-    self.fiducialsTableHeaders = ["Label", "1", "2", "3"]
+    self.fiducialsTableHeaders = ["Label", "Voxel", "In Volume", "Inside", "Distance (mm)"]
     self.fiducialsTable.setHorizontalHeaderLabels(self.fiducialsTableHeaders)
     self.fiducialsTable.horizontalHeader().setStretchLastSection(True)
     distanceLayout.addWidget(self.fiducialsTable)
@@ -145,18 +150,286 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
     self.extrapolateCheckBox.checked = 0
     self.extrapolateCheckBox.setToolTip("Extrapolate the first and last segment to calculate the distance")
     self.extrapolateCheckBox.connect('toggled(bool)', self.updateTargetFiducialsTable)
+    self.extrapolateCheckBox.connect('toggled(bool)', self.scheduleAnglesTableUpdate)
     self.extrapolateCheckBox.text = 'Extrapolate curves to measure the distances'
 
     self.showErrorVectorCheckBox = qt.QCheckBox()
     self.showErrorVectorCheckBox.checked = 0
     self.showErrorVectorCheckBox.setToolTip("Show error vectors, which is defined by the target point and the closest point on the curve. The vector is perpendicular to the curve, unless the closest point is one end of the curve.")
     self.showErrorVectorCheckBox.connect('toggled(bool)', self.updateTargetFiducialsTable)
+    self.showErrorVectorCheckBox.connect('toggled(bool)', self.scheduleAnglesTableUpdate)
     self.showErrorVectorCheckBox.text = 'Show error vectors'
 
     distanceLayout.addWidget(self.extrapolateCheckBox)
     distanceLayout.addWidget(self.showErrorVectorCheckBox)
     distanceFormLayout.addRow("Distance from:", distanceLayout)
 
+    #
+    # Entry Angle area
+    #
+    angleCollapsibleButton = ctk.ctkCollapsibleButton()
+    angleCollapsibleButton.text = "Entry Angle"
+    angleCollapsibleButton.collapsed = True
+    self.layout.addWidget(angleCollapsibleButton)
+    angleFormLayout = qt.QFormLayout(angleCollapsibleButton)
+
+
+    #  - Model selector
+    angleLayout = qt.QVBoxLayout()
+
+    self.inputModelSelector = slicer.qMRMLNodeComboBox()
+    self.inputModelSelector.nodeTypes = ["vtkMRMLModelHierarchyNode"]
+    self.inputModelSelector.selectNodeUponCreation = True
+    self.inputModelSelector.addEnabled = True
+    self.inputModelSelector.removeEnabled = True
+    self.inputModelSelector.noneEnabled = True
+    self.inputModelSelector.showHidden = False
+    self.inputModelSelector.showChildNodeTypes = False
+    self.inputModelSelector.setMRMLScene( slicer.mrmlScene )
+    self.inputModelSelector.setToolTip( "Select a 3D Model" )
+    angleFormLayout.addRow("Model:", self.inputModelSelector)
+
+
+    self.inputModelNode = None
+    self.modelTag = None
+
+    self.inputModelSelector.connect("currentNodeChanged(vtkMRMLNode*)",
+                                         self.onModelSelected)
+
+
+    self.anglesTable = qt.QTableWidget(1, 3)
+    self.anglesTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.anglesTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.anglesTableHeaders = ["Model", "Entry Angle (Degrees)", "Distance (mm)"]
+    self.crossingsTableHeaders = ["Model", "Angle (Degrees)", "Crossing", "Distance (mm)"]
+    self.anglesTable.setHorizontalHeaderLabels(self.anglesTableHeaders)
+    self.anglesTable.horizontalHeader().setStretchLastSection(True)
+    angleLayout.addWidget(self.anglesTable)
+
+    self.allCrossingsCheckBox = qt.QCheckBox()
+    self.allCrossingsCheckBox.checked = 0
+    self.allCrossingsCheckBox.setToolTip("List every entry and exit along all segments of the curve, instead of the entry angle of the straight line from the first to the last point.")
+    self.allCrossingsCheckBox.connect('toggled(bool)', self.updateAnglesTable)
+    self.allCrossingsCheckBox.text = 'Report all crossings along the curve'
+
+    angleLayout.addWidget(self.allCrossingsCheckBox)
+
+    self.labelSurfacesCheckBox = qt.QCheckBox()
+    self.labelSurfacesCheckBox.checked = 1
+    self.labelSurfacesCheckBox.setToolTip("Without a model, extract the surfaces of the labels crossed by the line from the first to the last point from the label map, and report their entry angles.")
+    self.labelSurfacesCheckBox.connect('toggled(bool)', self.updateAnglesTable)
+    self.labelSurfacesCheckBox.text = 'Use label map surfaces when no model is selected'
+    angleLayout.addWidget(self.labelSurfacesCheckBox)
+    angleFormLayout.addRow(angleLayout)
+
+    self.surfaceSmoothingSpinBox = qt.QSpinBox()
+    self.surfaceSmoothingSpinBox.minimum = 0
+    self.surfaceSmoothingSpinBox.maximum = 100
+    self.surfaceSmoothingSpinBox.value = 15
+    self.surfaceSmoothingSpinBox.setToolTip("Smoothing iterations of the label map surfaces, 0 to disable")
+    self.surfaceSmoothingSpinBox.connect('valueChanged(int)', self.scheduleAnglesTableUpdate)
+    angleFormLayout.addRow("Surface smoothing:", self.surfaceSmoothingSpinBox)
+
+    self.proximityRadiusSpinBox = qt.QDoubleSpinBox()
+    self.proximityRadiusSpinBox.minimum = 0.0
+    self.proximityRadiusSpinBox.maximum = 200.0
+    self.proximityRadiusSpinBox.value = 20.0
+    self.proximityRadiusSpinBox.suffix = " mm"
+    self.proximityRadiusSpinBox.setToolTip("Largest distance between the trajectory and a model that is measured")
+    self.proximityRadiusSpinBox.connect('valueChanged(double)', self.scheduleAnglesTableUpdate)
+    angleFormLayout.addRow("Search radius:", self.proximityRadiusSpinBox)
+
+    #
+    # Entry Planning area
+    #
+    planningCollapsibleButton = ctk.ctkCollapsibleButton()
+    planningCollapsibleButton.text = "Entry Planning"
+    planningCollapsibleButton.collapsed = True
+    self.layout.addWidget(planningCollapsibleButton)
+    planningFormLayout = qt.QFormLayout(planningCollapsibleButton)
+
+    self.skinModelSelector = slicer.qMRMLNodeComboBox()
+    self.skinModelSelector.nodeTypes = ["vtkMRMLModelNode"]
+    self.skinModelSelector.selectNodeUponCreation = True
+    self.skinModelSelector.addEnabled = False
+    self.skinModelSelector.removeEnabled = False
+    self.skinModelSelector.noneEnabled = True
+    self.skinModelSelector.showHidden = False
+    self.skinModelSelector.showChildNodeTypes = False
+    self.skinModelSelector.setMRMLScene( slicer.mrmlScene )
+    self.skinModelSelector.setToolTip( "Every vertex of this model is evaluated as an entry point" )
+    planningFormLayout.addRow("Skin:", self.skinModelSelector)
+
+    self.planningTargetSelector = slicer.qMRMLNodeComboBox()
+    self.planningTargetSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+    self.planningTargetSelector.selectNodeUponCreation = True
+    self.planningTargetSelector.addEnabled = True
+    self.planningTargetSelector.removeEnabled = True
+    self.planningTargetSelector.noneEnabled = True
+    self.planningTargetSelector.showHidden = False
+    self.planningTargetSelector.showChildNodeTypes = False
+    self.planningTargetSelector.setMRMLScene( slicer.mrmlScene )
+    self.planningTargetSelector.setToolTip( "The first fiducial is the target of all candidate trajectories" )
+    planningFormLayout.addRow("Target:", self.planningTargetSelector)
+
+    self.criticalLabelsLineEdit = qt.QLineEdit()
+    self.criticalLabelsLineEdit.setToolTip("Labels the trajectory must not cross, separated by commas")
+    planningFormLayout.addRow("Critical labels:", self.criticalLabelsLineEdit)
+
+    self.evaluateButton = qt.QPushButton("Evaluate Entry Points")
+    self.evaluateButton.toolTip = "Evaluate the straight trajectory from every skin vertex to the target."
+    self.evaluateButton.connect('clicked(bool)', self.onEvaluateButton)
+    planningFormLayout.addRow(self.evaluateButton)
+
+    self.candidatesTable = qt.QTableWidget(0, 4)
+    self.candidatesTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.candidatesTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.candidatesTableHeaders = ["Vertex", "Entry Angle (Degrees)", "Clearance (mm)", "Length (mm)"]
+    self.candidatesTable.setHorizontalHeaderLabels(self.candidatesTableHeaders)
+    self.candidatesTable.horizontalHeader().setStretchLastSection(True)
+    planningFormLayout.addRow(self.candidatesTable)
+
+    #
+    # Multiple Trajectories area
+    #
+    trajectoriesCollapsibleButton = ctk.ctkCollapsibleButton()
+    trajectoriesCollapsibleButton.text = "Multiple Trajectories"
+    trajectoriesCollapsibleButton.collapsed = True
+    self.layout.addWidget(trajectoriesCollapsibleButton)
+    trajectoriesFormLayout = qt.QFormLayout(trajectoriesCollapsibleButton)
+
+    self.trajectoriesSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.trajectoriesSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+    self.trajectoriesSelector.addEnabled = False
+    self.trajectoriesSelector.removeEnabled = False
+    self.trajectoriesSelector.noneEnabled = False
+    self.trajectoriesSelector.showHidden = False
+    self.trajectoriesSelector.showChildNodeTypes = False
+    self.trajectoriesSelector.setMRMLScene( slicer.mrmlScene )
+    self.trajectoriesSelector.setToolTip( "Check the trajectories to evaluate against the label map and the entry angle model" )
+    trajectoriesFormLayout.addRow("Trajectories: ", self.trajectoriesSelector)
+
+    self.evaluateTrajectoriesButton = qt.QPushButton("Evaluate All")
+    self.evaluateTrajectoriesButton.toolTip = "Trace every checked trajectory through the label map and the models."
+    trajectoriesFormLayout.addRow(self.evaluateTrajectoriesButton)
+    self.evaluateTrajectoriesButton.connect('clicked(bool)', self.onEvaluateTrajectoriesButton)
+
+    self.trajectoriesTable = qt.QTableWidget(0, 6)
+    self.trajectoriesTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.trajectoriesTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.trajectoriesTableHeaders = ["Trajectory", "Structure", "Entry (mm)", "Exit (mm)", "Voxels", "Entry Angle (Degrees)"]
+    self.trajectoriesTable.setHorizontalHeaderLabels(self.trajectoriesTableHeaders)
+    self.trajectoriesTable.horizontalHeader().setStretchLastSection(True)
+    trajectoriesFormLayout.addRow(self.trajectoriesTable)
+
+    #
+    # Tool Tracking area
+    #
+    trackingCollapsibleButton = ctk.ctkCollapsibleButton()
+    trackingCollapsibleButton.text = "Tool Tracking"
+    trackingCollapsibleButton.collapsed = True
+    self.layout.addWidget(trackingCollapsibleButton)
+    trackingFormLayout = qt.QFormLayout(trackingCollapsibleButton)
+
+    self.toolTransformSelector = slicer.qMRMLNodeComboBox()
+    self.toolTransformSelector.nodeTypes = ["vtkMRMLLinearTransformNode"]
+    self.toolTransformSelector.selectNodeUponCreation = True
+    self.toolTransformSelector.addEnabled = True
+    self.toolTransformSelector.removeEnabled = False
+    self.toolTransformSelector.noneEnabled = True
+    self.toolTransformSelector.showHidden = False
+    self.toolTransformSelector.showChildNodeTypes = False
+    self.toolTransformSelector.setMRMLScene( slicer.mrmlScene )
+    self.toolTransformSelector.setToolTip( "Tool to world transform streamed by the tracker; the tip is at its origin" )
+    trackingFormLayout.addRow("Tool: ", self.toolTransformSelector)
+
+    self.toolAxisComboBox = qt.QComboBox()
+    self.toolAxisComboBox.addItems(["+Z", "-Z", "+Y", "-Y", "+X", "-X"])
+    self.toolAxisComboBox.setToolTip("Axis of the tool, in tool coordinates, pointing from the tip forward")
+    trackingFormLayout.addRow("Tool axis: ", self.toolAxisComboBox)
+
+    self.toolLengthSpinBox = qt.QDoubleSpinBox()
+    self.toolLengthSpinBox.minimum = 1.0
+    self.toolLengthSpinBox.maximum = 1000.0
+    self.toolLengthSpinBox.value = 100.0
+    self.toolLengthSpinBox.suffix = " mm"
+    self.toolLengthSpinBox.setToolTip("Length of the trajectory ahead of the tip")
+    trackingFormLayout.addRow("Trajectory length: ", self.toolLengthSpinBox)
+
+    self.latencyBudgetSpinBox = qt.QSpinBox()
+    self.latencyBudgetSpinBox.minimum = 1
+    self.latencyBudgetSpinBox.maximum = 1000
+    self.latencyBudgetSpinBox.value = 33
+    self.latencyBudgetSpinBox.suffix = " ms"
+    self.latencyBudgetSpinBox.setToolTip("Entry angles and clearance are skipped for poses that have used up this time")
+    trackingFormLayout.addRow("Latency budget: ", self.latencyBudgetSpinBox)
+
+    self.simulateToolCheckBox = qt.QCheckBox()
+    self.simulateToolCheckBox.checked = 0
+    self.simulateToolCheckBox.setToolTip("Move the tool along the trajectory with synthetic poses at 60 Hz, instead of a tracker")
+    self.simulateToolCheckBox.text = 'Drive the tool with synthetic poses'
+    trackingFormLayout.addRow(self.simulateToolCheckBox)
+
+    self.trackingButton = qt.QPushButton("Track Tool")
+    self.trackingButton.toolTip = "Report the structures crossed, entry angles and clearance at every pose of the tool."
+    self.trackingButton.checkable = True
+    trackingFormLayout.addRow(self.trackingButton)
+
+    self.trackingStatusLabel = qt.QLabel()
+    trackingFormLayout.addRow("Latency: ", self.trackingStatusLabel)
+
+    self.trackingButton.connect('toggled(bool)', self.onTrackingToggled)
+
+    #
+    # Performance Area
+    #
+    performanceCollapsibleButton = ctk.ctkCollapsibleButton()
+    performanceCollapsibleButton.text = "Performance"
+    performanceCollapsibleButton.collapsed = True
+    self.layout.addWidget(performanceCollapsibleButton)
+    performanceFormLayout = qt.QFormLayout(performanceCollapsibleButton)
+
+    self.profilingCheckBox = qt.QCheckBox()
+    self.profilingCheckBox.checked = self.logic.profiler.enabled
+    self.profilingCheckBox.setToolTip("Time the processing stages and count cache hits")
+    performanceFormLayout.addRow("Enable instrumentation: ", self.profilingCheckBox)
+
+    self.profilingTable = qt.QTableWidget(0, 6)
+    self.profilingTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.profilingTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.profilingTableHeaders = ["Stage", "Calls", "Mean (ms)", "95% (ms)", "Max (ms)", "Histogram"]
+    self.profilingTable.setHorizontalHeaderLabels(self.profilingTableHeaders)
+    self.profilingTable.horizontalHeader().setStretchLastSection(True)
+    performanceFormLayout.addRow(self.profilingTable)
+
+    profilingButtonsLayout = qt.QHBoxLayout()
+    self.refreshProfilingButton = qt.QPushButton("Refresh")
+    self.resetProfilingButton = qt.QPushButton("Reset")
+    self.exportTraceButton = qt.QPushButton("Export Trace...")
+    self.exportTraceButton.toolTip = "Save the timed stages for chrome://tracing or Perfetto"
+    profilingButtonsLayout.addWidget(self.refreshProfilingButton)
+    profilingButtonsLayout.addWidget(self.resetProfilingButton)
+    profilingButtonsLayout.addWidget(self.exportTraceButton)
+    performanceFormLayout.addRow(profilingButtonsLayout)
+
+    # Persistent cache of normals, distance fields, label boxes and entry angles
+    self.diskCachePathLineEdit = ctk.ctkPathLineEdit()
+    self.diskCachePathLineEdit.filters = ctk.ctkPathLineEdit.Dirs
+    self.diskCachePathLineEdit.currentPath = os.path.join(slicer.app.temporaryPath, 'CurveTracerCache')
+    self.diskCachePathLineEdit.setToolTip("Directory of the persistent cache, empty to disable it")
+    performanceFormLayout.addRow("Disk cache: ", self.diskCachePathLineEdit)
+    self.clearDiskCacheButton = qt.QPushButton("Clear Disk Cache")
+    performanceFormLayout.addRow(self.clearDiskCacheButton)
+    self.onDiskCachePathChanged(self.diskCachePathLineEdit.currentPath)
+
+    self.diskCachePathLineEdit.connect('currentPathChanged(QString)', self.onDiskCachePathChanged)
+    self.clearDiskCacheButton.connect('clicked(bool)', self.onClearDiskCache)
+    self.profilingCheckBox.connect('toggled(bool)', self.onProfilingToggled)
+    self.refreshProfilingButton.connect('clicked(bool)', self.updateProfilingTable)
+    self.resetProfilingButton.connect('clicked(bool)', self.onResetProfiling)
+    self.exportTraceButton.connect('clicked(bool)', self.onExportTrace)
+
+
 
 
     #
@@ -167,10 +440,105 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    #
+    # Structures crossed by the trajectory
+    #
+    self.structuresTable = qt.QTableWidget(0, 4)
+    self.structuresTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.structuresTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.structuresTableHeaders = ["Label", "Entry (mm)", "Exit (mm)", "Voxels"]
+    self.structuresTable.setHorizontalHeaderLabels(self.structuresTableHeaders)
+    self.structuresTable.horizontalHeader().setStretchLastSection(True)
+    parametersFormLayout.addRow(self.structuresTable)
+
+    #
+    # Clearance of the trajectory from selected labels
+    #
+    self.clearanceLabelsLineEdit = qt.QLineEdit()
+    self.clearanceLabelsLineEdit.setToolTip("Labels to measure the distance to, separated by commas")
+    parametersFormLayout.addRow("Clearance labels:", self.clearanceLabelsLineEdit)
+
+    self.clearanceTable = qt.QTableWidget(0, 3)
+    self.clearanceTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.clearanceTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.clearanceTableHeaders = ["Label", "Distance (mm)", "At (mm)"]
+    self.clearanceTable.setHorizontalHeaderLabels(self.clearanceTableHeaders)
+    self.clearanceTable.horizontalHeader().setStretchLastSection(True)
+    parametersFormLayout.addRow(self.clearanceTable)
+
+    #
+    # Labels and models within the radius of the tool
+    #
+    self.toolRadiusSpinBox = qt.QDoubleSpinBox()
+    self.toolRadiusSpinBox.minimum = 0.0
+    self.toolRadiusSpinBox.maximum = 20.0
+    self.toolRadiusSpinBox.singleStep = 0.5
+    self.toolRadiusSpinBox.value = 0.0
+    self.toolRadiusSpinBox.suffix = " mm"
+    self.toolRadiusSpinBox.setToolTip("Radius of the tool swept along the trajectory, 0 to only trace its centerline")
+    parametersFormLayout.addRow("Tool radius:", self.toolRadiusSpinBox)
+
+    self.sweptTable = qt.QTableWidget(0, 5)
+    self.sweptTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.sweptTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.sweptTableHeaders = ["Structure", "Distance (mm)", "Penetration (mm)", "At (mm)", "Voxels"]
+    self.sweptTable.setHorizontalHeaderLabels(self.sweptTableHeaders)
+    self.sweptTable.horizontalHeader().setStretchLastSection(True)
+    parametersFormLayout.addRow(self.sweptTable)
+
+    # Coalesce bursts of modified events (e.g. while a fiducial is dragged)
+    # into at most one table update per frame
+    self.fiducialsUpdateTimer = qt.QTimer()
+    self.fiducialsUpdateTimer.setSingleShot(True)
+    self.fiducialsUpdateTimer.setInterval(16)
+    self.fiducialsUpdateTimer.connect('timeout()', self.updateTargetFiducialsTable)
+    self.anglesUpdateTimer = qt.QTimer()
+    self.anglesUpdateTimer.setSingleShot(True)
+    self.anglesUpdateTimer.setInterval(16)
+    self.anglesUpdateTimer.connect('timeout()', self.updateAnglesTable)
+    # Refresh the performance table twice a second while instrumenting
+    self.profilingUpdateTimer = qt.QTimer()
+    self.profilingUpdateTimer.setInterval(500)
+    self.profilingUpdateTimer.connect('timeout()', self.updateProfilingTable)
+
+    # Entry angles, model proximities and tracing run in worker threads;
+    # their results are collected on the main thread, once per frame while
+    # jobs are pending
+    from CurveTracerLib import jobs
+    self.anglesJobs = jobs.JobQueue()
+    self.proximityJobs = jobs.JobQueue()
+    self.structuresJobs = jobs.JobQueue(1)
+    self.structuresLabelMapNode = None
+    self.jobsPollTimer = qt.QTimer()
+    self.jobsPollTimer.setInterval(16)
+    self.jobsPollTimer.connect('timeout()', self.onJobsPoll)
+
+    self.trajectoryNode = None
+    self.trajectoryTags = []
+
+    # Tool poses are evaluated in a PoseStream worker; the latest result is
+    # shown once per frame
+    self.toolStream = None
+    self.trackingLabelMapNode = None
+    self.trackingModelNodes = []
+    self.toolTransformNode = None
+    self.toolTransformTag = None
+    self.trackingFrame = 0
+    self.trackingPollTimer = qt.QTimer()
+    self.trackingPollTimer.setInterval(16)
+    self.trackingPollTimer.connect('timeout()', self.onTrackingPoll)
+    self.simulatedPoses = []
+    self.simulatedPoseIndex = 0
+    self.simulateToolTimer = qt.QTimer()
+    self.simulateToolTimer.setInterval(16)
+    self.simulateToolTimer.connect('timeout()', self.onSimulateToolTimer)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.inputLabelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputFiducialSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.inputFiducialSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onTrajectorySelected)
+    self.inputLabelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.scheduleAnglesTableUpdate)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -179,15 +547,286 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.fiducialsUpdateTimer.stop()
+    self.anglesUpdateTimer.stop()
+    self.profilingUpdateTimer.stop()
+    self.jobsPollTimer.stop()
+    self.stopTracking()
+    self.anglesJobs.shutdown()
+    self.proximityJobs.shutdown()
+    self.structuresJobs.shutdown()
+    for tag in self.trajectoryTags:
+      self.trajectoryNode.RemoveObserver(tag)
+    self.trajectoryTags = []
 
   def onSelect(self):
     self.applyButton.enabled = self.inputLabelSelector.currentNode() and self.inputFiducialSelector.currentNode()
 
   def onApplyButton(self):
-    logic = CurveTracerLogic()
-    logic.GetVoxelValue(self.inputLabelSelector.currentNode(), self.inputFiducialSelector.currentNode())
-
+    logic = self.logic
+    labelMapNode = self.inputLabelSelector.currentNode()
+    self.structuresLabelMapNode = labelMapNode
+    self.structuresJobs.submit({0: logic.TraceTrajectoryTask(labelMapNode, self.inputFiducialSelector.currentNode())})
+    self.jobsPollTimer.start()
+    clearance = logic.GetClearance(labelMapNode, self.parseLabels(self.clearanceLabelsLineEdit.text),
+                                   self.inputFiducialSelector.currentNode())
+    with logic.profiler.timer('Table/Clearance'):
+      self.updateClearanceTable(clearance)
+    radius = self.toolRadiusSpinBox.value
+    if radius > 0:
+      modelNodes, swept = logic.SweptStructures(labelMapNode, self.inputFiducialSelector.currentNode(), radius,
+                                                self.inputModelSelector.currentNode())
+      with logic.profiler.timer('Table/Swept'):
+        self.updateSweptTable(labelMapNode, modelNodes, swept)
+    else:
+      self.sweptTable.setRowCount(0)
+
+  def parseLabels(self, text):
+    return [int(label) for label in text.replace(',', ' ').split() if label.lstrip('-').isdigit()]
+
+  def labelName(self, labelMapNode, label):
+    colorNode = None
+    if labelMapNode.GetDisplayNode():
+      colorNode = labelMapNode.GetDisplayNode().GetColorNode()
+    if colorNode and colorNode.GetColorName(label):
+      return "%s (%d)" % (colorNode.GetColorName(label), label)
+    return "%d" % label
+
+  def updateStructuresTable(self, labelMapNode, trace):
+
+    # Background runs are not structures
+    trace = trace[trace['label'] != 0]
+    self.structuresTable.setRowCount(len(trace))
+
+    for i, run in enumerate(trace):
+      name = self.labelName(labelMapNode, int(run['label']))
+      self.structuresTable.setItem(i, 0, qt.QTableWidgetItem(name))
+      self.structuresTable.setItem(i, 1, qt.QTableWidgetItem("%.2f" % run['entry']))
+      self.structuresTable.setItem(i, 2, qt.QTableWidgetItem("%.2f" % run['exit']))
+      self.structuresTable.setItem(i, 3, qt.QTableWidgetItem("%d" % run['voxels']))
+
+    self.structuresTable.show()
+
+  def updateClearanceTable(self, clearance):
+
+    self.clearanceTable.setRowCount(len(clearance))
+    for i, row in enumerate(clearance):
+      self.clearanceTable.setItem(i, 0, qt.QTableWidgetItem("%d" % row['label']))
+      self.clearanceTable.setItem(i, 1, qt.QTableWidgetItem("%.2f" % row['distance']))
+      self.clearanceTable.setItem(i, 2, qt.QTableWidgetItem("%.2f" % row['arcLength']))
+    self.clearanceTable.show()
+
+  def updateSweptTable(self, labelMapNode, modelNodes, swept):
+
+    self.sweptTable.setRowCount(len(swept))
+    for i, row in enumerate(swept):
+      if row['source'] == 'label':
+        name = self.labelName(labelMapNode, int(row['structure']))
+        voxels = "%d" % row['voxels']
+      else:
+        name = modelNodes[row['structure']].GetName()
+        voxels = ""
+      self.sweptTable.setItem(i, 0, qt.QTableWidgetItem(name))
+      self.sweptTable.setItem(i, 1, qt.QTableWidgetItem("%.2f" % row['distance']))
+      self.sweptTable.setItem(i, 2, qt.QTableWidgetItem("%.2f" % row['penetration']))
+      self.sweptTable.setItem(i, 3, qt.QTableWidgetItem("%.2f" % row['arcLength']))
+      self.sweptTable.setItem(i, 4, qt.QTableWidgetItem(voxels))
+    self.sweptTable.show()
+
+  def onEvaluateButton(self):
+
+    labelMapNode = self.inputLabelSelector.currentNode()
+    skinModelNode = self.skinModelSelector.currentNode()
+    targetNode = self.planningTargetSelector.currentNode()
+    if not labelMapNode or not skinModelNode or not targetNode or targetNode.GetNumberOfFiducials() < 1:
+      return
+
+    criticalLabels = self.parseLabels(self.criticalLabelsLineEdit.text)
+    candidates = self.logic.EvaluateEntryPoints(labelMapNode, skinModelNode, targetNode, criticalLabels)
+
+    self.candidatesTable.setRowCount(len(candidates))
+    for i, candidate in enumerate(candidates):
+      self.candidatesTable.setItem(i, 0, qt.QTableWidgetItem("%d" % candidate['vertex']))
+      self.candidatesTable.setItem(i, 1, qt.QTableWidgetItem("%.1f" % candidate['angle']))
+      self.candidatesTable.setItem(i, 2, qt.QTableWidgetItem("%.2f" % candidate['clearance']))
+      self.candidatesTable.setItem(i, 3, qt.QTableWidgetItem("%.2f" % candidate['length']))
+    self.candidatesTable.show()
+
+  def onEvaluateTrajectoriesButton(self):
+
+    import numpy as np
+    trajectoryNodes = self.trajectoriesSelector.checkedNodes()
+    labelMapNode = self.inputLabelSelector.currentNode()
+    modelNode = self.inputModelSelector.currentNode()
+    rows = self.logic.EvaluateTrajectories(labelMapNode, trajectoryNodes, modelNode)
+
+    modelNodes = []
+    if modelNode:
+      modelNodes = self.logic.GetHierarchyModelNodes(modelNode)
+
+    self.trajectoriesTable.setRowCount(len(rows))
+    for i, row in enumerate(rows):
+      if row['source'] == 'label':
+        structure = self.labelName(labelMapNode, int(row['structure']))
+        voxels = "%d" % row['voxels']
+      else:
+        structure = modelNodes[row['structure']].GetName()
+        voxels = ""
+      angle = "" if np.isnan(row['angle']) else "%f" % row['angle']
+      self.trajectoriesTable.setItem(i, 0, qt.QTableWidgetItem(trajectoryNodes[row['trajectory']].GetName()))
+      self.trajectoriesTable.setItem(i, 1, qt.QTableWidgetItem(structure))
+      self.trajectoriesTable.setItem(i, 2, qt.QTableWidgetItem("%.2f" % row['entry']))
+      self.trajectoriesTable.setItem(i, 3, qt.QTableWidgetItem("%.2f" % row['exit']))
+      self.trajectoriesTable.setItem(i, 4, qt.QTableWidgetItem(voxels))
+      self.trajectoriesTable.setItem(i, 5, qt.QTableWidgetItem(angle))
+    self.trajectoriesTable.show()
+
+  def onTrackingToggled(self, checked):
+
+    self.stopTracking()
+    transformNode = self.toolTransformSelector.currentNode()
+    if not checked or not transformNode:
+      self.trackingButton.checked = False
+      return
+
+    from CurveTracerLib import tracking
+    axis = {"+Z": (0, 0, 1), "-Z": (0, 0, -1), "+Y": (0, 1, 0), "-Y": (0, -1, 0),
+            "+X": (1, 0, 0), "-X": (-1, 0, 0)}[self.toolAxisComboBox.currentText]
+    self.trackingLabelMapNode = self.inputLabelSelector.currentNode()
+    self.trackingModelNodes, evaluator = self.logic.ToolEvaluator(
+      self.trackingLabelMapNode, self.inputModelNode, self.parseLabels(self.clearanceLabelsLineEdit.text),
+      axis=axis, ahead=self.toolLengthSpinBox.value)
+    self.toolStream = tracking.PoseStream(evaluator.evaluate, self.latencyBudgetSpinBox.value / 1000.0)
+    self.trackingFrame = 0
+
+    self.toolTransformNode = transformNode
+    self.toolTransformTag = transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                                                      self.onToolTransformModified)
+    self.toolStream.push(self.logic.GetTransformToWorld(transformNode))
+    self.trackingPollTimer.start()
+    if self.simulateToolCheckBox.checked:
+      self.startToolSimulation()
+
+  def stopTracking(self):
+    self.trackingPollTimer.stop()
+    self.simulateToolTimer.stop()
+    if self.toolTransformNode and self.toolTransformTag:
+      self.toolTransformNode.RemoveObserver(self.toolTransformTag)
+    self.toolTransformNode = None
+    self.toolTransformTag = None
+    if self.toolStream:
+      self.toolStream.stop()
+      self.toolStream = None
+
+  def startToolSimulation(self):
+    # Insert the tool along the trajectory, or along S without one
+    from CurveTracerLib import synthetic
+    trajectoryNode = self.inputFiducialSelector.currentNode()
+    entry, target = [0.0, 0.0, -50.0], [0.0, 0.0, 50.0]
+    if trajectoryNode and trajectoryNode.GetNumberOfFiducials() >= 2:
+      points = self.logic.GetFiducialPositions(trajectoryNode)
+      entry, target = points[0], points[-1]
+    self.simulatedPoses = synthetic.toolPoses(600, entry, target)
+    self.simulatedPoseIndex = 0
+    self.simulateToolTimer.start()
+
+  def onSimulateToolTimer(self):
+    from CurveTracerLib import conversion
+    pose = self.simulatedPoses[self.simulatedPoseIndex % len(self.simulatedPoses)]
+    self.simulatedPoseIndex += 1
+    self.toolTransformNode.SetMatrixTransformToParent(conversion.matrixFromArray(pose))
+
+  def onToolTransformModified(self, caller, event):
+    if self.toolStream:
+      self.toolStream.push(self.logic.GetTransformToWorld(caller))
+
+  def onTrackingPoll(self):
+
+    frame, result = self.toolStream.ring.latest()
+    if frame is None or frame['frame'] == self.trackingFrame:
+      return
+    self.trackingFrame = frame['frame']
+
+    statistics = self.toolStream.ring.statistics()
+    self.trackingStatusLabel.text = ("%.1f ms (mean %.1f, 95%% %.1f, max %.1f), %d dropped, %d over budget" %
+                                     (frame['latency'] * 1000.0, statistics['mean'], statistics['p95'],
+                                      statistics['max'], statistics['dropped'], statistics['overBudget']))
+    values, error = result
+    if error:
+      logging.error('Tool tracking failed: %s' % error)
+      return
+
+    points, trace, angles, clearance = values
+    with self.logic.profiler.timer('Table/Tracking'):
+      if trace is not None and self.trackingLabelMapNode:
+        self.updateStructuresTable(self.trackingLabelMapNode, trace)
+      if angles is not None and self.trackingModelNodes:
+        # Tracking takes over the rows: entry angle jobs of the static
+        # trajectory must not write into them
+        self.anglesJobs.cancel()
+        self.proximityJobs.cancel()
+        self.anglesTableData = []
+        if self.anglesTable.columnCount != len(self.anglesTableHeaders):
+          self.anglesTable.setColumnCount(len(self.anglesTableHeaders))
+          self.anglesTable.setHorizontalHeaderLabels(self.anglesTableHeaders)
+        self.anglesTable.setRowCount(len(angles))
+        for i, angle in enumerate(angles):
+          self.anglesTable.setItem(i, 0, qt.QTableWidgetItem(self.trackingModelNodes[i].GetName()))
+          self.anglesTable.setItem(i, 1, qt.QTableWidgetItem("%f" % angle))
+          self.anglesTable.setItem(i, 2, self.proximityItem(None))
+      if clearance is not None:
+        self.updateClearanceTable(clearance)
+
+  def onDiskCachePathChanged(self, path):
+    self.logic.SetDiskCacheDirectory(path or None)
+    self.clearDiskCacheButton.enabled = self.logic.diskCache is not None
+
+  def onClearDiskCache(self):
+    if self.logic.diskCache:
+      self.logic.diskCache.clear()
+
+  def onProfilingToggled(self, checked):
+    self.logic.profiler.enabled = checked
+    if checked:
+      self.profilingUpdateTimer.start()
+    else:
+      self.profilingUpdateTimer.stop()
+    self.updateProfilingTable()
+
+  def onResetProfiling(self):
+    self.logic.profiler.clear()
+    self.updateProfilingTable()
+
+  def onExportTrace(self):
+    path = qt.QFileDialog.getSaveFileName(None, "Export Trace", "CurveTracerTrace.json", "Trace (*.json)")
+    if path:
+      self.logic.profiler.exportTrace(path)
+
+  def updateProfilingTable(self):
+
+    from CurveTracerLib import profiling
+    profiler = self.logic.profiler
+    summary = profiler.summary()
+    counters = profiler.copyCounters()
+    self.profilingTable.setRowCount(len(summary) + len(counters))
+
+    for i, name in enumerate(sorted(summary)):
+      stage = summary[name]
+      self.profilingTable.setItem(i, 0, qt.QTableWidgetItem(name))
+      self.profilingTable.setItem(i, 1, qt.QTableWidgetItem("%d" % stage['calls']))
+      self.profilingTable.setItem(i, 2, qt.QTableWidgetItem("%.3f" % stage['mean']))
+      self.profilingTable.setItem(i, 3, qt.QTableWidgetItem("%.3f" % stage['p95']))
+      self.profilingTable.setItem(i, 4, qt.QTableWidgetItem("%.3f" % stage['max']))
+      self.profilingTable.setItem(i, 5, qt.QTableWidgetItem(profiling.histogramText(profiler.histogram(name))))
+
+    # Counters only fill the Calls column
+    for i, name in enumerate(sorted(counters), len(summary)):
+      self.profilingTable.setItem(i, 0, qt.QTableWidgetItem(name))
+      self.profilingTable.setItem(i, 1, qt.QTableWidgetItem("%d" % counters[name]))
+      for column in range(2, 6):
+        self.profilingTable.setItem(i, column, qt.QTableWidgetItem(""))
+
+    self.profilingTable.show()
 
   def onReload(self,moduleName="CurveTracer"):
     """Generic reload method for any scripted module.
@@ -200,78 +839,311 @@ class CurveTracerWidget(ScriptedLoadableModuleWidget):
   def onTargetFiducialsSelected(self):
 
     # Remove observer if previous node exists
-    if self.targetFiducialsNode and self.tag:
-      self.targetFiducialsNode.RemoveObserver(self.tag)
+    if self.targetFiducialsNode and self.targetTag:
+      self.targetFiducialsNode.RemoveObserver(self.targetTag)
 
     # Update selected node, add observer, and update control points
     if self.targetFiducialsSelector.currentNode():
       self.targetFiducialsNode = self.targetFiducialsSelector.currentNode()
-      self.tag = self.targetFiducialsNode.AddObserver('ModifiedEvent', self.onTargetFiducialsUpdated)
+      self.targetTag = self.targetFiducialsNode.AddObserver('ModifiedEvent', self.onTargetFiducialsUpdated)
     else:
       self.targetFiducialsNode = None
-      self.tag = None
+      self.targetTag = None
     self.updateTargetFiducialsTable()
 
     
   def onTargetFiducialsUpdated(self,caller,event):
     if caller.IsA('vtkMRMLMarkupsFiducialNode') and event == 'ModifiedEvent':
-      self.updateTargetFiducialsTable()
+      self.scheduleTargetFiducialsTableUpdate()
+
+  def scheduleTargetFiducialsTableUpdate(self):
+    # The timer is not restarted while it runs, so a continuous stream of
+    # events still updates the table once per frame
+    if not self.fiducialsUpdateTimer.isActive():
+      self.fiducialsUpdateTimer.start()
 
 
   def updateTargetFiducialsTable(self):
+    with self.logic.profiler.timer('Table/Targets'):
+      self.fillTargetFiducialsTable()
 
-    logic = CurveTracerLogic()
+  def fillTargetFiducialsTable(self):
+
+    logic = self.logic
 
+    errorVectors = None
     if not self.targetFiducialsNode:
       self.fiducialsTable.clear()
       self.fiducialsTable.setHorizontalHeaderLabels(self.fiducialsTableHeaders)
 
     else:
 
-      labell = self.inputLabelSelector.currentNode()
-      fiducial = self.targetFiducialsNode
+      results = logic.GetTargetResults(self.inputLabelSelector.currentNode(), self.targetFiducialsNode)
+      trajectoryNode = self.inputFiducialSelector.currentNode()
+      if trajectoryNode and trajectoryNode.GetNumberOfFiducials() > 0:
+        errorVectors = logic.GetErrorVectors(trajectoryNode, self.targetFiducialsNode, self.extrapolateCheckBox.checked)
       self.fiducialsTableData = []
-      nOfControlPoints = self.targetFiducialsNode.GetNumberOfFiducials()
+      nOfControlPoints = len(results)
 
       if self.fiducialsTable.rowCount != nOfControlPoints:
         self.fiducialsTable.setRowCount(nOfControlPoints)
 
-      
-      for i in range(nOfControlPoints):
-
-        label = self.targetFiducialsNode.GetNthFiducialLabel(i)
-        pos = [0.0, 0.0, 0.0]
+      # Avoid repainting after each item for large target lists
+      self.fiducialsTable.setUpdatesEnabled(False)
+      for i, result in enumerate(results):
 
-        self.targetFiducialsNode.GetNthFiducialPosition(i,pos)
-        vox = logic.GetVoxelValue(labell, fiducial)
-
-        
-        if vox != 0.0:
-          c1 = "1"
-          c2 = "1"
-          c3= "1"
-        else:
-          c1 = "0"
-          c2 = "0"
-          c3 = "0"
-          
-          
-
-        cellLabel = qt.QTableWidgetItem(label)
-        cell1 = qt.QTableWidgetItem(c1)
-        cell2= qt.QTableWidgetItem(c2)
-        cell3 = qt.QTableWidgetItem(c3) 
-        row = [cellLabel, cell1, cell2, cell3]
+        cellLabel = qt.QTableWidgetItem(result['label'])
+        cell1 = qt.QTableWidgetItem("%d" % result['value'])
+        cell2 = qt.QTableWidgetItem("1" if result['inBounds'] else "0")
+        cell3 = qt.QTableWidgetItem("1" if result['inside'] else "0")
+        cell4 = qt.QTableWidgetItem("%.2f" % errorVectors[0][i] if errorVectors else "")
+        row = [cellLabel, cell1, cell2, cell3, cell4]
 
         self.fiducialsTable.setItem(i, 0, row[0])
         self.fiducialsTable.setItem(i, 1, row[1])
         self.fiducialsTable.setItem(i, 2, row[2])
         self.fiducialsTable.setItem(i, 3, row[3])
+        self.fiducialsTable.setItem(i, 4, row[4])
 
         self.fiducialsTableData.append(row)
-        
+      self.fiducialsTable.setUpdatesEnabled(True)
+
     self.fiducialsTable.show()
 
+    if errorVectors and self.showErrorVectorCheckBox.checked:
+      self.updateErrorVectorsModel(logic.GetFiducialPositions(self.targetFiducialsNode), errorVectors[1])
+    elif self.errorVectorsModelNode:
+      slicer.mrmlScene.RemoveNode(self.errorVectorsModelNode)
+      self.errorVectorsModelNode = None
+
+  def updateErrorVectorsModel(self, targets, feet):
+    # All vectors go into one model node; one markups node per target
+    # would not scale to thousands of targets
+    from CurveTracerLib import conversion
+    poly = conversion.linesPolyData(targets, feet)
+    if self.errorVectorsModelNode and slicer.mrmlScene.IsNodePresent(self.errorVectorsModelNode):
+      self.errorVectorsModelNode.SetAndObservePolyData(poly)
+    else:
+      self.errorVectorsModelNode = slicer.modules.models.logic().AddModel(poly)
+      self.errorVectorsModelNode.SetName(slicer.mrmlScene.GenerateUniqueName("ErrorVectors"))
+      self.errorVectorsModelNode.GetDisplayNode().SetColor(1.0, 1.0, 0.0)
+      self.errorVectorsModelNode.GetDisplayNode().SetSliceIntersectionVisibility(True)
+
+  def onModelSelected(self):
+
+    # Remove observer if previous node exists
+    if self.inputModelNode and self.modelTag:
+      self.inputModelNode.RemoveObserver(self.modelTag)
+
+    # Update selected node, add observer, and update control points
+    if self.inputModelSelector.currentNode():
+      self.inputModelNode = self.inputModelSelector.currentNode()
+      self.modelTag = self.inputModelNode.AddObserver('ModifiedEvent', self.onModelUpdated)
+    else:
+      self.inputModelNode = None
+      self.modelTag = None
+    self.updateAnglesTable()
+
+  def onTrajectorySelected(self):
+
+    for tag in self.trajectoryTags:
+      self.trajectoryNode.RemoveObserver(tag)
+    self.trajectoryTags = []
+
+    self.trajectoryNode = self.inputFiducialSelector.currentNode()
+    if self.trajectoryNode:
+      for event in [vtk.vtkCommand.ModifiedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent]:
+        self.trajectoryTags.append(self.trajectoryNode.AddObserver(event, self.onTrajectoryUpdated))
+    self.scheduleAnglesTableUpdate()
+    self.scheduleTargetFiducialsTableUpdate()
+
+  def onTrajectoryUpdated(self,caller,event):
+    # The structures table is only traced on Apply, a pending trace is stale
+    self.structuresJobs.cancel()
+    self.scheduleAnglesTableUpdate()
+    self.scheduleTargetFiducialsTableUpdate()
+
+  def onModelUpdated(self,caller,event):
+    if caller.IsA('vtkMRMLModelHierarchyNode') and event == 'ModifiedEvent':
+      self.scheduleAnglesTableUpdate()
+
+  def scheduleAnglesTableUpdate(self):
+    # The timer is not restarted while it runs, so a continuous stream of
+    # events still updates the table once per frame
+    if not self.anglesUpdateTimer.isActive():
+      self.anglesUpdateTimer.start()
+
+
+  def updateAnglesTable(self):
+    with self.logic.profiler.timer('Table/Angles'):
+      self.fillAnglesTable()
+
+  def fillAnglesTable(self):
+
+    logic = self.logic
+
+    if not self.inputModelNode and self.labelSurfacesCheckBox.checked and self.inputLabelSelector.currentNode():
+      self.updateLabelAnglesTable(self.inputLabelSelector.currentNode())
+
+    elif not self.inputModelNode:
+      self.anglesJobs.cancel()
+      self.proximityJobs.cancel()
+      self.anglesTable.clear()
+      self.anglesTable.setColumnCount(len(self.anglesTableHeaders))
+      self.anglesTable.setHorizontalHeaderLabels(self.anglesTableHeaders)
+
+    elif self.allCrossingsCheckBox.checked:
+      self.anglesJobs.cancel()
+      self.proximityJobs.cancel()
+      self.updateCrossingsTable()
+      return
+
+    else:
+
+      if self.anglesTable.columnCount != len(self.anglesTableHeaders):
+        self.anglesTable.setColumnCount(len(self.anglesTableHeaders))
+        self.anglesTable.setHorizontalHeaderLabels(self.anglesTableHeaders)
+
+      self.anglesTableData = []
+      modelNodes, tasks = logic.EntryAngleTasks(self.inputModelNode, self.inputFiducialSelector.currentNode())
+      nOfModels = len(modelNodes)
+      proximities = None
+      proximityTasks = {}
+      if self.inputFiducialSelector.currentNode():
+        proximities, proximityTasks = logic.ModelProximityTasks(self.inputModelNode,
+                                                                self.inputFiducialSelector.currentNode(),
+                                                                self.proximityRadiusSpinBox.value)[1:]
+
+      if self.anglesTable.rowCount != nOfModels:
+        self.anglesTable.setRowCount(nOfModels)
+
+      for i, mnode in enumerate(modelNodes):
+
+        name = mnode.GetName()
+        cellModels = qt.QTableWidgetItem(name)
+        if i not in tasks:
+          cellAngle = qt.QTableWidgetItem("%f" % 0.0)
+        else:
+          cellAngle = self.pendingAngleItem(i, name)
+
+        if i in proximityTasks:
+          cellProximity = qt.QTableWidgetItem("...")
+        else:
+          cellProximity = self.proximityItem(None if proximities is None else proximities[i])
+
+        row = [cellModels, cellAngle, cellProximity]
+        self.anglesTable.setItem(i, 0, row[0])
+        self.anglesTable.setItem(i, 1, row[1])
+        self.anglesTable.setItem(i, 2, row[2])
+
+        self.anglesTableData.append(row)
+
+      # Cancels the jobs of the previous trajectory
+      self.anglesJobs.submit(tasks)
+      self.proximityJobs.submit(proximityTasks)
+      if tasks or proximityTasks:
+        self.jobsPollTimer.start()
+
+    self.anglesTable.show()
+
+  def updateLabelAnglesTable(self, labelMapNode):
+
+    angles, tasks = self.logic.LabelEntryAngleTasks(labelMapNode, self.inputFiducialSelector.currentNode(),
+                                                    self.surfaceSmoothingSpinBox.value)
+
+    if self.anglesTable.columnCount != len(self.anglesTableHeaders):
+      self.anglesTable.setColumnCount(len(self.anglesTableHeaders))
+      self.anglesTable.setHorizontalHeaderLabels(self.anglesTableHeaders)
+    if self.anglesTable.rowCount != len(angles):
+      self.anglesTable.setRowCount(len(angles))
+
+    self.proximityJobs.cancel()
+    self.anglesTableData = []
+    for i, label in enumerate(angles['label']):
+      name = self.labelName(labelMapNode, int(label))
+      row = [qt.QTableWidgetItem(name), self.pendingAngleItem(i, name), self.proximityItem(None)]
+      self.anglesTable.setItem(i, 0, row[0])
+      self.anglesTable.setItem(i, 1, row[1])
+      self.anglesTable.setItem(i, 2, row[2])
+      self.anglesTableData.append(row)
+
+    self.anglesJobs.submit(tasks)
+    if tasks:
+      self.jobsPollTimer.start()
+
+  def proximityItem(self, row):
+    # Distance to a model (a PROXIMITY_DTYPE row), with the closest points
+    # as tool tip
+    if row is None:
+      return qt.QTableWidgetItem("")
+    if row['distance'] >= self.proximityRadiusSpinBox.value:
+      return qt.QTableWidgetItem("> %.2f" % self.proximityRadiusSpinBox.value)
+    item = qt.QTableWidgetItem("%.2f" % row['distance'])
+    item.setToolTip("At %.2f mm, trajectory (%.2f, %.2f, %.2f), surface (%.2f, %.2f, %.2f)" %
+                    ((row['arcLength'],) + tuple(row['trajectoryPoint']) + tuple(row['surfacePoint'])))
+    return item
+
+  def pendingAngleItem(self, i, name):
+    # Keep showing the previous angle of row i until the new one arrives
+    previous = self.anglesTable.item(i, 1)
+    sameRow = self.anglesTable.item(i, 0) and self.anglesTable.item(i, 0).text() == name
+    return qt.QTableWidgetItem(previous.text() if previous and sameRow else "...")
+
+  def onJobsPoll(self):
+
+    for i, entryAngle, error in self.anglesJobs.poll():
+      if i >= len(self.anglesTableData):
+        continue
+      if error:
+        logging.error('Entry angle of %s failed: %s' % (self.anglesTableData[i][0].text(), error))
+        self.anglesTableData[i][1].setText("Error")
+      elif entryAngle is not None:
+        self.anglesTableData[i][1].setText("%f" % entryAngle)
+
+    for i, proximity, error in self.proximityJobs.poll():
+      if i >= len(self.anglesTableData):
+        continue
+      if error:
+        logging.error('Proximity of %s failed: %s' % (self.anglesTableData[i][0].text(), error))
+        self.anglesTableData[i][2].setText("Error")
+      elif proximity is not None:
+        self.anglesTableData[i][2] = self.proximityItem(proximity)
+        self.anglesTable.setItem(i, 2, self.anglesTableData[i][2])
+
+    for i, trace, error in self.structuresJobs.poll():
+      if error:
+        logging.error('Tracing failed: %s' % error)
+      else:
+        with self.logic.profiler.timer('Table/Structures'):
+          self.updateStructuresTable(self.structuresLabelMapNode, trace)
+
+    if not self.anglesJobs.busy() and not self.proximityJobs.busy() and not self.structuresJobs.busy():
+      self.jobsPollTimer.stop()
+
+  def updateCrossingsTable(self):
+
+    modelNodes = self.logic.GetHierarchyModelNodes(self.inputModelNode)
+    crossings = []
+    if self.inputFiducialSelector.currentNode():
+      crossings = self.logic.GetCrossings(self.inputModelNode, self.inputFiducialSelector.currentNode())
+
+    if self.anglesTable.columnCount != len(self.crossingsTableHeaders):
+      self.anglesTable.setColumnCount(len(self.crossingsTableHeaders))
+      self.anglesTable.setHorizontalHeaderLabels(self.crossingsTableHeaders)
+    self.anglesTable.setRowCount(len(crossings))
+
+    self.anglesTableData = []
+    for i, crossing in enumerate(crossings):
+      row = [qt.QTableWidgetItem(modelNodes[crossing['model']].GetName()),
+             qt.QTableWidgetItem("%f" % crossing['angle']),
+             qt.QTableWidgetItem("Entry" if crossing['entering'] else "Exit"),
+             qt.QTableWidgetItem("%.2f" % crossing['arcLength'])]
+      for column, item in enumerate(row):
+        self.anglesTable.setItem(i, column, item)
+      self.anglesTableData.append(row)
+
+    self.anglesTable.show()
+
       
 
     
@@ -285,11 +1157,26 @@ class CurveTracerLogic(ScriptedLoadableModuleLogic):
   should be such that other python code can import
   this class and make use of the functionality without
   requiring an instance of the Widget.
+  The computations themselves live in the Slicer-independent
+  CurveTracerLib package; this class extracts arrays from the MRML
+  nodes and passes them on.
   Uses ScriptedLoadableModuleLogic base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    from CurveTracerLib import distance, locators, profiling, surfaces
+    self.profiler = profiling.profiler
+    self.locatorCache = locators.LocatorCache()
+    self.surfaceCache = surfaces.SurfaceCache()
+    self.distanceCache = distance.DistanceCache()
+    self.labelMapHashes = {}
+    self.labelMapBoxes = {}
+    self.labelMapPyramids = {}
+    self.meshHashes = {}
+    self.meshTriangles = {}
+    self.diskCache = None
 
   def hasImageData(self,volumeNode):
     """This is an example logic method that
@@ -352,33 +1239,722 @@ class CurveTracerLogic(ScriptedLoadableModuleLogic):
     annotationLogic = slicer.modules.annotations.logic()
     annotationLogic.CreateSnapShot(name, description, type, 1, imageData)
 
-  def GetVoxelValue(self, inputLabelMapNode, inputFiducialNode):
-    """
-    Run the actual algorithm
+  def GetFiducialPositions(self, inputFiducialNode):
+    """Return the RAS positions of all fiducials as an (N,3) array
     """
-
-    logging.info('Processing started')
-
-    print ("run() is called.")
-
-
+    import numpy as np
     nOfFiducials = inputFiducialNode.GetNumberOfFiducials()
-    
+    points = np.zeros((nOfFiducials, 3))
+    pos = [0.0, 0.0, 0.0]
     for i in range(nOfFiducials):
-      pos = [0.0, 0.0, 0.0]
-      lab = inputFiducialNode.GetNthFiducialLabel(i)
       inputFiducialNode.GetNthFiducialPosition(i, pos)
-      image = inputLabelMapNode.GetImageData()
-      xyz = [pos[0], pos[1],pos[2], 1.0]
+      points[i] = pos
+    return points
+
+  def GetPoints(self, points):
+    """Return the positions of a fiducial node, or points as an (N,3) array
+    """
+    if hasattr(points, 'GetNumberOfFiducials'):
+      return self.GetFiducialPositions(points)
+    from CurveTracerLib import geometry
+    return geometry.asPoints(points)
+
+  def GetLabelMapArray(self, inputLabelMapNode):
+    """Return a zero-copy NumPy view of the label map voxels, indexed [k, j, i]
+    """
+    from CurveTracerLib import conversion
+    return conversion.arrayFromImageData(inputLabelMapNode.GetImageData())
+
+  def GetRASToIJKArray(self, inputLabelMapNode):
+    """Return the RAS to IJK matrix of the label map as a 4x4 array,
+    including a linear parent transform. Non-linear parent transforms are
+    handled by GetLabelMapROI.
+    """
+    from CurveTracerLib import conversion
+    matrix = vtk.vtkMatrix4x4()
+    inputLabelMapNode.GetRASToIJKMatrix(matrix)
+    rasToIjk = conversion.arrayFromMatrix(matrix)
+    transformNode = inputLabelMapNode.GetParentTransformNode()
+    if transformNode and transformNode.IsTransformToWorldLinear():
+      transformNode.GetMatrixTransformFromWorld(matrix)
+      rasToIjk = rasToIjk.dot(conversion.arrayFromMatrix(matrix))
+    return rasToIjk
+
+  def GetLabelMapROI(self, inputLabelMapNode, points, margin=1, narrow=True):
+    """Return (labels, rasToIjk) for the block of the label map within
+    margin voxels of the bounding box of points, an (N,3) RAS array.
+    The block is a zero-copy view, unless the label map has a non-linear
+    parent transform (only the block is resampled) or, with narrow, a dtype
+    wider than its values need (only the block is narrowed, from the value
+    range of the occupancy pyramid). Lookups of a few voxels pass
+    narrow=False, which neither copies the block nor builds the pyramid.
+    """
+    with self.profiler.timer('LabelMapROI'):
+      from CurveTracerLib import conversion, roi
+      transformNode = inputLabelMapNode.GetParentTransformNode()
+      if not transformNode or transformNode.IsTransformToWorldLinear():
+        pyramid = self.GetOccupancyPyramid(inputLabelMapNode) if narrow else None
+        return roi.cropLabels(self.GetLabelMapArray(inputLabelMapNode), self.GetRASToIJKArray(inputLabelMapNode),
+                              points, margin, narrow=narrow, pyramid=pyramid)
+
+      # Resample the block of the untransformed voxel lattice around the points
       matrix = vtk.vtkMatrix4x4()
       inputLabelMapNode.GetRASToIJKMatrix(matrix)
-      ijk = matrix.MultiplyDoublePoint(xyz)
-      voxel = image.GetScalarComponentAsDouble(int(round(ijk[0])), int(round(ijk[1])), int(round(ijk[2])), 0)
-      return voxel
-    
+      rasToIjk = conversion.arrayFromMatrix(matrix)
+      imageData = inputLabelMapNode.GetImageData()
+      box = roi.trajectoryBox(imageData.GetDimensions()[::-1], rasToIjk, points, margin)
+      if box is None:
+        return self.GetLabelMapArray(inputLabelMapNode)[:0, :0, :0], rasToIjk
+      lower, upper = box
+
+      worldToLocal = vtk.vtkGeneralTransform()
+      slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(None, transformNode, worldToLocal)
+      outputToInput = vtk.vtkGeneralTransform()
+      outputToInput.PostMultiply()
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputLabelMapNode.GetIJKToRASMatrix(ijkToRas)
+      outputToInput.Concatenate(ijkToRas)
+      outputToInput.Concatenate(worldToLocal)
+      outputToInput.Concatenate(matrix)
+      return roi.resampleBlock(imageData, outputToInput, lower, upper), roi.shiftMatrix(rasToIjk, lower)
+
+  def GetLabelMapHash(self, inputLabelMapNode):
+    """Return the content hash of the label map voxels. It is only
+    recomputed when the image data changes.
+    """
+    from CurveTracerLib import distance
+    imageData = inputLabelMapNode.GetImageData()
+    stamp = (imageData, imageData.GetMTime())
+    entry = self.labelMapHashes.get(inputLabelMapNode.GetID())
+    if entry is None or entry[0] != stamp:
+      entry = (stamp, distance.contentHash(self.GetLabelMapArray(inputLabelMapNode)))
+      self.labelMapHashes[inputLabelMapNode.GetID()] = entry
+    return entry[1]
+
+  def SetDiskCacheDirectory(self, directory, maxBytes=2 * 1024 ** 3):
+    """Keep distance fields, normals, label boxes and entry angles in a
+    persistent cache in directory (see diskcache.DiskCache), so they are
+    reused after the scene is reopened. None disables it.
+    """
+    from CurveTracerLib import diskcache
+    if self.diskCache:
+      self.diskCache.close()
+    self.diskCache = diskcache.DiskCache(directory, maxBytes) if directory else None
+    self.locatorCache.diskCache = self.diskCache
+    self.distanceCache.diskCache = self.diskCache
+
+  def GetLabelBoxes(self, inputLabelMapNode):
+    """Return the bounding boxes of all labels (boxes.LabelBoxes). They are
+    only recomputed when the image data changes, or read from the disk
+    cache.
+    """
+    from CurveTracerLib import boxes, diskcache
+    imageData = inputLabelMapNode.GetImageData()
+    stamp = (imageData, imageData.GetMTime())
+    entry = self.labelMapBoxes.get(inputLabelMapNode.GetID())
+    if entry is None or entry[0] != stamp:
+      labelBoxes = None
+      if self.diskCache:
+        diskKey = diskcache.digest('LabelBoxes', self.GetLabelMapHash(inputLabelMapNode))
+        labelBoxes = self.diskCache.getObject(diskKey, boxes.LabelBoxes)
+      if labelBoxes is None:
+        labelBoxes = boxes.LabelBoxes(self.GetLabelMapArray(inputLabelMapNode))
+        if self.diskCache:
+          self.diskCache.putObject(diskKey, labelBoxes)
+      entry = (stamp, labelBoxes)
+      self.labelMapBoxes[inputLabelMapNode.GetID()] = entry
+    return entry[1]
+
+  def GetOccupancyPyramid(self, inputLabelMapNode):
+    """Return the min/max occupancy pyramid of the label map
+    (occupancy.OccupancyPyramid). It is only rebuilt when the image data
+    changes, or read from the disk cache.
+    """
+    from CurveTracerLib import diskcache, occupancy
+    imageData = inputLabelMapNode.GetImageData()
+    stamp = (imageData, imageData.GetMTime())
+    entry = self.labelMapPyramids.get(inputLabelMapNode.GetID())
+    if entry is None or entry[0] != stamp:
+      pyramid = None
+      if self.diskCache:
+        diskKey = diskcache.digest('OccupancyPyramid', self.GetLabelMapHash(inputLabelMapNode))
+        pyramid = self.diskCache.getObject(diskKey, occupancy.OccupancyPyramid)
+      if pyramid is None:
+        with self.profiler.timer('OccupancyPyramidBuild'):
+          pyramid = occupancy.OccupancyPyramid(self.GetLabelMapArray(inputLabelMapNode))
+        if self.diskCache:
+          self.diskCache.putObject(diskKey, pyramid)
+      entry = (stamp, pyramid)
+      self.labelMapPyramids[inputLabelMapNode.GetID()] = entry
+    return entry[1]
+
+  def TouchesLabels(self, inputLabelMapNode, points):
+    """Whether the trajectory crosses any labeled voxel. Empty bricks of
+    the occupancy pyramid are skipped and the search stops at the first
+    labeled voxel.
+    points is either a fiducial node or an (N,3) array of RAS coordinates.
+    """
+    with self.profiler.timer('TouchesLabels'):
+      import numpy as np
+      points = self.GetPoints(points)
+      transformNode = inputLabelMapNode.GetParentTransformNode()
+      if transformNode and not transformNode.IsTransformToWorldLinear():
+        if len(points) == 1:
+          return bool(self.GetVoxelValues(inputLabelMapNode, points)[0][0] != 0)
+        return bool(np.any(self.TraceTrajectory(inputLabelMapNode, points)['label'] != 0))
+      return self.GetOccupancyPyramid(inputLabelMapNode).touches(self.GetLabelMapArray(inputLabelMapNode),
+                                                                 self.GetRASToIJKArray(inputLabelMapNode), points)
+
+  def GetMeshHash(self, inputModelNode):
+    """Return the digest of the points and cells of the mesh of a model.
+    It is only recomputed when the mesh changes.
+    """
+    from CurveTracerLib import diskcache
+    poly = inputModelNode.GetPolyData()
+    stamp = (poly, poly.GetMTime())
+    entry = self.meshHashes.get(inputModelNode.GetID())
+    if entry is None or entry[0] != stamp:
+      entry = (stamp, diskcache.meshDigest(poly))
+      self.meshHashes[inputModelNode.GetID()] = entry
+    return entry[1]
+
+  def GetMeshTriangles(self, inputModelNode):
+    """Return the (T,3,3) corners of the triangles of the mesh of a model.
+    They are only recomputed when the mesh changes.
+    """
+    return self.MeshTriangles(inputModelNode.GetID(), inputModelNode.GetPolyData())
 
+  def MeshTriangles(self, key, poly):
+    """Return the (T,3,3) corners of the triangles of the mesh poly, cached
+    under key. Safe to call from worker threads.
+    """
+    from CurveTracerLib import sweep
+    stamp = (poly, poly.GetMTime())
+    entry = self.meshTriangles.get(key)
+    if entry is None or entry[0] != stamp:
+      entry = (stamp, sweep.meshTriangles(poly))
+      self.meshTriangles[key] = entry
+    return entry[1]
+
+  def GetDistanceFields(self, inputLabelMapNode, labels, maxDistance=20.0):
+    """Return the cached distance fields of labels, computed on first use
+    over the bounding box of each label grown by maxDistance mm
+    """
+    from CurveTracerLib import distance
+    labelMap = self.GetLabelMapArray(inputLabelMapNode)
+    spacing = distance.voxelSpacing(self.GetRASToIJKArray(inputLabelMapNode))
+    labelsHash = self.GetLabelMapHash(inputLabelMapNode)
+    labelBoxes = self.GetLabelBoxes(inputLabelMapNode)
+    return [self.distanceCache.getField(labelMap, label, spacing, maxDistance, labelsHash, labelBoxes.box(label))
+            for label in labels]
+
+  def GetClearance(self, inputLabelMapNode, labels, points, maxDistance=20.0):
+    """Smallest distance between the trajectory and each of labels, and the
+    arc length and position where it occurs. Distances beyond maxDistance mm
+    are reported as maxDistance, at the first point; the distance fields
+    of labels whose bounding box is that far from the trajectory are not
+    computed.
+    points is either a fiducial node or an (N,3) array of RAS coordinates.
+    Returns a structured array (CLEARANCE_DTYPE) with one row per label.
+    """
+    with self.profiler.timer('Clearance'):
+      import numpy as np
+      from CurveTracerLib import distance
+      points = self.GetPoints(points)
+      rasToIjk = self.GetRASToIJKArray(inputLabelMapNode)
+      near = self.GetLabelBoxes(inputLabelMapNode).near(rasToIjk, points, maxDistance, labels)
+      clearance = np.zeros(len(labels), dtype=distance.CLEARANCE_DTYPE)
+      clearance['label'] = labels
+      clearance['distance'] = maxDistance
+      if len(points):
+        clearance['point'] = points[0]
+      isNear = np.isin(clearance['label'], near)
+      if np.any(isNear):
+        fields = self.GetDistanceFields(inputLabelMapNode, clearance['label'][isNear], maxDistance)
+        clearance[isNear] = distance.trajectoryClearance(fields, rasToIjk, points)
+      return clearance
+
+  def GetVoxelValues(self, inputLabelMapNode, points):
+    """Look up the label map at a batch of points in one pass.
+    points is either a fiducial node or an (N,3) array of RAS coordinates.
+    Returns (values, inBounds); points outside the volume are not read,
+    their value is 0 and their inBounds flag is False.
+    """
+    with self.profiler.timer('VoxelSampling'):
+      from CurveTracerLib import sampling
+      points = self.GetPoints(points)
+      labels, rasToIjk = self.GetLabelMapROI(inputLabelMapNode, points, narrow=False)
+      return sampling.sampleLabels(labels, rasToIjk, points)
+
+  def GetTargetResults(self, inputLabelMapNode, inputTargetNode):
+    """Voxel lookup for every target fiducial in one call.
+    Returns a structured array (TARGET_DTYPE) with one row per target.
+    Without a label map all targets are reported out of the volume.
+    """
+    with self.profiler.timer('TargetResults'):
+      from CurveTracerLib import sampling
+      names = [inputTargetNode.GetNthFiducialLabel(i) for i in range(inputTargetNode.GetNumberOfFiducials())]
+      points = self.GetFiducialPositions(inputTargetNode)
+      labels = None
+      rasToIjk = None
+      if inputLabelMapNode and inputLabelMapNode.GetImageData():
+        labels, rasToIjk = self.GetLabelMapROI(inputLabelMapNode, points, narrow=False)
+      return sampling.targetResults(labels, rasToIjk, points, names)
+
+  def GetErrorVectors(self, inputFiducialNode, targets, extrapolate=False):
+    """Closest point of the trajectory to every target, computed for all
+    targets in one batched pass. With extrapolate, the first and last
+    segments are extended beyond the end points of the trajectory.
+    inputFiducialNode and targets are fiducial nodes or (N,3) RAS arrays.
+    Returns (distances, feet, segments): the distance of every target to
+    the trajectory, the closest point on it and the index of its segment.
+    """
+    with self.profiler.timer('ErrorVectors'):
+      from CurveTracerLib import geometry
+      return geometry.closestPoints(self.GetPoints(inputFiducialNode), self.GetPoints(targets), extrapolate)
+
+  def TraceTrajectory(self, inputLabelMapNode, points):
+    """List every label crossed along the trajectory.
+    points is either a fiducial node or an (N,3) array of RAS coordinates.
+    Returns a structured array (TRACE_DTYPE) with one row per run of
+    identical labels: label, entry and exit arc length (mm from the first
+    point) and the number of voxels in the run.
+    """
+    with self.profiler.timer('Tracing'):
+      from CurveTracerLib import tracing
+      points = self.GetPoints(points)
+      labels, rasToIjk = self.GetLabelMapROI(inputLabelMapNode, points)
+      return tracing.traceTrajectory(labels, rasToIjk, points)
+
+  def SweptStructures(self, inputLabelMapNode, points, radius, inputModelHierarchyNode=None):
+    """Every label and model within radius mm of the trajectory, as swept by
+    a tool of that radius. Labels are found in the block of the label map
+    around the trajectory, models among those whose bounds grown by radius
+    the trajectory touches.
+    points is either a fiducial node or an (N,3) array of RAS coordinates.
+    Returns (modelNodes, swept): the models of the hierarchy and a
+    structured array (SWEEP_DTYPE) with one row per structure, labels first;
+    the structure of a model row indexes modelNodes.
+    """
+    with self.profiler.timer('SweptStructures'):
+      import numpy as np
+      from CurveTracerLib import distance, sweep
+      points = self.GetPoints(points)
+      swept = [np.zeros(0, dtype=sweep.SWEEP_DTYPE)]
+      if inputLabelMapNode and inputLabelMapNode.GetImageData():
+        reach = distance.voxelReach(self.GetRASToIJKArray(inputLabelMapNode), radius)
+        margin = int(np.ceil(np.max(reach))) + 1
+        labels, rasToIjk = self.GetLabelMapROI(inputLabelMapNode, points, margin)
+        swept.append(sweep.sweptLabels(labels, rasToIjk, points, radius))
+      modelNodes = []
+      if inputModelHierarchyNode:
+        modelNodes = self.GetHierarchyModelNodes(inputModelHierarchyNode)
+        swept.append(sweep.sweptMeshes([mnode.GetPolyData() for mnode in modelNodes], points, radius))
+      return modelNodes, np.concatenate(swept)
+
+  def GetVoxelValue(self, inputLabelMapNode, inputFiducialNode):
+    """
+    Return the label values at the positions of all fiducials
+    """
+    values, inBounds = self.GetVoxelValues(inputLabelMapNode, inputFiducialNode)
+    return values
+
+  def EntryAngle(self, inputChildModelNode, inputFiducialNode, orientation='winding'):
+    """
+    Entry angle in degrees of the line from the first to the last fiducial
+    into the model, 0.0 if the line misses it. The normal is interpolated at
+    the hit point from the cached point normals of the model; orientation
+    selects their convention (see normals.MeshNormals).
+    """
+    with self.profiler.timer('EntryAngle'):
+      if inputChildModelNode == None:
+        return None
+
+      if inputFiducialNode == None:
+        return None
+
+      from CurveTracerLib import intersection
+      points = self.GetFiducialPositions(inputFiducialNode)
+      poly = inputChildModelNode.GetPolyData()
+      key = inputChildModelNode.GetID()
+      locator = self.locatorCache.getLocator(key, poly)
+      return intersection.entryAngle(locator, poly, points[0], points[-1],
+                                     normals=self.locatorCache.getNormals(key, orientation))
+
+  def GetHierarchyModelNodes(self, inputModelHierarchyNode):
+    """Return the model nodes of the hierarchy that have a mesh
+    """
+    modelNodes = []
+    for i in range(inputModelHierarchyNode.GetNumberOfChildrenNodes()):
+      chnode = inputModelHierarchyNode.GetNthChildNode(i)
+      if chnode == None:
+        continue
+      mnode = chnode.GetAssociatedNode()
+      if mnode == None or mnode.GetPolyData() == None:
+        continue
+      modelNodes.append(mnode)
+    return modelNodes
+
+  def GetNearModels(self, modelNodes, points, margin=0.001):
+    """Indices of the model nodes whose bounds, grown by margin mm, are
+    touched by the polyline points
+    """
+    from CurveTracerLib import boxes
+    return boxes.nearMeshes([mnode.GetPolyData() for mnode in modelNodes], points, margin)
+
+  def GetHierarchyLocator(self, inputModelHierarchyNode, modelNodes):
+    """Return (key, hierarchyLocator): the cached merged locator over
+    modelNodes, a subset of the models of the hierarchy, and its key in the
+    locator cache
+    """
+    key = (inputModelHierarchyNode.GetID(),) + tuple(mnode.GetID() for mnode in modelNodes)
+    return key, self.locatorCache.getHierarchyLocator(key, [mnode.GetPolyData() for mnode in modelNodes])
+
+  def ModelProximities(self, inputModelHierarchyNode, inputFiducialNode, maxDistance=20.0):
+    """Closest approach of the trajectory to every model of the hierarchy:
+    the smallest distance between the polyline and the surface (0.0 when it
+    is crossed), its arc length and the closest points on both. Models
+    whose bounds are further than maxDistance mm are not measured and are
+    reported at maxDistance.
+    inputFiducialNode is either a fiducial node or an (N,3) array of RAS
+    coordinates.
+    Returns (modelNodes, proximities): the models of the hierarchy and a
+    structured array (PROXIMITY_DTYPE) with one row per model.
+    """
+    with self.profiler.timer('ModelProximities'):
+      modelNodes, proximities, tasks = self.ModelProximityTasks(inputModelHierarchyNode, inputFiducialNode,
+                                                                maxDistance)
+      for i, task in tasks.items():
+        proximities[i] = task()
+      return modelNodes, proximities
+
+  def ModelProximityTasks(self, inputModelHierarchyNode, inputFiducialNode, maxDistance=20.0):
+    """Split ModelProximities into one task per model, to run in worker
+    threads (see jobs.JobQueue). The MRML nodes are read here, on the
+    calling thread; the tasks only use the meshes and the triangles cache.
+    Returns (modelNodes, proximities, tasks): proximities has the rows of
+    the models further than maxDistance, and tasks maps the index of every
+    other model to a callable returning its row.
+    """
+    import functools
+    from CurveTracerLib import sweep
+    modelNodes = self.GetHierarchyModelNodes(inputModelHierarchyNode)
+    points = self.GetPoints(inputFiducialNode)
+    tasks = {}
+    for i in self.GetNearModels(modelNodes, points, maxDistance):
+      mnode = modelNodes[i]
+      tasks[int(i)] = functools.partial(self.ModelProximity, int(i), mnode.GetID(), mnode.GetPolyData(), points,
+                                        maxDistance)
+    return modelNodes, sweep.farProximities(len(modelNodes), maxDistance), tasks
+
+  def ModelProximity(self, index, key, poly, points, maxDistance=20.0, cancelled=None):
+    """Closest approach of points to the mesh poly of model index, whose
+    triangles are cached under key. Safe to call from worker threads.
+    """
+    with self.profiler.timer('ModelProximity'):
+      from CurveTracerLib import sweep
+      triangles = self.MeshTriangles(key, poly)
+      if cancelled is not None and cancelled.is_set():
+        return None
+      return sweep.meshProximity(index, poly, points, maxDistance, triangles)
+
+  def EntryAngles(self, inputModelHierarchyNode, inputFiducialNode, orientation='winding'):
+    """Entry angle of the trajectory into every model of the hierarchy.
+    Models whose bounds the line misses are skipped; the others are
+    intersected in one query against a merged locator, and the hit closest
+    to the first fiducial is the entry point of each model. Normals are
+    interpolated at the hit points, with the orientation convention of
+    normals.MeshNormals.
+    Returns a list of (modelNode, angle), angle being 0.0 for models
+    that are not hit.
+    """
+    with self.profiler.timer('EntryAngles'):
+      modelNodes = self.GetHierarchyModelNodes(inputModelHierarchyNode)
+      if not modelNodes or inputFiducialNode == None or inputFiducialNode.GetNumberOfFiducials() < 2:
+        return [(mnode, 0.0) for mnode in modelNodes]
+
+      import numpy as np
+      from CurveTracerLib import diskcache, intersection
+      points = self.GetFiducialPositions(inputFiducialNode)
+      if self.diskCache:
+        diskKey = diskcache.digest('EntryAngles', [self.GetMeshHash(mnode) for mnode in modelNodes],
+                                   points[0], points[-1], orientation)
+        cached = self.diskCache.get(diskKey)
+        if cached is not None:
+          return list(zip(modelNodes, cached['angles']))
+
+      angles = np.zeros(len(modelNodes))
+      near = self.GetNearModels(modelNodes, [points[0], points[-1]])
+      if len(near):
+        key, hierarchyLocator = self.GetHierarchyLocator(inputModelHierarchyNode, [modelNodes[i] for i in near])
+        angles[near] = intersection.entryAngles(hierarchyLocator, len(near), points[0], points[-1],
+                                                self.locatorCache.getNormals(key, orientation))
+      if self.diskCache:
+        self.diskCache.put(diskKey, {'angles': angles})
+      return list(zip(modelNodes, angles))
+
+  def EntryAngleTasks(self, inputModelHierarchyNode, inputFiducialNode, orientation='winding'):
+    """Split EntryAngles into one task per model, to run in worker threads
+    (see jobs.JobQueue). The MRML nodes are read here, on the calling
+    thread; the tasks only use the meshes and the locator cache.
+    Returns (modelNodes, tasks): tasks maps the index of every model the
+    line may hit to a callable returning its entry angle. The other models
+    are not hit, their entry angle is 0.0.
+    """
+    import functools
+    modelNodes = self.GetHierarchyModelNodes(inputModelHierarchyNode)
+    tasks = {}
+    if not modelNodes or inputFiducialNode == None or inputFiducialNode.GetNumberOfFiducials() < 2:
+      return modelNodes, tasks
+    points = self.GetFiducialPositions(inputFiducialNode)
+    for i in self.GetNearModels(modelNodes, [points[0], points[-1]]):
+      mnode = modelNodes[i]
+      tasks[int(i)] = functools.partial(self.ModelEntryAngle, mnode.GetID(), mnode.GetPolyData(),
+                                        points[0], points[-1], orientation)
+    return modelNodes, tasks
+
+  def ModelEntryAngle(self, key, poly, pos0, posN, orientation='winding', cancelled=None):
+    """Entry angle of the line from pos0 to posN into the mesh poly, whose
+    locator is cached under key. Safe to call from worker threads.
+    """
+    with self.profiler.timer('ModelEntryAngle'):
+      from CurveTracerLib import intersection
+      locator, normals = self.locatorCache.getLocatorNormals(key, poly, orientation)
+      if cancelled is not None and cancelled.is_set():
+        return None
+      return intersection.entryAngle(locator, poly, pos0, posN, normals=normals)
+
+  def LabelEntryAngles(self, inputLabelMapNode, inputFiducialNode, smoothing=0, decimation=0.0):
+    """Entry angle of the line from the first to the last fiducial into
+    every label it crosses, without models: the surfaces of the crossed
+    labels are extracted from the label map around the crossings (see
+    surfaces.labelSurface) and cached. Angles are measured against the
+    outward normals, like the crossings.
+    Returns a structured array (LABEL_ANGLE_DTYPE) ordered along the line.
+    """
+    with self.profiler.timer('LabelEntryAngles'):
+      angles, tasks = self.LabelEntryAngleTasks(inputLabelMapNode, inputFiducialNode, smoothing, decimation)
+      for i, task in tasks.items():
+        angles['angle'][i] = task()
+      return angles
+
+  def LabelEntryAngleTasks(self, inputLabelMapNode, inputFiducialNode, smoothing=0, decimation=0.0):
+    """Split LabelEntryAngles into one task per crossed label, to run in
+    worker threads (see jobs.JobQueue).
+    Returns (angles, tasks): the crossed labels with angles set to 0.0, and
+    a dictionary mapping each row to a callable returning its angle.
+    """
+    import functools
+    import numpy as np
+    from CurveTracerLib import surfaces
+    if inputFiducialNode == None or inputFiducialNode.GetNumberOfFiducials() < 2:
+      return np.zeros(0, dtype=surfaces.LABEL_ANGLE_DTYPE), {}
+    points = self.GetFiducialPositions(inputFiducialNode)
+    labels = self.GetLabelMapArray(inputLabelMapNode)
+    rasToIjk = self.GetRASToIJKArray(inputLabelMapNode)
+    ijkToRas = np.linalg.inv(rasToIjk)
+    labelsHash = self.GetLabelMapHash(inputLabelMapNode)
+    angles = surfaces.crossingBlocks(labels, rasToIjk, points[0], points[-1])
+    tasks = {}
+    for i, row in enumerate(angles):
+      lower, upper = row['lower'], row['upper']
+      block = labels[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+      tasks[i] = functools.partial(self.LabelEntryAngle, block, int(row['label']), lower, ijkToRas, labelsHash,
+                                   points[0], points[-1], smoothing, decimation)
+    return angles, tasks
+
+  def LabelEntryAngle(self, block, label, lower, ijkToRas, labelsHash, pos0, posN, smoothing=0, decimation=0.0,
+                      cancelled=None):
+    """Entry angle of the line from pos0 to posN into the surface of label
+    in block, a view of the label map starting at voxel lower ([k, j, i]).
+    Safe to call from worker threads.
+    """
+    with self.profiler.timer('LabelEntryAngle'):
+      from CurveTracerLib import intersection
+      key, surface = self.surfaceCache.getSurface(block, label, lower, ijkToRas, smoothing, decimation, labelsHash)
+      if cancelled is not None and cancelled.is_set():
+        return None
+      locator, normals = self.locatorCache.getLocatorNormals(('surface',) + key, surface, 'outward')
+      return intersection.entryAngle(locator, surface, pos0, posN, normals=normals)
+
+  def EvaluateTrajectories(self, inputLabelMapNode, trajectoryNodes, inputModelNode=None):
+    """Structures crossed by every trajectory of trajectoryNodes (fiducial
+    nodes or (N,3) RAS arrays) in one pass. The label map is read once, and
+    a single merged locator with its normals is built over the models (of
+    a model hierarchy, or a single model) that any of the trajectories
+    comes near, so they are shared by all trajectories.
+    The structure of a label run is its label, the structure of a model
+    passage indexes GetHierarchyModelNodes (0 for a single model).
+    Returns a structured array (STRUCTURE_CROSSING_DTYPE) ordered by
+    trajectory and entry.
+    """
+    with self.profiler.timer('Trajectories'):
+      import numpy as np
+      from CurveTracerLib import trajectories
+      trajectoryPoints = [self.GetPoints(node) for node in trajectoryNodes]
+
+      labels = None
+      rasToIjk = None
+      labelRows = []
+      if inputLabelMapNode and inputLabelMapNode.GetImageData():
+        transformNode = inputLabelMapNode.GetParentTransformNode()
+        if not transformNode or transformNode.IsTransformToWorldLinear():
+          labels = self.GetLabelMapArray(inputLabelMapNode)
+          rasToIjk = self.GetRASToIJKArray(inputLabelMapNode)
+        else:
+          # Non-linear transforms resample the label map around each trajectory
+          labelRows = [trajectories.labelRuns(self.TraceTrajectory(inputLabelMapNode, points), index)
+                       for index, points in enumerate(trajectoryPoints)]
+
+      hierarchyLocator = None
+      normals = None
+      near = np.zeros(0, dtype=np.int64)
+      if inputModelNode:
+        modelNodes = [inputModelNode]
+        if inputModelNode.IsA('vtkMRMLModelHierarchyNode'):
+          modelNodes = self.GetHierarchyModelNodes(inputModelNode)
+        for points in trajectoryPoints:
+          near = np.union1d(near, self.GetNearModels(modelNodes, points))
+        if len(near):
+          key, hierarchyLocator = self.GetHierarchyLocator(inputModelNode, [modelNodes[i] for i in near])
+          normals = self.locatorCache.getNormals(key, 'outward')
+
+      rows = trajectories.evaluateTrajectories(labels, rasToIjk, trajectoryPoints, hierarchyLocator, normals)
+      isModel = rows['source'] == 'model'
+      rows['structure'][isModel] = near[rows['structure'][isModel]]
+      if labelRows:
+        rows = trajectories.sortCrossings(np.concatenate([rows] + labelRows))
+      return rows
+
+  def GetFolderTrajectories(self, folderItemID):
+    """Fiducial nodes in a subject hierarchy folder and its sub-folders
+    """
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    children = vtk.vtkIdList()
+    shNode.GetItemChildren(folderItemID, children, True)
+    nodes = [shNode.GetItemDataNode(children.GetId(i)) for i in range(children.GetNumberOfIds())]
+    return [node for node in nodes if node and node.IsA('vtkMRMLMarkupsFiducialNode')]
+
+  def TraceTrajectoryTask(self, inputLabelMapNode, points):
+    """TraceTrajectory as a callable to run in a worker thread. The block
+    of the label map around the trajectory is copied here, so later edits
+    of the label map do not affect the task.
+    """
+    import numpy as np
+    from CurveTracerLib import tracing
+    points = self.GetPoints(points)
+    labels, rasToIjk = self.GetLabelMapROI(inputLabelMapNode, points)
+    labels = np.array(labels)
+    return lambda cancelled: tracing.traceTrajectory(labels, rasToIjk, points)
+
+  def GetTransformToWorld(self, transformNode):
+    """Return the 4x4 matrix from a linear transform node to world (RAS)
+    """
+    from CurveTracerLib import conversion
+    matrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToWorld(matrix)
+    return conversion.arrayFromMatrix(matrix)
+
+  def ToolEvaluator(self, inputLabelMapNode, inputModelHierarchyNode=None, clearanceLabels=(), maxDistance=20.0,
+                    axis=(0.0, 0.0, 1.0), ahead=100.0, behind=0.0, orientation='winding'):
+    """Return (modelNodes, evaluator): a tracking.ToolEvaluator of the
+    structures crossed by the trajectory of a tracked tool, its entry angles
+    into modelNodes (the models of the hierarchy) and its clearance from
+    clearanceLabels. The label map, merged locator, normals and distance
+    fields are read and built here, on the calling thread, so
+    evaluator.evaluate can run in a worker thread at every pose (see
+    tracking.PoseStream). Later edits of the nodes are not seen by the
+    evaluator, and a non-linear parent transform of the label map is
+    ignored.
+    """
+    from CurveTracerLib import tracking
+    labels = None
+    rasToIjk = None
+    fields = []
+    if inputLabelMapNode and inputLabelMapNode.GetImageData():
+      labels = self.GetLabelMapArray(inputLabelMapNode)
+      rasToIjk = self.GetRASToIJKArray(inputLabelMapNode)
+      if len(clearanceLabels):
+        fields = self.GetDistanceFields(inputLabelMapNode, clearanceLabels, maxDistance)
+
+    modelNodes = []
+    hierarchyLocator = None
+    normals = None
+    if inputModelHierarchyNode:
+      modelNodes = self.GetHierarchyModelNodes(inputModelHierarchyNode)
+      if modelNodes:
+        key, hierarchyLocator = self.GetHierarchyLocator(inputModelHierarchyNode, modelNodes)
+        normals = self.locatorCache.getNormals(key, orientation)
+    return modelNodes, tracking.ToolEvaluator(labels, rasToIjk, hierarchyLocator, len(modelNodes), normals,
+                                              fields, axis, ahead, behind)
+
+  def GetCrossings(self, inputModelNode, inputFiducialNode):
+    """Every entry and exit of the curve through a model, or through all the
+    models of a model hierarchy. The 'model' field indexes the list returned
+    by GetHierarchyModelNodes (0 for a single model). Locators are only
+    built over the models whose bounds the curve touches. Crossing angles
+    and entries use outward normals interpolated at the crossing points.
+    Returns a structured array (CROSSING_DTYPE) sorted by arc length.
+    """
+    with self.profiler.timer('Crossings'):
+      import numpy as np
+      from CurveTracerLib import intersection
+      points = self.GetFiducialPositions(inputFiducialNode)
+      key = inputModelNode.GetID()
+      if inputModelNode.IsA('vtkMRMLModelHierarchyNode'):
+        modelNodes = self.GetHierarchyModelNodes(inputModelNode)
+        near = self.GetNearModels(modelNodes, points)
+        if not len(near):
+          return np.zeros(0, dtype=intersection.CROSSING_DTYPE)
+        key, hierarchyLocator = self.GetHierarchyLocator(inputModelNode, [modelNodes[i] for i in near])
+        crossings = intersection.intersectTrajectory(hierarchyLocator.locator, hierarchyLocator.polyData, points,
+                                                     segmentCache=self.locatorCache.segmentCache(key),
+                                                     normals=self.locatorCache.getNormals(key, 'outward'),
+                                                     cellToModel=hierarchyLocator.cellToModel)
+        crossings['model'] = near[crossings['model']]
+        return crossings
+      if not len(self.GetNearModels([inputModelNode], points)):
+        return np.zeros(0, dtype=intersection.CROSSING_DTYPE)
+      poly = inputModelNode.GetPolyData()
+      locator = self.locatorCache.getLocator(key, poly)
+      return intersection.intersectTrajectory(locator, poly, points, segmentCache=self.locatorCache.segmentCache(key),
+                                              normals=self.locatorCache.getNormals(key, 'outward'))
+
+  def EvaluateEntryPoints(self, inputLabelMapNode, inputSkinModelNode, target, criticalLabels, count=10,
+                          maxDistance=20.0):
+    """Evaluate the straight trajectories from every vertex of the skin
+    model to the target, a fiducial node (its first fiducial) or a RAS point.
+    The entry angle, the number of critical labels crossed and the
+    clearance (up to maxDistance mm) of every candidate are stored in the
+    'EntryAngle', 'CriticalLabels' and 'Clearance' point arrays of the skin
+    model, which is colored by clearance.
+    Returns the count best candidates (CANDIDATE_DTYPE), see
+    planning.rankCandidates.
+    """
+    with self.profiler.timer('EntryPlanning'):
+      from CurveTracerLib import conversion, planning
+      poly = inputSkinModelNode.GetPolyData()
+      # The skin surrounds the whole volume, so there is nothing to crop; the
+      # distance fields are indexed in the voxels of the whole label map
+      candidates = planning.evaluateCandidates(self.GetLabelMapArray(inputLabelMapNode),
+                                               self.GetRASToIJKArray(inputLabelMapNode),
+                                               conversion.arrayFromPoints(poly.GetPoints()), planning.pointNormals(poly),
+                                               self.GetPoints(target)[0], criticalLabels,
+                                               self.GetDistanceFields(inputLabelMapNode, criticalLabels, maxDistance),
+                                               maxDistance)
+
+      pointData = poly.GetPointData()
+      pointData.AddArray(conversion.dataArrayFromArray(candidates['angle'], 'EntryAngle'))
+      pointData.AddArray(conversion.dataArrayFromArray(candidates['critical'], 'CriticalLabels'))
+      pointData.AddArray(conversion.dataArrayFromArray(candidates['clearance'], 'Clearance'))
+      poly.Modified()
+      displayNode = inputSkinModelNode.GetDisplayNode()
+      if displayNode:
+        displayNode.SetActiveScalarName('Clearance')
+        displayNode.SetScalarVisibility(True)
+
+      return planning.rankCandidates(candidates, count)
 
-  
 
 class CurveTracerTest(ScriptedLoadableModuleTest):
   """
@@ -397,6 +1973,55 @@ class CurveTracerTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_CurveTracer1()
+    self.setUp()
+    self.test_CurveTracerVoxelValues()
+    self.setUp()
+    self.test_CurveTracerTrace()
+    self.setUp()
+    self.test_CurveTracerPlanning()
+    self.setUp()
+    self.test_CurveTracerClearance()
+    self.setUp()
+    self.test_CurveTracerErrorVectors()
+    self.setUp()
+    self.test_CurveTracerTransformedLabelMap()
+    self.setUp()
+    self.test_CurveTracerEntryAngle()
+    self.setUp()
+    self.test_CurveTracerProfiling()
+    self.setUp()
+    self.test_CurveTracerJobs()
+    self.setUp()
+    self.test_CurveTracerLabelEntryAngles()
+    self.setUp()
+    self.test_CurveTracerTrajectories()
+    self.setUp()
+    self.test_CurveTracerDiskCache()
+    self.setUp()
+    self.test_CurveTracerOccupancy()
+    self.setUp()
+    self.test_CurveTracerTracking()
+    self.setUp()
+    self.test_CurveTracerSweep()
+    self.setUp()
+    self.test_CurveTracerProximity()
+    self.setUp()
+    self.test_CurveTracerBatchResume()
+
+  def createSyntheticLabelMap(self):
+    """Create a 20x10x10 label map with 1 mm voxels: label 1 for i < 10, label 2 otherwise
+    """
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(20, 10, 10)
+    imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    from vtk.util import numpy_support
+    labels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(10, 10, 20)
+    labels[:, :, :10] = 1
+    labels[:, :, 10:] = 2
+    labelMapNode = slicer.vtkMRMLLabelMapVolumeNode()
+    labelMapNode.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(labelMapNode)
+    return labelMapNode
 
   def test_CurveTracer1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -433,3 +2058,658 @@ class CurveTracerTest(ScriptedLoadableModuleTest):
     logic = CurveTracerLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_CurveTracerVoxelValues(self):
+    """ Batched voxel lookup, including points outside of the volume.
+    """
+
+    self.delayDisplay("Starting the voxel lookup test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    points = [[5.0, 5.0, 5.0], [15.0, 5.0, 5.0], [100.0, 0.0, 0.0]]
+    values, inBounds = logic.GetVoxelValues(labelMapNode, points)
+    self.assertEqual(list(inBounds), [True, True, False])
+    self.assertEqual(list(values), [1, 2, 0])
+
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(fiducialNode)
+    fiducialNode.AddFiducial(15.0, 2.0, 3.0)
+    fiducialNode.AddFiducial(2.0, 2.0, 3.0)
+    self.assertEqual(list(logic.GetVoxelValue(labelMapNode, fiducialNode)), [2, 1])
+
+    fiducialNode.AddFiducial(-50.0, 2.0, 3.0)
+    results = logic.GetTargetResults(labelMapNode, fiducialNode)
+    self.assertEqual(list(results['value']), [2, 1, 0])
+    self.assertEqual(list(results['inBounds']), [True, True, False])
+    self.assertEqual(list(results['inside']), [True, True, False])
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerTrace(self):
+    """ Voxel traversal of a polyline that crosses two labels and leaves the volume.
+    """
+
+    self.delayDisplay("Starting the tracing test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    trace = logic.TraceTrajectory(labelMapNode, [[2.0, 5.0, 5.0], [12.0, 5.0, 5.0], [17.0, 5.0, 5.0], [30.0, 5.0, 5.0]])
+    self.assertEqual(list(trace['label']), [1, 2])
+    self.assertEqual(list(trace['voxels']), [8, 10])
+    self.assertAlmostEqual(trace['entry'][1], 7.5)
+    self.assertAlmostEqual(trace['exit'][1], 17.5)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerPlanning(self):
+    """ Entry points over a sphere around a target in label 1, with label 2 critical.
+    """
+
+    self.delayDisplay("Starting the entry planning test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(10.0, 5.0, 5.0)
+    sphere.SetRadius(4.0)
+    sphere.Update()
+    skinModelNode = slicer.vtkMRMLModelNode()
+    skinModelNode.SetAndObservePolyData(sphere.GetOutput())
+    slicer.mrmlScene.AddNode(skinModelNode)
+
+    candidates = logic.EvaluateEntryPoints(labelMapNode, skinModelNode, [8.0, 5.0, 5.0], [2], count=5)
+    self.assertEqual(len(candidates), 5)
+    self.assertTrue(all(candidates['critical'] == 0))
+    self.assertTrue(all(candidates['entry'][:, 0] < 10.0))
+
+    critical = skinModelNode.GetPolyData().GetPointData().GetArray('CriticalLabels')
+    self.assertEqual(critical.GetNumberOfTuples(), sphere.GetOutput().GetNumberOfPoints())
+    self.assertEqual(max(critical.GetRange()), 1)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerClearance(self):
+    """ Distance from a trajectory in label 1 to label 2, served from the cache the second time.
+    """
+
+    self.delayDisplay("Starting the clearance test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    points = [[2.0, 5.0, 5.0], [6.0, 5.0, 5.0], [6.0, 2.0, 5.0]]
+    clearance = logic.GetClearance(labelMapNode, [2], points)
+    self.assertEqual(list(clearance['label']), [2])
+    self.assertAlmostEqual(clearance['distance'][0], 4.0, places=5)
+    # Samples are looked up in the nearest voxel
+    self.assertLessEqual(abs(clearance['arcLength'][0] - 4.0), 0.5)
+
+    logic.GetClearance(labelMapNode, [2], points)
+    self.assertEqual(logic.distanceCache.statistics()['hits'], 1)
+
+    # Labels far from the trajectory, or absent, get no distance field
+    clearance = logic.GetClearance(labelMapNode, [2, 3], points, maxDistance=3.0)
+    self.assertEqual(list(clearance['distance']), [3.0, 3.0])
+    self.assertEqual(logic.distanceCache.statistics()['misses'], 1)
+
+    # The box index of labels far apart does not grow with their span
+    import numpy as np
+    from CurveTracerLib import boxes
+    labels = np.zeros((4, 5, 6), dtype=np.int32)
+    labels[1:3, 2, 4:6] = 2 ** 31 - 1
+    labels[0, 0, 0] = -2 ** 31
+    labelBoxes = boxes.LabelBoxes(labels)
+    self.assertEqual(list(labelBoxes.labels), [-2 ** 31, 0, 2 ** 31 - 1])
+    lower, upper = labelBoxes.box(2 ** 31 - 1)
+    self.assertEqual(list(lower), [1, 2, 4])
+    self.assertEqual(list(upper), [3, 3, 6])
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerErrorVectors(self):
+    """ Closest points on a bent trajectory, with and without extrapolation.
+    """
+
+    self.delayDisplay("Starting the error vector test")
+    logic = CurveTracerLogic()
+
+    trajectory = [[0.0, 0.0, 0.0], [10.0, 0.0, 0.0], [10.0, 10.0, 0.0]]
+    targets = [[5.0, 3.0, 0.0], [12.0, 5.0, 0.0], [-4.0, 0.0, 3.0]]
+    distances, feet, segments = logic.GetErrorVectors(trajectory, targets)
+    self.assertEqual(list(distances), [3.0, 2.0, 5.0])
+    self.assertEqual(list(segments), [0, 1, 0])
+    self.assertEqual(list(feet[1]), [10.0, 5.0, 0.0])
+
+    distances, feet, segments = logic.GetErrorVectors(trajectory, targets, extrapolate=True)
+    self.assertEqual(distances[2], 3.0)
+    self.assertEqual(list(feet[2]), [-4.0, 0.0, 0.0])
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerTransformedLabelMap(self):
+    """ Lookups and tracing in a label map under a linear transform, on a cropped block.
+    """
+
+    self.delayDisplay("Starting the transformed label map test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    matrix = vtk.vtkMatrix4x4()
+    matrix.SetElement(0, 3, 100.0)
+    transformNode.SetMatrixTransformToParent(matrix)
+    labelMapNode.SetAndObserveTransformNodeID(transformNode.GetID())
+
+    values, inBounds = logic.GetVoxelValues(labelMapNode, [[105.0, 5.0, 5.0], [115.0, 5.0, 5.0], [5.0, 5.0, 5.0]])
+    self.assertEqual(list(values), [1, 2, 0])
+    self.assertEqual(list(inBounds), [True, True, False])
+
+    labels, rasToIjk = logic.GetLabelMapROI(labelMapNode, [[102.0, 5.0, 5.0], [104.0, 5.0, 5.0]])
+    self.assertEqual(labels.shape, (3, 3, 5))
+
+    trace = logic.TraceTrajectory(labelMapNode, [[102.0, 5.0, 5.0], [112.0, 5.0, 5.0], [117.0, 5.0, 5.0], [130.0, 5.0, 5.0]])
+    self.assertEqual(list(trace['label']), [1, 2])
+    self.assertEqual(list(trace['voxels']), [8, 10])
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerEntryAngle(self):
+    """ Interpolated normals give the exact angle of a radial line on a coarse sphere.
+    """
+
+    self.delayDisplay("Starting the entry angle test")
+    logic = CurveTracerLogic()
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10.0)
+    sphere.Update()
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetAndObservePolyData(sphere.GetOutput())
+    slicer.mrmlScene.AddNode(modelNode)
+
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(fiducialNode)
+    fiducialNode.AddFiducial(0.0, 0.0, 0.0)
+    fiducialNode.AddFiducial(20.0, 0.0, 0.0)
+    self.assertAlmostEqual(logic.EntryAngle(modelNode, fiducialNode), 0.0, delta=0.1)
+    self.assertAlmostEqual(logic.EntryAngle(modelNode, fiducialNode, 'inward'), 180.0, delta=0.1)
+
+    # The line leaves through an edge, which both of its cells report once
+    crossings = logic.GetCrossings(modelNode, fiducialNode)
+    self.assertEqual(len(crossings), 1)
+    self.assertFalse(any(crossings['entering']))
+    self.assertTrue(all(crossings['angle'] < 0.1))
+
+    # A line that enters a cube through one face and leaves through another
+    # gets the angle of the entry, whether computed directly or in a task
+    import math
+    cube = vtk.vtkCubeSource()
+    cube.SetXLength(2.0)
+    cube.SetYLength(2.0)
+    cube.SetZLength(2.0)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(cube.GetOutputPort())
+    triangles.Update()
+    cubeNode = slicer.vtkMRMLModelNode()
+    cubeNode.SetAndObservePolyData(triangles.GetOutput())
+    slicer.mrmlScene.AddNode(cubeNode)
+    hierarchyNode = slicer.vtkMRMLModelHierarchyNode()
+    slicer.mrmlScene.AddNode(hierarchyNode)
+    childNode = slicer.vtkMRMLModelHierarchyNode()
+    childNode.SetParentNodeID(hierarchyNode.GetID())
+    childNode.SetAssociatedNodeID(cubeNode.GetID())
+    slicer.mrmlScene.AddNode(childNode)
+    fiducialNode.SetNthFiducialPosition(0, -3.0, -4.5, 0.0)
+    fiducialNode.SetNthFiducialPosition(1, 1.75, 5.0, 0.0)
+
+    entry = math.degrees(math.acos(-1.0 / math.sqrt(5.0)))
+    self.assertAlmostEqual(logic.EntryAngle(cubeNode, fiducialNode), entry, delta=0.1)
+    modelNodes, tasks = logic.EntryAngleTasks(hierarchyNode, fiducialNode)
+    self.assertAlmostEqual(tasks[0](), entry, delta=0.1)
+    self.assertAlmostEqual(logic.EntryAngles(hierarchyNode, fiducialNode)[0][1], entry, delta=0.1)
+
+    # Lines through the diagonal edges at the centers of two faces, and
+    # through two opposite corners, cross the cube once on each side
+    for p0, p1, arcLengths in [((-3.0, 0.0, 0.0), (3.0, 0.0, 0.0), [2.0, 4.0]),
+                               ((-2.0, -2.0, -2.0), (2.0, 2.0, 2.0), [math.sqrt(3.0), 3.0 * math.sqrt(3.0)])]:
+      fiducialNode.SetNthFiducialPosition(0, *p0)
+      fiducialNode.SetNthFiducialPosition(1, *p1)
+      for crossings in [logic.GetCrossings(cubeNode, fiducialNode), logic.GetCrossings(hierarchyNode, fiducialNode)]:
+        self.assertEqual(len(crossings), 2)
+        self.assertEqual(list(crossings['entering']), [True, False])
+        for arcLength, expected in zip(crossings['arcLength'], arcLengths):
+          self.assertAlmostEqual(arcLength, expected, delta=0.01)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerProfiling(self):
+    """ Stages are only timed while the profiler is enabled.
+    """
+
+    self.delayDisplay("Starting the profiling test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+    points = [[2.0, 5.0, 5.0], [17.0, 5.0, 5.0]]
+
+    enabled = logic.profiler.enabled
+    logic.profiler.clear()
+    try:
+      logic.profiler.enabled = False
+      logic.TraceTrajectory(labelMapNode, points)
+      self.assertEqual(logic.profiler.summary(), {})
+
+      logic.profiler.enabled = True
+      logic.TraceTrajectory(labelMapNode, points)
+      logic.TraceTrajectory(labelMapNode, points)
+      self.assertEqual(logic.profiler.summary()['Tracing']['calls'], 2)
+      self.assertEqual(sum(logic.profiler.histogram('Tracing')), 2)
+      self.assertEqual(len(logic.profiler.trace()['traceEvents']), len(logic.profiler.events))
+    finally:
+      logic.profiler.enabled = enabled
+      logic.profiler.clear()
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerJobs(self):
+    """ Entry angles computed in worker threads match EntryAngles, and a new
+    batch drops the results of the cancelled one.
+    """
+
+    self.delayDisplay("Starting the background jobs test")
+    import time
+    from CurveTracerLib import jobs
+    logic = CurveTracerLogic()
+
+    hierarchyNode = slicer.vtkMRMLModelHierarchyNode()
+    slicer.mrmlScene.AddNode(hierarchyNode)
+    for x in [0.0, 30.0, 60.0]:
+      sphere = vtk.vtkSphereSource()
+      sphere.SetCenter(x, 0.0, 0.0)
+      sphere.SetRadius(5.0)
+      sphere.Update()
+      modelNode = slicer.vtkMRMLModelNode()
+      modelNode.SetAndObservePolyData(sphere.GetOutput())
+      slicer.mrmlScene.AddNode(modelNode)
+      childNode = slicer.vtkMRMLModelHierarchyNode()
+      childNode.SetParentNodeID(hierarchyNode.GetID())
+      childNode.SetAssociatedNodeID(modelNode.GetID())
+      slicer.mrmlScene.AddNode(childNode)
+
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(fiducialNode)
+    fiducialNode.AddFiducial(-10.0, 0.0, 100.0)
+    fiducialNode.AddFiducial(40.0, 1.0, 1.0)
+
+    jobQueue = jobs.JobQueue()
+    modelNodes, tasks = logic.EntryAngleTasks(hierarchyNode, fiducialNode)
+    jobQueue.submit(tasks)
+    fiducialNode.SetNthFiducialPosition(0, -10.0, 0.0, 0.0)
+    modelNodes, tasks = logic.EntryAngleTasks(hierarchyNode, fiducialNode)
+    self.assertEqual(sorted(tasks), [0, 1])
+    jobQueue.submit(tasks)
+
+    angles = {}
+    while jobQueue.busy():
+      for i, angle, error in jobQueue.poll():
+        self.assertIsNone(error)
+        angles[i] = angle
+      time.sleep(0.01)
+
+    # Results of a cancelled batch are dropped, even from running tasks
+    jobQueue.submit(tasks)
+    jobQueue.cancel()
+    time.sleep(0.1)
+    self.assertEqual(jobQueue.poll(), [])
+    self.assertFalse(jobQueue.busy())
+    jobQueue.shutdown()
+
+    expected = logic.EntryAngles(hierarchyNode, fiducialNode)
+    for i, (modelNode, angle) in enumerate(expected):
+      self.assertAlmostEqual(angles.get(i, 0.0), angle)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerLabelEntryAngles(self):
+    """ Entry angles on surfaces extracted from the label map, which are
+    only extracted once.
+    """
+
+    self.delayDisplay("Starting the label map surfaces test")
+    import math
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(fiducialNode)
+    fiducialNode.AddFiducial(2.0, 5.0, 5.0)
+    fiducialNode.AddFiducial(17.0, 4.0, 5.0)
+
+    # The line starts inside label 1, leaves it and enters label 2 at i = 9.5
+    tilt = math.degrees(math.atan2(1.0, 15.0))
+    angles = logic.LabelEntryAngles(labelMapNode, fiducialNode)
+    self.assertEqual(list(angles['label']), [1, 2])
+    self.assertAlmostEqual(angles['angle'][0], tilt, delta=0.01)
+    self.assertAlmostEqual(angles['angle'][1], 180.0 - tilt, delta=0.01)
+    self.assertEqual(logic.surfaceCache.statistics()['misses'], 2)
+
+    logic.LabelEntryAngles(labelMapNode, fiducialNode)
+    self.assertEqual(logic.surfaceCache.statistics()['hits'], 2)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerTrajectories(self):
+    """ Several trajectories evaluated in one pass share one locator.
+    """
+
+    self.delayDisplay("Starting the multiple trajectories test")
+    import math
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(60.0, 0.0, 0.0)
+    sphere.SetRadius(5.0)
+    sphere.Update()
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetAndObservePolyData(sphere.GetOutput())
+    slicer.mrmlScene.AddNode(modelNode)
+    hierarchyNode = slicer.vtkMRMLModelHierarchyNode()
+    slicer.mrmlScene.AddNode(hierarchyNode)
+    childNode = slicer.vtkMRMLModelHierarchyNode()
+    childNode.SetParentNodeID(hierarchyNode.GetID())
+    childNode.SetAssociatedNodeID(modelNode.GetID())
+    slicer.mrmlScene.AddNode(childNode)
+
+    trajectories = [[[2.0, 5.0, 5.0], [17.0, 5.0, 5.0]],
+                    [[12.0, 5.0, 5.0], [50.0, 0.0, 0.0], [70.0, 0.0, 0.0]]]
+    rows = logic.EvaluateTrajectories(labelMapNode, trajectories, hierarchyNode)
+    self.assertEqual(list(rows['trajectory']), [0, 0, 1, 1])
+    self.assertEqual(list(rows['source']), ['label', 'label', 'label', 'model'])
+    self.assertEqual(list(rows['structure']), [1, 2, 2, 0])
+    # The second segment enters the coarse sphere within 0.2 mm of the ideal sphere
+    self.assertAlmostEqual(rows['entry'][3], math.sqrt(38.0 ** 2 + 50.0) + 5.0, delta=0.2)
+    self.assertAlmostEqual(rows['exit'][3] - rows['entry'][3], 10.0, delta=0.4)
+    self.assertEqual(logic.locatorCache.statistics()['misses'], 1)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerDiskCache(self):
+    """ A new logic reads the distance fields and label boxes of the same
+    label map back from the disk cache.
+    """
+
+    self.delayDisplay("Starting the disk cache test")
+    import shutil
+    labelMapNode = self.createSyntheticLabelMap()
+    directory = os.path.join(slicer.app.temporaryPath, 'CurveTracerTestCache')
+    shutil.rmtree(directory, ignore_errors=True)
+    points = [[2.0, 5.0, 5.0], [17.0, 5.0, 5.0]]
+
+    logic = CurveTracerLogic()
+    logic.SetDiskCacheDirectory(directory)
+    clearance = logic.GetClearance(labelMapNode, [1, 2], points)
+    self.assertEqual(logic.diskCache.statistics()['entries'], 3)
+    logic.SetDiskCacheDirectory(None)
+
+    logic = CurveTracerLogic()
+    logic.SetDiskCacheDirectory(directory)
+    self.assertEqual(list(logic.GetClearance(labelMapNode, [1, 2], points)['distance']), list(clearance['distance']))
+    self.assertEqual(logic.diskCache.hits, 3)
+    self.assertEqual(logic.distanceCache.buildTime, 0.0)
+
+    logic.diskCache.clear()
+    self.assertEqual(logic.diskCache.statistics()['entries'], 0)
+    logic.SetDiskCacheDirectory(None)
+    shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerOccupancy(self):
+    """ The block around a trajectory is narrowed from the value range of
+    the bricks of the occupancy pyramid and gives the same runs as the
+    whole label map, and segments in empty space touch no label.
+    """
+
+    self.delayDisplay("Starting the occupancy pyramid test")
+    import numpy as np
+    from CurveTracerLib import tracing
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+    labels = logic.GetLabelMapArray(labelMapNode)
+    labels[:, :, 8:] = 0
+    labelMapNode.GetImageData().Modified()
+
+    # Voxel lookups read the label map in place, without the pyramid
+    values, inBounds = logic.GetVoxelValues(labelMapNode, [[2.0, 5.0, 5.0], [12.0, 5.0, 5.0]])
+    self.assertEqual(list(values), [1, 0])
+    self.assertEqual(len(logic.labelMapPyramids), 0)
+
+    pyramid = logic.GetOccupancyPyramid(labelMapNode)
+    self.assertEqual(pyramid.level(0).shape, (2, 2, 3))
+    self.assertFalse(pyramid.level(0)[:, :, 1:].any())
+    self.assertTrue(pyramid.level(len(pyramid.levelShapes) - 1).all())
+
+    self.assertFalse(logic.TouchesLabels(labelMapNode, [[12.0, 5.0, 5.0], [19.0, 5.0, 5.0]]))
+    self.assertTrue(logic.TouchesLabels(labelMapNode, [[19.0, 5.0, 5.0], [2.0, 5.0, 5.0]]))
+    self.assertTrue(logic.TouchesLabels(labelMapNode, [[2.0, 5.0, 5.0]]))
+    self.assertFalse(logic.TouchesLabels(labelMapNode, [[12.0, 5.0, 5.0]]))
+
+    points = [[2.0, 5.0, 5.0], [17.0, 3.0, 5.0], [17.0, 8.0, 8.0]]
+    block, blockRasToIjk = logic.GetLabelMapROI(labelMapNode, points)
+    self.assertEqual(block.dtype, np.uint8)
+    trace = logic.TraceTrajectory(labelMapNode, points)
+    self.assertEqual(list(trace['label']), [1, 0])
+    self.assertEqual(trace['voxels'][0], 7)
+    self.assertEqual(trace.tolist(), tracing.traceTrajectory(labels, logic.GetRASToIJKArray(labelMapNode), points).tolist())
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerTracking(self):
+    """ A pose streamed from a transform node is evaluated like the same
+    static trajectory, a pose replaced while the worker is busy is dropped,
+    and a spent budget skips the entry angles and clearance.
+    """
+
+    self.delayDisplay("Starting the tool tracking test")
+    import threading
+    from CurveTracerLib import conversion, synthetic, tracking
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+    poses = synthetic.toolPoses(10, [0.0, 5.0, 5.0], [19.0, 5.0, 5.0], jitter=0.0)
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    transformNode.SetMatrixTransformToParent(conversion.matrixFromArray(poses[2]))
+
+    modelNodes, evaluator = logic.ToolEvaluator(labelMapNode, clearanceLabels=[2], ahead=10.0)
+    stream = tracking.PoseStream(evaluator.evaluate, budget=1.0)
+    try:
+      frame = stream.push(logic.GetTransformToWorld(transformNode))
+      self.assertTrue(stream.wait(frame))
+      frame, (values, error) = stream.ring.latest()
+      self.assertIsNone(error)
+      self.assertTrue(frame['complete'])
+      points, trace, angles, clearance = values
+      self.assertEqual(trace.tolist(), logic.TraceTrajectory(labelMapNode, points).tolist())
+      self.assertEqual(list(clearance['distance']), list(logic.GetClearance(labelMapNode, [2], points)['distance']))
+    finally:
+      stream.stop()
+
+    started = threading.Event()
+    release = threading.Event()
+    def slowEvaluate(pose, deadline):
+      started.set()
+      release.wait(5.0)
+      return evaluator.evaluate(pose, deadline)
+    stream = tracking.PoseStream(slowEvaluate, budget=1.0)
+    try:
+      stream.push(poses[0])
+      started.wait(5.0)
+      stream.push(poses[1])
+      frame = stream.push(poses[2])
+      release.set()
+      self.assertTrue(stream.wait(frame))
+      frames = stream.ring.recent()[0]
+      self.assertEqual(list(frames['frame']), [1, 3])
+      self.assertEqual(list(frames['dropped']), [0, 1])
+      self.assertEqual(stream.ring.statistics()['dropped'], 1)
+    finally:
+      stream.stop()
+
+    (points, trace, angles, clearance), complete = evaluator.evaluate(poses[0], deadline=0.0)
+    self.assertFalse(complete)
+    self.assertIsNotNone(trace)
+    self.assertIsNone(clearance)
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerSweep(self):
+    """ A tool with a radius reaches a label and a model that its centerline
+    misses, and how far it reaches into them.
+    """
+
+    self.delayDisplay("Starting the swept tool test")
+    labelMapNode = self.createSyntheticLabelMap()
+    logic = CurveTracerLogic()
+    labels = logic.GetLabelMapArray(labelMapNode)
+    labels[:] = 0
+    labels[5, 5:7, :] = 3
+    labelMapNode.GetImageData().Modified()
+
+    hierarchyNode = slicer.vtkMRMLModelHierarchyNode()
+    slicer.mrmlScene.AddNode(hierarchyNode)
+    for y in [10.5, 30.0]:
+      cube = vtk.vtkCubeSource()
+      cube.SetCenter(10.0, y, 5.0)
+      triangles = vtk.vtkTriangleFilter()
+      triangles.SetInputConnection(cube.GetOutputPort())
+      triangles.Update()
+      modelNode = slicer.vtkMRMLModelNode()
+      modelNode.SetAndObservePolyData(triangles.GetOutput())
+      slicer.mrmlScene.AddNode(modelNode)
+      childNode = slicer.vtkMRMLModelHierarchyNode()
+      childNode.SetParentNodeID(hierarchyNode.GetID())
+      childNode.SetAssociatedNodeID(modelNode.GetID())
+      slicer.mrmlScene.AddNode(childNode)
+
+    # The centerline passes 2 mm from label 3 and from the first cube
+    points = [[0.0, 8.0, 5.0], [19.0, 8.0, 5.0]]
+    self.assertEqual(list(logic.TraceTrajectory(labelMapNode, points)['label']), [0])
+    modelNodes, swept = logic.SweptStructures(labelMapNode, points, 2.5, hierarchyNode)
+    self.assertEqual(len(modelNodes), 2)
+    self.assertEqual(list(swept['source']), ['label', 'model'])
+    self.assertEqual(list(swept['structure']), [3, 0])
+    self.assertEqual(swept['voxels'][0], 20)
+    for row in swept:
+      self.assertAlmostEqual(row['distance'], 2.0)
+      self.assertAlmostEqual(row['penetration'], 0.5)
+    self.assertAlmostEqual(swept['arcLength'][1], 9.5)
+
+    modelNodes, swept = logic.SweptStructures(labelMapNode, points, 1.5, hierarchyNode)
+    self.assertEqual(len(swept), 0)
+
+    # On a sheared grid the tool reaches further along i than 1 / spacing
+    import numpy as np
+    from CurveTracerLib import conversion, geometry
+    labels[:] = np.arange(1, labels.size + 1).reshape(labels.shape)
+    labelMapNode.GetImageData().Modified()
+    shear = np.eye(4)
+    shear[0, 1] = 2.0
+    shear[1, 2] = -1.5
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    transformNode.SetMatrixTransformToParent(conversion.matrixFromArray(shear))
+    labelMapNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    points = [[0.0, 0.0, 5.0], [30.0, 0.0, 5.0]]
+    k, j, i = np.indices(labels.shape)
+    centers = geometry.transformPoints(np.linalg.inv(logic.GetRASToIJKArray(labelMapNode)),
+                                       np.stack([i.ravel(), j.ravel(), k.ravel()], axis=1))
+    expected = labels.ravel()[geometry.closestPoints(np.array(points), centers)[0] <= 3.0]
+    self.assertTrue(len(expected) > 0)
+    modelNodes, swept = logic.SweptStructures(labelMapNode, points, 3.0)
+    self.assertEqual(sorted(swept['structure']), sorted(expected))
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerProximity(self):
+    """ The distance from the trajectory to every model of a hierarchy, with
+    the closest points on both, and models beyond the search radius.
+    """
+
+    self.delayDisplay("Starting the model proximity test")
+    import time
+    from CurveTracerLib import jobs
+    logic = CurveTracerLogic()
+    hierarchyNode = slicer.vtkMRMLModelHierarchyNode()
+    slicer.mrmlScene.AddNode(hierarchyNode)
+    for center in [(0.0, 0.0, 0.0), (15.0, 4.0, 0.0), (30.0, 40.0, 0.0)]:
+      cube = vtk.vtkCubeSource()
+      cube.SetCenter(*center)
+      cube.SetXLength(2.0)
+      cube.SetYLength(2.0)
+      cube.SetZLength(2.0)
+      triangles = vtk.vtkTriangleFilter()
+      triangles.SetInputConnection(cube.GetOutputPort())
+      triangles.Update()
+      modelNode = slicer.vtkMRMLModelNode()
+      modelNode.SetAndObservePolyData(triangles.GetOutput())
+      slicer.mrmlScene.AddNode(modelNode)
+      childNode = slicer.vtkMRMLModelHierarchyNode()
+      childNode.SetParentNodeID(hierarchyNode.GetID())
+      childNode.SetAssociatedNodeID(modelNode.GetID())
+      slicer.mrmlScene.AddNode(childNode)
+
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(fiducialNode)
+    fiducialNode.AddFiducial(-10.0, 4.0, 0.0)
+    fiducialNode.AddFiducial(40.0, 4.0, 0.0)
+
+    modelNodes, proximities = logic.ModelProximities(hierarchyNode, fiducialNode, maxDistance=20.0)
+    self.assertEqual(len(proximities), 3)
+    self.assertAlmostEqual(proximities['distance'][0], 3.0)
+    self.assertAlmostEqual(proximities['trajectoryPoint'][0][1], 4.0)
+    self.assertAlmostEqual(proximities['surfacePoint'][0][1], 1.0)
+    self.assertAlmostEqual(proximities['distance'][1], 0.0)
+    self.assertAlmostEqual(proximities['arcLength'][1], 24.0)
+    self.assertEqual(proximities['distance'][2], 20.0)
+
+    # The same rows from worker threads, the far model without a task
+    modelNodes, farRows, tasks = logic.ModelProximityTasks(hierarchyNode, fiducialNode, maxDistance=20.0)
+    self.assertEqual(sorted(tasks), [0, 1])
+    self.assertEqual(farRows['distance'][2], 20.0)
+    jobQueue = jobs.JobQueue()
+    jobQueue.submit(tasks)
+    while jobQueue.busy():
+      for i, row, error in jobQueue.poll():
+        self.assertIsNone(error)
+        self.assertAlmostEqual(row['distance'], proximities['distance'][i])
+        self.assertAlmostEqual(row['arcLength'], proximities['arcLength'][i])
+      time.sleep(0.01)
+    jobQueue.shutdown()
+    self.delayDisplay('Test passed!')
+
+  def test_CurveTracerBatchResume(self):
+    """ Resuming a batch drops the rows of the failed and interrupted
+    cases before they are run again, so every case appears once.
+    """
+
+    self.delayDisplay("Starting the batch resume test")
+    import csv, json
+    from CurveTracerLib import batch
+    ok = {'case': 'a', 'status': 'ok', 'seconds': 1.0, 'labels': [],
+          'fiducials': [{'name': 'F-1', 'value': 1, 'inBounds': True}]}
+    failed = {'case': 'b', 'status': 'error', 'error': 'IOError: missing', 'seconds': 0.5}
+    path = os.path.join(slicer.app.temporaryPath, 'CurveTracerTestBatch.csv')
+    if os.path.exists(path):
+      os.remove(path)
+    with batch.CsvWriter(path) as writer:
+      writer.write(ok)
+      writer.write(failed)
+      writer.writer.writerow({'case': 'c', 'source': 'fiducial', 'structure': 'F-1', 'value': 2})
+
+    with batch.CsvWriter(path) as writer:
+      self.assertEqual(writer.finishedCases(), set(['a']))
+      writer.write(dict(failed, status='ok', fiducials=[{'name': 'F-1', 'value': 3, 'inBounds': True}]))
+    with open(path) as f:
+      rows = list(csv.DictReader(f))
+    self.assertEqual([(row['case'], row['source']) for row in rows],
+                     [('a', 'fiducial'), ('a', 'case'), ('b', 'fiducial'), ('b', 'case')])
+    self.assertEqual([row['status'] for row in rows if row['source'] == 'case'], ['ok', 'ok'])
+    os.remove(path)
+
+    path = os.path.join(slicer.app.temporaryPath, 'CurveTracerTestBatch.jsonl')
+    with open(path, 'w') as f:
+      f.write(json.dumps(ok) + '\n' + json.dumps(failed) + '\n{"case": "c", "sta')
+    with batch.JsonLinesWriter(path) as writer:
+      self.assertEqual(writer.finishedCases(), set(['a']))
+      writer.write(dict(failed, status='ok'))
+    with open(path) as f:
+      records = [json.loads(line) for line in f]
+    self.assertEqual([(record['case'], record['status']) for record in records], [('a', 'ok'), ('b', 'ok')])
+    os.remove(path)
+    self.delayDisplay('Test passed!')
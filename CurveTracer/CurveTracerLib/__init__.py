@@ -0,0 +1,45 @@
+"""Headless computational core of the CurveTracer module.
+
+Everything in this package works on NumPy arrays, 4x4 matrices and VTK
+data objects, without MRML nodes, Qt or a running Slicer, so it can be
+used from plain Python workers and batch pipelines. CurveTracerLogic is a
+thin adapter that extracts arrays from the scene and calls into it.
+
+Submodules are imported on first use so that importing the package (and
+registering the Slicer module) stays cheap:
+
+  conversion    zero-copy views of VTK images, points and matrices
+  geometry      polyline arc lengths and bounding box tests
+  sampling      batched voxel lookup
+  roi           cropping of label maps around trajectories
+  boxes         bounding boxes of labels and meshes to skip far structures
+  occupancy     min/max brick pyramid of label maps to skip empty space
+  tracing       exact voxel traversal of trajectories
+  sweep         structures within a tool radius and distances to meshes
+  tracking      streaming evaluation of tracked tool poses
+  trajectories  one pass evaluation of many trajectories
+  locators      cached VTK locators over single and merged meshes
+  normals       precomputed cell and point normals of meshes
+  surfaces      surfaces of crossed labels, extracted on demand
+  intersection  crossings of trajectories with meshes and entry angles
+  distance      distance maps of label map structures
+  diskcache     persistent cache of indexes and results keyed by content
+  planning      batched evaluation of candidate entry points
+  synthetic     deterministic label maps, meshes and trajectories
+  readers       NRRD, FCSV and model files without Slicer
+  batch         command line processing of many cases in a process pool
+  profiling     opt-in timers and counters of the hot paths
+  jobs          cancellable batches of tasks in a thread pool
+"""
+
+import importlib
+
+_submodules = ['conversion', 'geometry', 'sampling', 'tracing', 'locators', 'intersection', 'synthetic',
+               'readers', 'batch', 'distance', 'planning', 'roi',
+               'boxes', 'normals', 'profiling', 'jobs', 'surfaces', 'trajectories', 'diskcache',
+               'occupancy', 'tracking', 'sweep']
+
+def __getattr__(name):
+  if name in _submodules:
+    return importlib.import_module('.' + name, __name__)
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,297 @@
+"""Command line batch processing of many cases in a process pool.
+
+  python -m CurveTracerLib.batch manifest.csv --output results.jsonl --workers 8
+
+The manifest is either a CSV file with the columns case, labelmap,
+trajectory and an optional models column (paths separated by ';'), or a
+JSON list of objects with the same keys. Relative paths are resolved
+against the directory of the manifest.
+
+Results are streamed to the output as cases finish, as JSON Lines (one
+object per case) or as CSV (one row per structure, fiducial and
+crossing, followed by a status row per case) depending on the extension.
+Running the same command again after an interruption skips the cases
+that are already complete in the output, and first removes the rows left
+by failed or interrupted cases, which are run again. With --cache, the results of
+every case are also kept in a persistent cache keyed by the content of its
+inputs, so running a cohort again into a new output only recomputes the
+cases whose label map, trajectory or models changed.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+from . import diskcache
+from . import distance
+from . import intersection
+from . import locators
+from . import readers
+from . import sampling
+from . import tracing
+
+CSV_COLUMNS = ['case', 'status', 'source', 'structure', 'value', 'entry', 'exit', 'voxels', 'angle', 'crossing']
+
+# Per-process state, created by initWorker
+_worker = {}
+
+
+def readManifest(path):
+  """Return the cases of a CSV or JSON manifest as a list of dictionaries
+  with the keys case, labelmap, trajectory and models (a list of paths)
+  """
+  if path.lower().endswith('.json'):
+    with open(path) as f:
+      rows = json.load(f)
+  else:
+    with open(path) as f:
+      rows = list(csv.DictReader(f))
+
+  directory = os.path.dirname(os.path.abspath(path))
+  resolve = lambda p: os.path.normpath(os.path.join(directory, p.strip()))
+  cases = []
+  for index, row in enumerate(rows):
+    models = row.get('models') or []
+    if not isinstance(models, list):
+      models = [m for m in models.split(';') if m.strip()]
+    cases.append({'case': str(row.get('case') or index),
+                  'labelmap': resolve(row['labelmap']),
+                  'trajectory': resolve(row['trajectory']),
+                  'models': [resolve(m) for m in models]})
+  return cases
+
+def initWorker(memoryBudget=256 * 1024 * 1024, cacheDirectory=None, cacheSize=2 * 1024 ** 3):
+  """Create the caches of a worker process. Meshes are cached by path and
+  modification time, so cases sharing an atlas reuse its locator. With a
+  cacheDirectory, case results and normals are kept on disk.
+  """
+  _worker['locatorCache'] = locators.LocatorCache(memoryBudget)
+  _worker['models'] = {}
+  _worker['diskCache'] = diskcache.DiskCache(cacheDirectory, cacheSize) if cacheDirectory else None
+  _worker['locatorCache'].diskCache = _worker['diskCache']
+
+def loadModel(path):
+  if 'models' not in _worker:
+    initWorker()
+  key = (path, os.path.getmtime(path))
+  if key not in _worker['models']:
+    _worker['models'][key] = readers.readModel(path)
+  return _worker['models'][key]
+
+def processCase(case):
+  """Compute the structures crossed, the voxel values at the fiducials and
+  the entry angles into the models of one case. Errors are reported in
+  the result instead of being raised.
+  """
+  startTime = time.time()
+  result = {'case': case['case'], 'status': 'ok'}
+  try:
+    labels, ijkToRas = readers.readNrrd(case['labelmap'])
+    rasToIjk = np.linalg.inv(ijkToRas)
+    names, points = readers.readFcsv(case['trajectory'])
+    polys = [loadModel(path) for path in case['models']]
+    modelNames = [os.path.splitext(os.path.basename(path))[0] for path in case['models']]
+
+    diskCache = _worker.get('diskCache')
+    if diskCache:
+      diskKey = diskcache.digest('Case', distance.contentHash(labels), ijkToRas, names, points,
+                                 [diskcache.meshDigest(poly) for poly in polys], modelNames)
+      cached = diskCache.get(diskKey)
+      if cached is not None:
+        result.update(json.loads(str(cached['result'])))
+        result['cached'] = True
+        result['seconds'] = time.time() - startTime
+        return result
+
+    trace = tracing.traceTrajectory(labels, rasToIjk, points)
+    result['labels'] = [{'label': int(run['label']), 'entry': float(run['entry']), 'exit': float(run['exit']),
+                         'voxels': int(run['voxels'])} for run in trace if run['label'] != 0]
+    values, inBounds = sampling.sampleLabels(labels, rasToIjk, points)
+    result['fiducials'] = [{'name': name, 'value': int(value), 'inBounds': bool(inside)}
+                           for name, value, inside in zip(names, values, inBounds)]
+
+    result['models'] = []
+    if case['models'] and len(points) >= 2:
+      key = tuple(case['models'])
+      hierarchyLocator = _worker['locatorCache'].getHierarchyLocator(key, polys)
+      angles = intersection.entryAngles(hierarchyLocator, len(polys), points[0], points[-1],
+                                        _worker['locatorCache'].getNormals(key))
+      crossings = intersection.intersectTrajectory(hierarchyLocator.locator, hierarchyLocator.polyData, points,
+                                                   normals=_worker['locatorCache'].getNormals(key, 'outward'),
+                                                   cellToModel=hierarchyLocator.cellToModel)
+      models = crossings['model']
+      for index, name in enumerate(modelNames):
+        result['models'].append({
+          'name': name, 'entryAngle': float(angles[index]),
+          'crossings': [{'arcLength': float(c['arcLength']), 'entering': bool(c['entering']), 'angle': float(c['angle'])}
+                        for c in crossings[models == index]]})
+
+    if diskCache:
+      computed = {name: result[name] for name in ('labels', 'fiducials', 'models')}
+      diskCache.put(diskKey, {'result': np.array(json.dumps(computed))})
+  except Exception as e:
+    result['status'] = 'error'
+    result['error'] = '%s: %s' % (type(e).__name__, e)
+  result['seconds'] = time.time() - startTime
+  return result
+
+
+class JsonLinesWriter(object):
+  """Appends one JSON object per case. Opening an existing file keeps only
+  the cases that completed, so a resumed run writes each case once.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def readAttempts(self):
+    """The attempts at a case in the file, as a list of (case, status,
+    records); the status of an interrupted attempt is None
+    """
+    attempts = []
+    if os.path.exists(self.path):
+      with open(self.path) as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # Last line of an interrupted run
+            attempts.append((None, None, []))
+            continue
+          attempts.append((record['case'], record.get('status'), [record]))
+    return attempts
+
+  def finishedCases(self):
+    """Cases that completed without error; failed cases are run again"""
+    return set(case for case, status, records in self.readAttempts() if status == 'ok')
+
+  def writeAttempts(self, f, attempts):
+    for case, status, records in attempts:
+      for record in records:
+        f.write(json.dumps(record) + '\n')
+
+  def open(self):
+    """Open the file for appending, after dropping the failed and
+    interrupted attempts an earlier run left
+    """
+    attempts = self.readAttempts()
+    finished = [attempt for attempt in attempts if attempt[1] == 'ok']
+    if len(finished) < len(attempts):
+      temporary = self.path + '.tmp'
+      with open(temporary, 'w') as f:
+        self.writeAttempts(f, finished)
+      os.replace(temporary, self.path)
+    self.file = open(self.path, 'a')
+
+  def __enter__(self):
+    self.open()
+    return self
+
+  def __exit__(self, *args):
+    self.file.close()
+
+  def write(self, result):
+    self.file.write(json.dumps(result) + '\n')
+    self.file.flush()
+
+
+class CsvWriter(JsonLinesWriter):
+  """Appends one row per structure, fiducial and crossing of a case,
+  followed by a status row that marks the case as complete"""
+
+  def readAttempts(self):
+    """The rows of the file grouped by attempt, each ending with its status
+    row; rows after the last status row are an interrupted attempt
+    """
+    attempts = []
+    rows = []
+    if os.path.exists(self.path):
+      with open(self.path) as f:
+        for row in csv.DictReader(f):
+          rows.append(row)
+          if row['source'] == 'case':
+            attempts.append((row['case'], row['status'], rows))
+            rows = []
+    if rows:
+      attempts.append((None, None, rows))
+    return attempts
+
+  def writeAttempts(self, f, attempts):
+    writer = csv.DictWriter(f, CSV_COLUMNS)
+    writer.writeheader()
+    for case, status, rows in attempts:
+      writer.writerows(rows)
+
+  def __enter__(self):
+    self.open()
+    self.writer = csv.DictWriter(self.file, CSV_COLUMNS)
+    if os.path.getsize(self.path) == 0:
+      self.writer.writeheader()
+    return self
+
+  def write(self, result):
+    case = result['case']
+    for run in result.get('labels', []):
+      self.writer.writerow({'case': case, 'source': 'label', 'structure': run['label'], 'entry': run['entry'],
+                            'exit': run['exit'], 'voxels': run['voxels']})
+    for fiducial in result.get('fiducials', []):
+      self.writer.writerow({'case': case, 'source': 'fiducial', 'structure': fiducial['name'],
+                            'value': fiducial['value'] if fiducial['inBounds'] else ''})
+    for model in result.get('models', []):
+      self.writer.writerow({'case': case, 'source': 'model', 'structure': model['name'], 'angle': model['entryAngle']})
+      for crossing in model['crossings']:
+        self.writer.writerow({'case': case, 'source': 'crossing', 'structure': model['name'],
+                              'entry': crossing['arcLength'], 'angle': crossing['angle'],
+                              'crossing': 'entry' if crossing['entering'] else 'exit'})
+    self.writer.writerow({'case': case, 'status': result['status'], 'source': 'case',
+                          'structure': result.get('error', ''), 'value': result['seconds']})
+    self.file.flush()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Run CurveTracer over the cases of a manifest.')
+  parser.add_argument('manifest', help='CSV or JSON manifest of cases')
+  parser.add_argument('-o', '--output', required=True, help='results file (.csv, or .jsonl for JSON Lines)')
+  parser.add_argument('-j', '--workers', type=int, default=multiprocessing.cpu_count(),
+                      help='number of worker processes (default: number of CPUs)')
+  parser.add_argument('--memory-budget', type=float, default=256, help='locator cache budget per worker in MB')
+  parser.add_argument('--cache', metavar='DIRECTORY', help='persistent cache of case results and normals')
+  parser.add_argument('--cache-size', type=float, default=2048, help='size limit of the persistent cache in MB')
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+  writerClass = CsvWriter if args.output.lower().endswith('.csv') else JsonLinesWriter
+  cases = readManifest(args.manifest)
+  with writerClass(args.output) as writer:
+    finished = writer.finishedCases()
+    pending = [case for case in cases if case['case'] not in finished]
+    logging.info('%d cases, %d already done, %d workers' % (len(cases), len(cases) - len(pending), args.workers))
+
+    memoryBudget = int(args.memory_budget * 1024 * 1024)
+    initArgs = (memoryBudget, args.cache, int(args.cache_size * 1024 * 1024))
+    if args.workers <= 1:
+      initWorker(*initArgs)
+      results = (processCase(case) for case in pending)
+      pool = None
+    else:
+      pool = multiprocessing.Pool(args.workers, initializer=initWorker, initargs=initArgs)
+      results = pool.imap_unordered(processCase, pending)
+
+    try:
+      for n, result in enumerate(results):
+        writer.write(result)
+        logging.info('[%d/%d] %s: %s (%.2f s)' % (n + 1, len(pending), result['case'], result['status'], result['seconds']))
+    finally:
+      if pool:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+  sys.exit(main())
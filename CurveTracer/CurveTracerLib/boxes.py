@@ -0,0 +1,91 @@
+"""Bounding boxes of labels and meshes, to skip the structures that are
+far from a trajectory before any expensive work is done on them.
+"""
+
+import numpy as np
+
+from . import distance
+from . import geometry
+
+# Largest span of label values histogrammed directly, whatever labels are
+# present (FreeSurfer lookup tables go up to 14175)
+DENSE_LABEL_SPAN = 1 << 14
+
+
+class LabelBoxes(object):
+  """Voxel bounding box of every label of a label map. The boxes are found
+  with one histogram per slice along each axis, so building the index
+  reads the label map three times and then every query is a handful of
+  vectorized box tests. When the label values span more than
+  DENSE_LABEL_SPAN, the histograms are taken over the indices of the
+  labels present, so memory does not grow with the span.
+  Boxes are stored as [k, j, i] lower bounds and exclusive upper bounds.
+  """
+
+  def __init__(self, labels):
+    if labels.size == 0:
+      self.labels = np.zeros(0, dtype=np.int64)
+      self.lower = np.zeros((0, 3), dtype=int)
+      self.upper = np.zeros((0, 3), dtype=int)
+      return
+
+    offset = int(labels.min())
+    if int(labels.max()) - offset < DENSE_LABEL_SPAN:
+      values = np.arange(offset, int(labels.max()) + 1)
+      toBins = lambda labelSlice: labelSlice.astype(np.int64) - offset
+    else:
+      # Slices are mapped to the indices of the labels present one at a
+      # time, so no index array of the whole label map is allocated
+      values = np.unique(labels).astype(np.int64)
+      toBins = lambda labelSlice: np.searchsorted(values, labelSlice)
+    present = []
+    for axis in range(3):
+      axisPresent = np.zeros((len(values), labels.shape[axis]), dtype=bool)
+      for index in range(labels.shape[axis]):
+        bins = toBins(np.take(labels, index, axis=axis).ravel())
+        axisPresent[:, index] = np.bincount(bins, minlength=len(values)) > 0
+      present.append(axisPresent)
+
+    bins = np.nonzero(np.any(present[0], axis=1))[0]
+    self.labels = values[bins]
+    self.lower = np.stack([np.argmax(p[bins], axis=1) for p in present], axis=1)
+    self.upper = np.stack([p.shape[1] - np.argmax(p[bins, ::-1], axis=1) for p in present], axis=1)
+
+  def box(self, label):
+    """Return (lower, upper) of label, or None if it is not in the label map
+    """
+    index = np.nonzero(self.labels == label)[0]
+    if len(index) == 0:
+      return None
+    return self.lower[index[0]], self.upper[index[0]]
+
+  def near(self, rasToIjk, points, margin=0.0, labels=None):
+    """Return the labels (among labels, all of them by default) whose box,
+    grown by margin mm, is touched by the polyline points
+    """
+    selected = np.ones(len(self.labels), dtype=bool)
+    if labels is not None:
+      selected = np.isin(self.labels, labels)
+    marginVoxels = distance.voxelReach(rasToIjk, margin)
+    # Voxel centers are at integer indices, so a box spans half a voxel more
+    lower = self.lower[selected][:, ::-1] - 0.5 - marginVoxels
+    upper = self.upper[selected][:, ::-1] - 0.5 + marginVoxels
+    ijk = geometry.transformPoints(rasToIjk, points)
+    return self.labels[selected][geometry.polylineTouchesBoxes(ijk, lower, upper)]
+
+
+def meshBounds(polys):
+  """Return (lower, upper), the (N,3) bounds of every mesh. VTK recomputes
+  the bounds of a mesh only when it is modified.
+  """
+  bounds = np.array([poly.GetBounds() for poly in polys]).reshape(-1, 3, 2)
+  return bounds[:, :, 0], bounds[:, :, 1]
+
+def nearMeshes(polys, points, margin=0.0):
+  """Indices of the meshes whose bounds, grown by margin, are touched by
+  the polyline points
+  """
+  if len(polys) == 0:
+    return np.zeros(0, dtype=np.int64)
+  lower, upper = meshBounds(polys)
+  return np.nonzero(geometry.polylineTouchesBoxes(points, lower - margin, upper + margin))[0]
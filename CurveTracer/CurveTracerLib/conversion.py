@@ -0,0 +1,73 @@
+"""Zero-copy conversions between VTK data objects and NumPy arrays."""
+
+import numpy as np
+
+
+def arrayFromImageData(imageData):
+  """Return a zero-copy NumPy view of the scalars of a single component
+  vtkImageData, indexed [k, j, i]
+  """
+  from vtk.util import numpy_support
+  dims = imageData.GetDimensions()
+  scalars = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+  return scalars.reshape(dims[2], dims[1], dims[0])
+
+def arrayFromMatrix(matrix):
+  """Return a vtkMatrix4x4 as a 4x4 array
+  """
+  return np.array([[matrix.GetElement(r, c) for c in range(4)] for r in range(4)])
+
+def matrixFromArray(array):
+  """Return a 4x4 array as a vtkMatrix4x4
+  """
+  import vtk
+  matrix = vtk.vtkMatrix4x4()
+  for r in range(4):
+    for c in range(4):
+      matrix.SetElement(r, c, array[r][c])
+  return matrix
+
+def arrayFromPoints(points):
+  """Return a zero-copy (N,3) view of a vtkPoints
+  """
+  from vtk.util import numpy_support
+  return numpy_support.vtk_to_numpy(points.GetData())
+
+def arrayFromArray(dataArray):
+  """Return a zero-copy NumPy view of a vtkDataArray
+  """
+  from vtk.util import numpy_support
+  return numpy_support.vtk_to_numpy(dataArray)
+
+def dataArrayFromArray(array, name):
+  """Return a vtkDataArray named name holding a copy of a NumPy array
+  """
+  from vtk.util import numpy_support
+  dataArray = numpy_support.numpy_to_vtk(np.ascontiguousarray(array), deep=1)
+  dataArray.SetName(name)
+  return dataArray
+
+def linesPolyData(starts, ends):
+  """Return a polydata with one line cell from every start to its end point
+  """
+  import vtk
+  from vtk.util import numpy_support
+  nOfLines = len(starts)
+  coordinates = np.empty((2 * nOfLines, 3))
+  coordinates[0::2] = starts
+  coordinates[1::2] = ends
+  points = vtk.vtkPoints()
+  points.SetData(numpy_support.numpy_to_vtk(coordinates, deep=1))
+
+  idType = np.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else np.int32
+  connectivity = np.empty((nOfLines, 3), dtype=idType)
+  connectivity[:, 0] = 2
+  connectivity[:, 1] = np.arange(0, 2 * nOfLines, 2)
+  connectivity[:, 2] = connectivity[:, 1] + 1
+  lines = vtk.vtkCellArray()
+  lines.SetCells(nOfLines, numpy_support.numpy_to_vtkIdTypeArray(connectivity.ravel(), deep=1))
+
+  poly = vtk.vtkPolyData()
+  poly.SetPoints(points)
+  poly.SetLines(lines)
+  return poly
@@ -0,0 +1,177 @@
+"""Persistent cache of derived indexes and results on disk.
+
+Entries are .npz files of named arrays in a directory, with an SQLite index
+of their sizes and last use. Keys are digests of the content an entry was
+derived from (label map voxels, mesh points and cells, trajectory points
+and parameters), so entries are found again after a scene is reopened or a
+batch is run again, and never go stale: changed inputs give another key.
+Least recently used entries are deleted once the cache exceeds its size.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from . import conversion
+from . import profiling
+
+
+def digest(*parts):
+  """Hex digest of parts: arrays (shape, type and content), strings,
+  numbers, None, and lists or tuples of them
+  """
+  hasher = hashlib.blake2b(digest_size=16)
+
+  def update(part):
+    if isinstance(part, np.ndarray):
+      hasher.update(repr((part.shape, part.dtype.str)).encode())
+      hasher.update(np.ascontiguousarray(part).reshape(-1).view(np.uint8))
+    elif isinstance(part, (list, tuple)):
+      hasher.update(b'(')
+      for item in part:
+        update(item)
+      hasher.update(b')')
+    else:
+      if isinstance(part, np.generic):
+        part = part.item()
+      hasher.update(repr(part).encode() + b',')
+
+  for part in parts:
+    update(part)
+  return hasher.hexdigest()
+
+def meshDigest(poly):
+  """digest of the points and cells of a vtkPolyData
+  """
+  parts = [conversion.arrayFromPoints(poly.GetPoints()) if poly.GetPoints() else None]
+  for cells in (poly.GetVerts(), poly.GetLines(), poly.GetPolys(), poly.GetStrips()):
+    if hasattr(cells, 'GetConnectivityArray'):
+      parts.append(conversion.arrayFromArray(cells.GetOffsetsArray()))
+      parts.append(conversion.arrayFromArray(cells.GetConnectivityArray()))
+    else:
+      parts.append(conversion.arrayFromArray(cells.GetData()))
+  return digest(*parts)
+
+
+class DiskCache(object):
+  """Entries of named arrays stored under digest keys in directory, up to
+  maxBytes. Several threads and processes can share a directory: files
+  are written to a temporary name and renamed, and the index is an SQLite
+  database in WAL mode.
+  """
+
+  def __init__(self, directory, maxBytes=2 * 1024 ** 3):
+    os.makedirs(directory, exist_ok=True)
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=30.0,
+                                      check_same_thread=False, isolation_level=None)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, lastUsed REAL)')
+
+  def path(self, key):
+    return os.path.join(self.directory, key[:2], key + '.npz')
+
+  def get(self, key):
+    """Return the dictionary of arrays stored under key, or None
+    """
+    try:
+      with np.load(self.path(key), allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    except (IOError, OSError, ValueError, zipfile.BadZipFile):
+      self.misses += 1
+      profiling.profiler.count('DiskCacheMiss')
+      return None
+    self.hits += 1
+    profiling.profiler.count('DiskCacheHit')
+    with self.lock:
+      self.connection.execute('UPDATE entries SET lastUsed = ? WHERE key = ?', (time.time(), key))
+    return arrays
+
+  def put(self, key, arrays):
+    """Store a dictionary of arrays under key
+    """
+    path = self.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with profiling.profiler.timer('DiskCacheWrite'):
+      with open(temporary, 'wb') as f:
+        np.savez(f, **arrays)
+      os.replace(temporary, path)
+    with self.lock:
+      self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                              (key, os.path.getsize(path), time.time()))
+    self.evict()
+
+  def getObject(self, key, objectClass):
+    """Return the object of objectClass stored by putObject under key, or
+    None. Its constructor is not called.
+    """
+    arrays = self.get(key)
+    if arrays is None:
+      return None
+    instance = objectClass.__new__(objectClass)
+    for name, value in arrays.items():
+      setattr(instance, name, value.item() if value.ndim == 0 else value)
+    return instance
+
+  def putObject(self, key, instance):
+    """Store the attributes of instance, which must be arrays, numbers or
+    strings, under key
+    """
+    self.put(key, {name: np.asarray(value) for name, value in vars(instance).items()})
+
+  def size(self):
+    with self.lock:
+      return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+  def evict(self):
+    """Delete least recently used entries until the cache fits in maxBytes
+    """
+    with self.lock:
+      total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+      if total <= self.maxBytes:
+        return
+      removed = []
+      # The most recent entry is always kept
+      for key, size in self.connection.execute('SELECT key, size FROM entries ORDER BY lastUsed').fetchall()[:-1]:
+        if total <= self.maxBytes:
+          break
+        removed.append(key)
+        total -= size
+      self.connection.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in removed])
+    for key in removed:
+      try:
+        os.remove(self.path(key))
+      except OSError:
+        pass
+
+  def setMaxBytes(self, maxBytes):
+    self.maxBytes = maxBytes
+    self.evict()
+
+  def clear(self):
+    with self.lock:
+      keys = [row[0] for row in self.connection.execute('SELECT key FROM entries').fetchall()]
+      self.connection.execute('DELETE FROM entries')
+    for key in keys:
+      try:
+        os.remove(self.path(key))
+      except OSError:
+        pass
+
+  def close(self):
+    self.connection.close()
+
+  def statistics(self):
+    with self.lock:
+      entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+    return {'entries': entries, 'size': size, 'maxBytes': self.maxBytes, 'hits': self.hits, 'misses': self.misses}
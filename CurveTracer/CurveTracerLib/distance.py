@@ -0,0 +1,206 @@
+"""Distance maps of label map structures and clearance along trajectories."""
+
+import collections
+import hashlib
+import time
+
+import numpy as np
+
+from . import diskcache
+from . import geometry
+from . import profiling
+
+# One row per label: the smallest distance between the trajectory and the
+# label, and where along the trajectory it occurs
+CLEARANCE_DTYPE = np.dtype([('label', np.int64), ('distance', np.float64), ('arcLength', np.float64),
+                            ('point', np.float64, 3)])
+
+
+def voxelSpacing(rasToIjk):
+  """Size of the voxels in mm along i, j and k
+  """
+  ijkToRas = np.linalg.inv(rasToIjk)
+  return np.sqrt(np.sum(ijkToRas[:3, :3] ** 2, axis=0))
+
+def voxelReach(rasToIjk, radius):
+  """Extent in voxels along i, j and k of a ball of radius mm. Unlike
+  radius / voxelSpacing, it also holds for sheared voxel grids.
+  """
+  return radius * np.sqrt(np.sum(np.asarray(rasToIjk)[:3, :3] ** 2, axis=1))
+
+def contentHash(labels):
+  """Digest of the shape, type and voxels of a label map
+  """
+  digest = hashlib.blake2b(digest_size=16)
+  digest.update(repr((labels.shape, labels.dtype.str)).encode())
+  digest.update(memoryview(np.ascontiguousarray(labels)).cast('B'))
+  return digest.hexdigest()
+
+def distanceMap(mask, spacing, maxDistance=20.0):
+  """Euclidean distance in mm from every voxel to the nearest voxel of
+  mask (a boolean array indexed [k, j, i]), with spacing given along
+  i, j and k. The transform is computed one axis at a time, only looking
+  maxDistance mm away, so distances are exact up to maxDistance and
+  clipped to it beyond.
+  """
+  squared = np.where(mask, 0.0, np.inf).astype(np.float32)
+  for axis, axisSpacing in zip((2, 1, 0), spacing):
+    previous = squared
+    squared = previous.copy()
+    for offset in range(1, min(int(maxDistance / axisSpacing), mask.shape[axis] - 1) + 1):
+      cost = np.float32((offset * axisSpacing) ** 2)
+      lower = [slice(None)] * 3
+      upper = [slice(None)] * 3
+      lower[axis] = slice(None, -offset)
+      upper[axis] = slice(offset, None)
+      lower = tuple(lower)
+      upper = tuple(upper)
+      np.minimum(squared[upper], previous[lower] + cost, out=squared[upper])
+      np.minimum(squared[lower], previous[upper] + cost, out=squared[lower])
+  return np.minimum(np.sqrt(squared), np.float32(maxDistance))
+
+
+class DistanceField(object):
+  """Distance map of one label, computed only over the bounding box of the
+  label grown by maxDistance. Everything outside of the box is at least
+  maxDistance away. The box may extend beyond the volume, so points just
+  outside of it are measured too.
+  If the bounding box of the label is known (see boxes.LabelBoxes), only
+  that part of the label map is read; box is None for absent labels.
+  """
+
+  def __init__(self, labels, label, spacing, maxDistance=20.0, box=False):
+    self.label = label
+    self.maxDistance = maxDistance
+    self.offset = np.zeros(3, dtype=int)
+    self.distances = np.zeros((0, 0, 0), dtype=np.float32)
+    if box is False:
+      mask = labels == label
+      box = [[], []]
+      for axis in range(3):
+        occupied = np.nonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis)))[0]
+        if len(occupied) == 0:
+          return
+        box[0].append(occupied[0])
+        box[1].append(occupied[-1] + 1)
+    elif box is None:
+      return
+
+    margin = np.ceil(maxDistance / np.asarray(spacing)[::-1]).astype(int) + 1
+    lower = np.asarray(box[0]) - margin
+    upper = np.asarray(box[1]) + margin
+
+    # Offset and crop of the grown box, [k, j, i]
+    self.offset = np.array(lower)
+    cropped = np.zeros(np.subtract(upper, lower), dtype=bool)
+    source = tuple(slice(max(l, 0), min(u, n)) for l, u, n in zip(lower, upper, labels.shape))
+    target = tuple(slice(s.start - l, s.stop - l) for s, l in zip(source, lower))
+    cropped[target] = labels[source] == label
+    self.distances = distanceMap(cropped, spacing, maxDistance)
+
+  @property
+  def nbytes(self):
+    return self.distances.nbytes
+
+  def sample(self, ijk):
+    """Distance at integer voxel indices ijk, an (...,3) array of [i, j, k]
+    """
+    local = ijk[..., ::-1] - self.offset
+    inside = np.all((local >= 0) & (local < self.distances.shape), axis=-1)
+    values = np.full(ijk.shape[:-1], self.maxDistance)
+    local = local[inside]
+    values[inside] = self.distances[local[:, 0], local[:, 1], local[:, 2]]
+    return values
+
+
+class DistanceCache(object):
+  """Keeps the distance fields of labels, keyed by the content hash of the
+  label map and the label, so they are only computed once per label map
+  state. Least recently used fields are evicted once their memory exceeds
+  the budget. With a diskCache (diskcache.DiskCache), fields are also
+  stored on disk and read back instead of being computed again.
+  """
+
+  def __init__(self, memoryBudget=256 * 1024 * 1024):
+    self.memoryBudget = memoryBudget
+    self.entries = collections.OrderedDict()
+    self.memorySize = 0
+    self.hits = 0
+    self.misses = 0
+    self.buildTime = 0.0
+    self.diskCache = None
+
+  def getField(self, labels, label, spacing, maxDistance=20.0, labelsHash=None, box=False):
+    """Return the DistanceField of label. labelsHash is the contentHash of
+    labels, computed when not given; box is passed on to DistanceField.
+    """
+    if labelsHash is None:
+      labelsHash = contentHash(labels)
+    key = (labelsHash, int(label), tuple(np.round(spacing, 6)), maxDistance)
+    field = self.entries.get(key)
+    if field is not None:
+      self.hits += 1
+      profiling.profiler.count('DistanceCacheHit')
+      self.entries.move_to_end(key)
+      return field
+
+    self.misses += 1
+    profiling.profiler.count('DistanceCacheMiss')
+    diskKey = diskcache.digest('DistanceField', key)
+    if self.diskCache is not None:
+      field = self.diskCache.getObject(diskKey, DistanceField)
+    if field is None:
+      startTime = time.time()
+      with profiling.profiler.timer('DistanceFieldBuild'):
+        field = DistanceField(labels, label, spacing, maxDistance, box)
+      self.buildTime += time.time() - startTime
+      if self.diskCache is not None:
+        self.diskCache.putObject(diskKey, field)
+
+    self.entries[key] = field
+    self.memorySize += field.nbytes
+    self.evict()
+    return field
+
+  def evict(self):
+    """Drop least recently used fields until the cache fits in the budget.
+    The most recent entry is always kept.
+    """
+    while self.memorySize > self.memoryBudget and len(self.entries) > 1:
+      key, field = self.entries.popitem(last=False)
+      self.memorySize -= field.nbytes
+
+  def setMemoryBudget(self, memoryBudget):
+    self.memoryBudget = memoryBudget
+    self.evict()
+
+  def clear(self):
+    self.entries.clear()
+    self.memorySize = 0
+
+  def statistics(self):
+    return {'entries': len(self.entries), 'memorySize': self.memorySize, 'memoryBudget': self.memoryBudget,
+            'hits': self.hits, 'misses': self.misses, 'buildTime': self.buildTime}
+
+
+def trajectoryClearance(fields, rasToIjk, points, step=None):
+  """Smallest distance between the polyline points and the label of every
+  field, with the arc length and position where it occurs. The polyline
+  is sampled every step mm, half the smallest voxel size by default.
+  Distances are clipped to the maxDistance of the fields.
+  Returns a structured array (CLEARANCE_DTYPE) with one row per field.
+  """
+  if step is None:
+    step = 0.5 * np.min(voxelSpacing(rasToIjk))
+  samples, arcLength = geometry.samplePolyline(points, step)
+  ijk = np.rint(geometry.transformPoints(rasToIjk, samples)).astype(np.intp)
+
+  clearance = np.zeros(len(fields), dtype=CLEARANCE_DTYPE)
+  for i, field in enumerate(fields):
+    distances = field.sample(ijk)
+    closest = np.argmin(distances)
+    clearance['label'][i] = field.label
+    clearance['distance'][i] = distances[closest]
+    clearance['arcLength'][i] = arcLength[closest]
+    clearance['point'][i] = samples[closest]
+  return clearance
@@ -0,0 +1,123 @@
+"""Polyline helpers shared by the tracing and intersection code."""
+
+import numpy as np
+
+
+def asPoints(points):
+  """Return points as a float (N,3) array
+  """
+  return np.asarray(points, dtype=float).reshape(-1, 3)
+
+def transformPoints(matrix, points):
+  """Apply a 4x4 homogeneous matrix to an (N,3) array of points
+  """
+  matrix = np.asarray(matrix, dtype=float)
+  return asPoints(points).dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+def segmentLengths(points):
+  """Length of every segment of the polyline points
+  """
+  return np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1))
+
+def arcLengths(points):
+  """Return (lengths, arcStart): the length of every segment and the arc
+  length of every point from the first one
+  """
+  lengths = segmentLengths(points)
+  return lengths, np.concatenate(([0.0], np.cumsum(lengths)))
+
+def segmentOverlapsBox(p0, p1, bounds, margin=0.0):
+  """True if the bounding box of the segment p0-p1 overlaps bounds, given
+  as a (3,2) array of [min, max] per axis, grown by margin
+  """
+  return not (np.any(np.minimum(p0, p1) > bounds[:, 1] + margin) or
+              np.any(np.maximum(p0, p1) < bounds[:, 0] - margin))
+
+def samplePolyline(points, step):
+  """Return (samples, arcLength): points every step mm along the polyline,
+  including its last point, and their arc length from the first point
+  """
+  points = asPoints(points)
+  lengths, arcStart = arcLengths(points)
+  if len(points) < 2:
+    return points.copy(), np.zeros(len(points))
+  arcLength = np.append(np.arange(0.0, arcStart[-1], step), arcStart[-1])
+  segment = np.clip(np.searchsorted(arcStart, arcLength, side='right') - 1, 0, len(lengths) - 1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = np.nan_to_num((arcLength - arcStart[segment]) / lengths[segment])
+  samples = points[segment] + t[:, np.newaxis] * (points[segment + 1] - points[segment])
+  return samples, arcLength
+
+def closestPoints(points, targets, extrapolate=False, batchSize=1 << 20):
+  """Closest point of the polyline points to every target, in batches of
+  at most batchSize target-segment pairs. With extrapolate, the first and
+  last segments are extended to infinity.
+  Returns (distances, feet, segments): the distance of every target to
+  the polyline, the closest point on it and the index of its segment.
+  """
+  points = asPoints(points)
+  targets = asPoints(targets)
+  distances = np.zeros(len(targets))
+  feet = np.zeros((len(targets), 3))
+  segments = np.zeros(len(targets), dtype=np.int64)
+  if len(points) == 0:
+    return distances, feet, segments
+  if len(points) == 1:
+    feet[:] = points[0]
+    return np.sqrt(np.sum((targets - points[0]) ** 2, axis=1)), feet, segments
+
+  a = points[:-1]
+  d = np.diff(points, axis=0)
+  squaredLengths = np.sum(d ** 2, axis=1)
+  lower = np.zeros(len(d))
+  upper = np.ones(len(d))
+  if extrapolate:
+    lower[0] = -np.inf
+    upper[-1] = np.inf
+
+  batch = max(1, batchSize // len(d))
+  for start in range(0, len(targets), batch):
+    q = targets[start:start+batch, np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = np.sum((q - a) * d, axis=2) / squaredLengths
+    # Degenerate segments are points
+    t = np.clip(np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0), lower, upper)
+    foot = a + t[:, :, np.newaxis] * d
+    squaredDistances = np.sum((q - foot) ** 2, axis=2)
+    closest = np.argmin(squaredDistances, axis=1)
+    rows = np.arange(len(closest))
+    distances[start:start+batch] = np.sqrt(squaredDistances[rows, closest])
+    feet[start:start+batch] = foot[rows, closest]
+    segments[start:start+batch] = closest
+  return distances, feet, segments
+
+def polylineTouchesBoxes(points, lower, upper):
+  """For every box given by its (N,3) lower and upper corners, True if a
+  segment of the polyline points (or its only point) touches it. All
+  segments are tested against all boxes at once with the slab method.
+  """
+  points = asPoints(points)
+  if len(points) == 0:
+    return np.zeros(len(lower), dtype=bool)
+  if len(points) == 1:
+    return np.all((points[0] >= lower) & (points[0] <= upper), axis=1)
+  return np.any(segmentsTouchBoxes(points, lower, upper), axis=0)
+
+def segmentsTouchBoxes(points, lower, upper):
+  """(S,N) array, True where segment s of the polyline points, of at least
+  two points, touches box n given by its (N,3) lower and upper corners
+  """
+  points = asPoints(points)
+  lower = np.asarray(lower, dtype=float)[np.newaxis]
+  upper = np.asarray(upper, dtype=float)[np.newaxis]
+  p0 = points[:-1, np.newaxis, :]
+  d = np.diff(points, axis=0)[:, np.newaxis, :]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t0 = (lower - p0) / d
+    t1 = (upper - p0) / d
+  # Segments parallel to a slab are inside it everywhere or nowhere
+  parallel = d == 0
+  inside = (p0 >= lower) & (p0 <= upper)
+  tNear = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t0, t1)).max(axis=2)
+  tFar = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t0, t1)).min(axis=2)
+  return (tNear <= tFar) & (tFar >= 0.0) & (tNear <= 1.0)
@@ -0,0 +1,189 @@
+"""Crossings of trajectories with model surfaces and entry angles."""
+
+import math
+
+import numpy as np
+import vtk
+
+from . import conversion
+from . import geometry
+from . import profiling
+
+# One row per crossing of a polyline trajectory with a model surface
+CROSSING_DTYPE = np.dtype([('model', np.int64), ('cell', np.int64), ('segment', np.int64), ('arcLength', np.float64),
+                           ('point', np.float64, 3), ('entering', np.bool_), ('angle', np.float64)])
+
+
+def cellAngle(poly, cellId, traj):
+  """Angle in degrees between the normal of a cell and the trajectory
+  """
+  p0 = poly.GetCell(cellId).GetPoints()
+  v0 = np.subtract(p0.GetPoint(1), p0.GetPoint(0))
+  v1 = np.subtract(p0.GetPoint(2), p0.GetPoint(0))
+
+  v0xv1 = np.cross(v1, v0)
+  normal = v0xv1 / math.sqrt(np.dot(v0xv1, v0xv1))
+  return math.degrees(vtk.vtkMath.AngleBetweenVectors(normal, traj))
+
+def cellNormals(poly, cellIds):
+  """Unit normals of the given cells, oriented by the right-hand rule of
+  their point order (outward for consistently oriented closed meshes).
+  Degenerate cells get a NaN normal.
+  """
+  normals = np.zeros((len(cellIds), 3))
+  for i, cellId in enumerate(cellIds):
+    cellPoints = poly.GetCell(cellId).GetPoints()
+    p0 = np.array(cellPoints.GetPoint(0))
+    normals[i] = np.cross(np.array(cellPoints.GetPoint(1)) - p0, np.array(cellPoints.GetPoint(2)) - p0)
+  norms = np.sqrt(np.sum(normals ** 2, axis=1))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return normals / np.where(norms > 0, norms, np.nan)[:, np.newaxis]
+
+def normalAngles(normals, direction):
+  """Angles in degrees between unit normals and the direction vector
+  """
+  direction = np.asarray(direction, dtype=float)
+  direction = direction / np.sqrt(np.dot(direction, direction))
+  return np.degrees(np.arccos(np.clip(normals.dot(direction), -1.0, 1.0)))
+
+def entryAngle(locator, poly, pos0, posN, tolerance=0.001, normals=None):
+  """Entry angle of the straight line from pos0 to posN into the mesh of
+  locator, at the hit closest to pos0 like entryAngles. 0.0 when the line
+  does not hit the mesh. With normals (normals.MeshNormals of poly), the
+  normal is interpolated at the hit point instead of taken from the cell.
+  """
+  points = vtk.vtkPoints()
+  idList = vtk.vtkIdList()
+  locator.IntersectWithLine(pos0, posN, tolerance, points, idList)
+  if idList.GetNumberOfIds() == 0:
+    return 0.0
+  hitPoints = conversion.arrayFromPoints(points)
+  first = int(np.argmin(np.sum((hitPoints - np.asarray(pos0)) ** 2, axis=1)))
+  if normals is None:
+    return cellAngle(poly, idList.GetId(first), np.subtract(pos0, posN))
+  normal = normals.interpolate([idList.GetId(first)], hitPoints[first:first+1])
+  return float(normalAngles(normal, np.subtract(posN, pos0))[0])
+
+def entryAngles(hierarchyLocator, nOfModels, pos0, posN, normals=None):
+  """Entry angle of the straight line from pos0 to posN into every mesh of
+  a HierarchyLocator, from a single query. The hit closest to pos0 is the
+  entry point of each mesh. Meshes that are not hit get 0.0. With normals
+  (normals.MeshNormals of the merged mesh), the normals are interpolated
+  at the hit points.
+  """
+  angles = np.zeros(nOfModels)
+  hits = hierarchyLocator.intersectWithLine(pos0, posN)
+
+  # Hits are sorted by distance, so the first hit of each mesh is its entry
+  models, first = np.unique(hits['model'], return_index=True)
+  if normals is not None:
+    if len(first):
+      hitNormals = normals.interpolate(hits['cell'][first], hits['point'][first])
+      angles[models] = normalAngles(hitNormals, np.subtract(posN, pos0))
+    return angles
+  traj = np.subtract(pos0, posN)
+  for model, hit in zip(models, hits[first]):
+    angles[model] = cellAngle(hierarchyLocator.polyData, hit['cell'], traj)
+  return angles
+
+def hitGroups(crossings, tolerance):
+  """Sort crossings by model and arc length. Returns (crossings, starts):
+  the sorted crossings and the index of the first of every group of hits
+  of a model less than tolerance apart, such as the hits of the cells
+  around an edge or a vertex the line passes through.
+  """
+  crossings = crossings[np.lexsort((crossings['arcLength'], crossings['model']))]
+  newGroup = np.ones(len(crossings), dtype=bool)
+  newGroup[1:] = (crossings['model'][1:] != crossings['model'][:-1]) | (np.diff(crossings['arcLength']) >= tolerance)
+  return crossings, np.flatnonzero(newGroup)
+
+def intersectSegment(locator, poly, p0, p1, tolerance=0.001, normals=None, cellToModel=None):
+  """Every crossing of the segment p0-p1 with the mesh of locator, with
+  arc lengths measured from p0 (see intersectTrajectory)
+  """
+  hitPoints = vtk.vtkPoints()
+  idList = vtk.vtkIdList()
+  locator.IntersectWithLine(p0, p1, tolerance, hitPoints, idList)
+  nOfHits = idList.GetNumberOfIds()
+  crossings = np.zeros(nOfHits, dtype=CROSSING_DTYPE)
+  if nOfHits == 0:
+    return crossings
+  crossings['cell'] = [idList.GetId(j) for j in range(nOfHits)]
+  crossings['point'] = conversion.arrayFromPoints(hitPoints)
+  crossings['arcLength'] = np.sqrt(np.sum((crossings['point'] - p0) ** 2, axis=1))
+  if cellToModel is not None:
+    crossings['model'] = cellToModel[crossings['cell']]
+
+  # The cells around a crossed edge or vertex make one crossing, with the
+  # mean of their normals
+  crossings, starts = hitGroups(crossings, tolerance)
+  if normals is None:
+    hitNormals = cellNormals(poly, crossings['cell'])
+  else:
+    hitNormals = normals.interpolate(crossings['cell'], crossings['point'])
+  hitNormals = np.add.reduceat(np.nan_to_num(hitNormals), starts)
+  crossings = crossings[starts]
+  norms = np.sqrt(np.sum(hitNormals ** 2, axis=1))
+  direction = (p1 - p0) / np.sqrt(np.sum((p1 - p0) ** 2))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    cosines = hitNormals.dot(direction) / np.where(norms > 0, norms, np.nan)
+  crossings['entering'] = cosines < 0
+  crossings['angle'] = np.degrees(np.arccos(np.clip(np.abs(cosines), 0.0, 1.0)))
+  return crossings[np.argsort(crossings['arcLength'], kind='stable')]
+
+def intersectTrajectory(locator, poly, points, tolerance=0.001, segmentCache=None, normals=None, cellToModel=None):
+  """Every crossing of the polyline points with the mesh of locator.
+  Segments whose bounding box does not overlap the mesh bounds are skipped.
+  The angle of a crossing is measured between the local segment direction
+  and the surface normal (0 degrees for a perpendicular crossing), and a
+  crossing is an entry when the segment runs against the outward normal.
+  If a segmentCache dictionary is given, segments whose end points did not
+  move since the previous call reuse their crossings, so dragging one
+  control point only recomputes its two adjacent segments.
+  With normals (normals.MeshNormals of poly), angles and entries use the
+  normals interpolated at the crossing points instead of the cell normals.
+  Hits less than tolerance apart, from the cells around a crossed edge or
+  vertex or from both segments at a control point, are one crossing; with
+  cellToModel (the model of every cell of a merged mesh, which fills the
+  model field), only the hits of the same model are merged.
+  Returns a structured array (CROSSING_DTYPE) sorted by arc length.
+  """
+  points = geometry.asPoints(points)
+  bounds = np.array(poly.GetBounds()).reshape(3, 2)
+  lengths, arcStart = geometry.arcLengths(points)
+
+  usedSegments = {}
+  segmentCrossings = []
+  for i in range(len(points) - 1):
+    p0 = points[i]
+    p1 = points[i+1]
+    if lengths[i] == 0.0 or not geometry.segmentOverlapsBox(p0, p1, bounds, tolerance):
+      continue
+    key = (p0.tobytes(), p1.tobytes(), tolerance)
+    crossings = segmentCache.get(key) if segmentCache is not None else None
+    if crossings is None:
+      with profiling.profiler.timer('SegmentIntersection'):
+        crossings = intersectSegment(locator, poly, p0, p1, tolerance, normals, cellToModel)
+    else:
+      profiling.profiler.count('SegmentCacheHit')
+    usedSegments[key] = crossings
+    if len(crossings) == 0:
+      continue
+    crossings = crossings.copy()
+    crossings['segment'] = i
+    crossings['arcLength'] += arcStart[i]
+    segmentCrossings.append(crossings)
+
+  # Only keep the segments of the current trajectory
+  if segmentCache is not None:
+    segmentCache.clear()
+    segmentCache.update(usedSegments)
+
+  if not segmentCrossings:
+    return np.zeros(0, dtype=CROSSING_DTYPE)
+  crossings = np.concatenate(segmentCrossings)
+
+  # A hit exactly on a control point is reported by both adjacent segments
+  crossings, starts = hitGroups(crossings, tolerance)
+  crossings = crossings[starts]
+  return crossings[np.argsort(crossings['arcLength'], kind='stable')]
@@ -0,0 +1,91 @@
+"""Background execution of independent computations in a thread pool."""
+
+import concurrent.futures
+import queue
+import threading
+
+from . import profiling
+
+
+class JobQueue(object):
+  """Runs batches of independent tasks in a thread pool and hands their
+  results to the thread that polls it, the Qt main thread in the module.
+  Tasks must not touch MRML nodes or Qt widgets.
+
+  Submitting a batch cancels the previous one: its queued tasks never
+  start, running tasks see their cancelled event set, and the results
+  they still produce are dropped by poll. So the results always belong
+  to the latest batch.
+  """
+
+  def __init__(self, maxWorkers=None):
+    self.executor = concurrent.futures.ThreadPoolExecutor(maxWorkers)
+    self.results = queue.Queue()
+    self.generation = 0
+    self.cancelled = threading.Event()
+    self.futures = []
+    self.pending = 0
+
+  def submit(self, tasks):
+    """Cancel the current batch and start tasks, a dictionary of callables
+    taking one argument: a threading.Event that is set when the batch is
+    cancelled, which long tasks can check to stop early.
+    Returns the number of the batch.
+    """
+    self.cancel()
+    self.generation += 1
+    self.cancelled = threading.Event()
+    self.pending = len(tasks)
+    self.futures = [self.executor.submit(self.run, self.generation, self.cancelled, key, task)
+                    for key, task in tasks.items()]
+    return self.generation
+
+  def run(self, generation, cancelled, key, task):
+    if cancelled.is_set():
+      return
+    result = None
+    error = None
+    try:
+      with profiling.profiler.timer('Job'):
+        result = task(cancelled)
+    except Exception as e:
+      error = e
+    self.results.put((generation, key, result, error))
+
+  def cancel(self):
+    """Cancel the current batch. Tasks that already run are not
+    interrupted, but their results are dropped.
+    """
+    self.generation += 1
+    self.cancelled.set()
+    for future in self.futures:
+      future.cancel()
+    self.futures = []
+    self.pending = 0
+
+  def poll(self):
+    """Return the results of the current batch that arrived since the last
+    call, as a list of (key, result, error); error is the exception raised
+    by the task, or None
+    """
+    finished = []
+    while True:
+      try:
+        generation, key, result, error = self.results.get_nowait()
+      except queue.Empty:
+        break
+      if generation == self.generation:
+        finished.append((key, result, error))
+    self.pending -= len(finished)
+    if finished:
+      profiling.profiler.count('JobResults', len(finished))
+    return finished
+
+  def busy(self):
+    """True while results of the current batch are outstanding
+    """
+    return self.pending > 0
+
+  def shutdown(self):
+    self.cancel()
+    self.executor.shutdown(wait=False)
@@ -0,0 +1,243 @@
+"""Cached VTK locators over model meshes."""
+
+import collections
+import threading
+import time
+
+import numpy as np
+import vtk
+
+from . import conversion
+from . import diskcache
+from . import normals
+from . import profiling
+
+# One row per intersection of a ray with the meshes of a HierarchyLocator
+HIT_DTYPE = np.dtype([('model', np.int64), ('cell', np.int64), ('distance', np.float64), ('point', np.float64, 3)])
+
+
+def buildLocator(poly):
+  """Build a vtkModifiedBSPTree over poly
+  """
+  locator = vtk.vtkModifiedBSPTree()
+  locator.SetDataSet(poly)
+  locator.BuildLocator()
+  return locator
+
+
+class HierarchyLocator(object):
+  """A single locator over the triangles of several meshes. The meshes are
+  merged into one polydata whose 'ModelIndex' cell array maps every cell
+  back to its mesh, so one query returns the hits on all meshes.
+  """
+
+  def __init__(self, polys):
+    append = vtk.vtkAppendPolyData()
+    for index, modelPoly in enumerate(polys):
+      poly = vtk.vtkPolyData()
+      poly.ShallowCopy(modelPoly)
+      modelIndex = vtk.vtkIntArray()
+      modelIndex.SetName('ModelIndex')
+      modelIndex.SetNumberOfTuples(poly.GetNumberOfCells())
+      modelIndex.Fill(index)
+      poly.GetCellData().AddArray(modelIndex)
+      append.AddInputData(poly)
+    append.Update()
+    self.polyData = append.GetOutput()
+    self.cellToModel = np.array(conversion.arrayFromArray(self.polyData.GetCellData().GetArray('ModelIndex')))
+    self.locator = buildLocator(self.polyData)
+
+  def intersectWithLine(self, p0, p1, tolerance=0.001):
+    """Return every hit of the segment p0-p1 with any mesh, sorted by
+    distance from p0
+    """
+    points = vtk.vtkPoints()
+    idList = vtk.vtkIdList()
+    self.locator.IntersectWithLine(p0, p1, tolerance, points, idList)
+
+    nOfHits = idList.GetNumberOfIds()
+    hits = np.zeros(nOfHits, dtype=HIT_DTYPE)
+    if nOfHits == 0:
+      return hits
+    hits['cell'] = [idList.GetId(i) for i in range(nOfHits)]
+    hits['point'] = conversion.arrayFromPoints(points)
+    hits['model'] = self.cellToModel[hits['cell']]
+    hits['distance'] = np.sqrt(np.sum((hits['point'] - np.asarray(p0)) ** 2, axis=1))
+    return hits[np.argsort(hits['distance'], kind='stable')]
+
+
+class LocatorCache(object):
+  """Keeps the spatial locators built over meshes so they are only rebuilt
+  when the mesh changes. Entries are stored under a caller-chosen key (the
+  model or hierarchy node ID in the module) and validated against the
+  polydata objects and their MTime. Least recently used locators are
+  evicted once the estimated memory exceeds the budget.
+  The cache can be shared by worker threads: the entries are guarded by a
+  lock, and a mesh is only built once when several threads ask for it.
+  With a diskCache (diskcache.DiskCache), normals are also stored on disk,
+  keyed by the digest of the mesh. The locators are always rebuilt.
+  """
+
+  # Estimated locator footprint: one bounding box (6 doubles) and one id per cell
+  BYTES_PER_CELL = 56
+  # Builds of keys that hash to the same stripe wait for each other
+  BUILD_LOCK_STRIPES = 64
+
+  def __init__(self, memoryBudget=256 * 1024 * 1024):
+    self.memoryBudget = memoryBudget
+    self.entries = collections.OrderedDict()
+    self.memorySize = 0
+    self.hits = 0
+    self.misses = 0
+    self.buildTime = 0.0
+    self.lock = threading.RLock()
+    self.buildLocks = [threading.Lock() for i in range(self.BUILD_LOCK_STRIPES)]
+    self.diskCache = None
+
+  def buildLock(self, key):
+    """Lock held while the locator or normals of key are built. There is a
+    fixed number of them, so keys that are never used again leave nothing
+    behind.
+    """
+    return self.buildLocks[hash(key) % len(self.buildLocks)]
+
+  def getLocator(self, key, poly):
+    """Return an up-to-date vtkModifiedBSPTree over poly
+    """
+    stamp = (poly, poly.GetMTime())
+    with self.buildLock(key):
+      locator = self.lookup(key, stamp)
+      if locator:
+        return locator
+
+      startTime = time.time()
+      with profiling.profiler.timer('LocatorBuild'):
+        locator = buildLocator(poly)
+      self.buildTime += time.time() - startTime
+
+      self.store(key, stamp, locator, poly.GetNumberOfCells() * self.BYTES_PER_CELL)
+      return locator
+
+  def getHierarchyLocator(self, key, polys):
+    """Return a HierarchyLocator over polys.
+    It is rebuilt only when a mesh is added, removed or changes.
+    """
+    stamp = tuple((poly, poly.GetMTime()) for poly in polys)
+    with self.buildLock(key):
+      hierarchyLocator = self.lookup(key, stamp)
+      if hierarchyLocator:
+        return hierarchyLocator
+
+      startTime = time.time()
+      with profiling.profiler.timer('HierarchyLocatorBuild'):
+        hierarchyLocator = HierarchyLocator(polys)
+      self.buildTime += time.time() - startTime
+
+      merged = hierarchyLocator.polyData
+      size = merged.GetNumberOfCells() * self.BYTES_PER_CELL + merged.GetActualMemorySize() * 1024
+      self.store(key, stamp, hierarchyLocator, size)
+      return hierarchyLocator
+
+  def lookup(self, key, stamp):
+    """Return the cached value for key if it was stored with the same stamp
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry and entry['stamp'] == stamp:
+        self.hits += 1
+        profiling.profiler.count('LocatorCacheHit')
+        self.entries.move_to_end(key)
+        return entry['value']
+      self.misses += 1
+      profiling.profiler.count('LocatorCacheMiss')
+      self.remove(key)
+      return None
+
+  def store(self, key, stamp, value, size):
+    with self.lock:
+      self.entries[key] = {'stamp': stamp, 'value': value, 'size': size, 'segments': {}, 'normals': {}}
+      self.memorySize += size
+      self.evict()
+
+  def segmentCache(self, key):
+    """Return the dictionary of per-segment results attached to the locator
+    stored for key. It is dropped together with the locator, so results are
+    never reused across mesh changes. If another thread has evicted the
+    entry in between, a new dictionary is returned that is not kept.
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      return entry['segments'] if entry else {}
+
+  def getNormals(self, key, orientation='winding'):
+    """Return the normals.MeshNormals of the mesh of the locator stored for
+    key, computed on first use and dropped together with the locator. The
+    meshes of a HierarchyLocator are oriented separately.
+    """
+    with self.buildLock(key):
+      with self.lock:
+        entry = self.entries[key]
+        meshNormals = entry['normals'].get(orientation)
+      if meshNormals is None:
+        meshNormals = self.buildNormals(entry['value'], orientation)
+        with self.lock:
+          entry['normals'][orientation] = meshNormals
+          entry['size'] += meshNormals.nbytes
+          if self.entries.get(key) is entry:
+            self.memorySize += meshNormals.nbytes
+      return meshNormals
+
+  def getLocatorNormals(self, key, poly, orientation='winding'):
+    """Return (locator, meshNormals) of poly, as getLocator and getNormals.
+    When other threads use the cache, the entry may be evicted in between;
+    the normals are then built without being cached.
+    """
+    locator = self.getLocator(key, poly)
+    try:
+      return locator, self.getNormals(key, orientation)
+    except KeyError:
+      return locator, self.buildNormals(locator, orientation)
+
+  def buildNormals(self, value, orientation):
+    """normals.MeshNormals of the mesh of a locator or HierarchyLocator
+    """
+    poly = value.polyData if isinstance(value, HierarchyLocator) else value.GetDataSet()
+    groups = value.cellToModel if isinstance(value, HierarchyLocator) else None
+    if self.diskCache is not None:
+      diskKey = diskcache.digest('MeshNormals', diskcache.meshDigest(poly), orientation, groups)
+      meshNormals = self.diskCache.getObject(diskKey, normals.MeshNormals)
+      if meshNormals is not None:
+        return meshNormals
+    with profiling.profiler.timer('NormalsBuild'):
+      meshNormals = normals.MeshNormals(poly, orientation, groups)
+    if self.diskCache is not None:
+      self.diskCache.putObject(diskKey, meshNormals)
+    return meshNormals
+
+  def remove(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry:
+        self.memorySize -= entry['size']
+
+  def evict(self):
+    """Drop least recently used locators until the cache fits in the budget.
+    The most recent entry is always kept.
+    """
+    with self.lock:
+      while self.memorySize > self.memoryBudget and len(self.entries) > 1:
+        key, entry = self.entries.popitem(last=False)
+        self.memorySize -= entry['size']
+
+  def setMemoryBudget(self, memoryBudget):
+    self.memoryBudget = memoryBudget
+    self.evict()
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.memorySize = 0
+
+  def statistics(self):
+    return {'entries': len(self.entries), 'memorySize': self.memorySize, 'memoryBudget': self.memoryBudget,
+            'hits': self.hits, 'misses': self.misses, 'buildTime': self.buildTime}
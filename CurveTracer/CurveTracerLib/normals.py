@@ -0,0 +1,123 @@
+"""Precomputed normals of meshes for entry angles and crossings."""
+
+import numpy as np
+
+from . import conversion
+
+
+def cellCorners(poly):
+  """Return the ids of the first three points of every cell as a (C,3)
+  array, -1 for cells with fewer than three points
+  """
+  nOfCells = poly.GetNumberOfCells()
+  corners = np.full((nOfCells, 3), -1, dtype=np.int64)
+  polys = poly.GetPolys()
+  first = poly.GetNumberOfVerts() + poly.GetNumberOfLines()
+  nOfPolys = polys.GetNumberOfCells()
+  if nOfPolys:
+    if hasattr(polys, 'GetOffsetsArray'):
+      offsets = conversion.arrayFromArray(polys.GetOffsetsArray())
+      connectivity = conversion.arrayFromArray(polys.GetConnectivityArray())
+    else:
+      # Legacy layout: the size of every cell followed by its point ids
+      data = conversion.arrayFromArray(polys.GetData())
+      sizes = np.zeros(nOfPolys, dtype=np.int64)
+      position = 0
+      for i in range(nOfPolys):
+        sizes[i] = data[position]
+        position += sizes[i] + 1
+      offsets = np.concatenate(([0], np.cumsum(sizes)))
+      connectivity = np.delete(data, offsets[:-1] + np.arange(nOfPolys))
+    starts = offsets[:-1]
+    valid = np.diff(offsets) >= 3
+    for corner in range(3):
+      corners[first:first+nOfPolys, corner][valid] = connectivity[starts[valid] + corner]
+
+  # Triangle strips are rare enough to be read one cell at a time
+  for cellId in range(first + nOfPolys, nOfCells):
+    pointIds = poly.GetCell(cellId).GetPointIds()
+    if pointIds.GetNumberOfIds() >= 3:
+      corners[cellId] = [pointIds.GetId(corner) for corner in range(3)]
+  return corners
+
+def normalize(vectors):
+  """Unit vectors along vectors, NaN for zero vectors
+  """
+  norms = np.sqrt(np.sum(vectors ** 2, axis=-1))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return vectors / np.where(norms > 0, norms, np.nan)[..., np.newaxis]
+
+
+class MeshNormals(object):
+  """Unit normals of every cell and every point of a mesh, computed once
+  with NumPy. Point normals are the area weighted mean of the normals of
+  their cells. Degenerate cells have a NaN normal and do not contribute.
+  orientation is 'winding' for the right-hand rule of the point order of
+  the cells, or 'outward' or 'inward' to flip the normals of every closed
+  mesh (or of every group of cells, given groups per cell) whose winding
+  encloses a negative volume.
+  """
+
+  def __init__(self, poly, orientation='winding', groups=None):
+    self.orientation = orientation
+    self.points = np.array(conversion.arrayFromPoints(poly.GetPoints()), dtype=float)
+    self.corners = cellCorners(poly)
+
+    valid = np.all(self.corners >= 0, axis=1)
+    corners = np.where(valid[:, np.newaxis], self.corners, 0)
+    a = self.points[corners[:, 0]]
+    b = self.points[corners[:, 1]]
+    c = self.points[corners[:, 2]]
+    areaNormals = np.where(valid[:, np.newaxis], np.cross(b - a, c - a), 0.0)
+
+    if orientation != 'winding':
+      # Signed volume enclosed by the cells of every group
+      if groups is None:
+        groups = np.zeros(len(corners), dtype=np.int64)
+      volumes = np.bincount(groups, weights=np.sum(a * areaNormals, axis=1))
+      sign = np.where(volumes < 0, -1.0, 1.0)
+      if orientation == 'inward':
+        sign = -sign
+      areaNormals *= sign[groups][:, np.newaxis]
+
+    self.cellNormals = normalize(areaNormals)
+    pointNormals = np.zeros_like(self.points)
+    for corner in range(3):
+      for axis in range(3):
+        pointNormals[:, axis] += np.bincount(corners[valid, corner], weights=areaNormals[valid, axis],
+                                             minlength=len(self.points))
+    self.pointNormals = normalize(pointNormals)
+
+  @property
+  def nbytes(self):
+    return self.points.nbytes + self.corners.nbytes + self.cellNormals.nbytes + self.pointNormals.nbytes
+
+  def interpolate(self, cellIds, points):
+    """Normals at points lying on the cells cellIds, interpolated from the
+    point normals with barycentric weights. Where the interpolation is
+    degenerate the cell normal is used.
+    """
+    cellIds = np.asarray(cellIds, dtype=np.int64)
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    corners = self.corners[cellIds]
+    a = self.points[corners[:, 0]]
+    v0 = self.points[corners[:, 1]] - a
+    v1 = self.points[corners[:, 2]] - a
+    v2 = points - a
+    d00 = np.sum(v0 * v0, axis=1)
+    d01 = np.sum(v0 * v1, axis=1)
+    d11 = np.sum(v1 * v1, axis=1)
+    d20 = np.sum(v2 * v0, axis=1)
+    d21 = np.sum(v2 * v1, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      denominator = d00 * d11 - d01 * d01
+      v = (d11 * d20 - d01 * d21) / denominator
+      w = (d00 * d21 - d01 * d20) / denominator
+    # Hits found within the locator tolerance may lie slightly outside
+    weights = np.clip(np.stack((1.0 - v - w, v, w), axis=1), 0.0, None)
+    weights /= np.sum(weights, axis=1)[:, np.newaxis]
+
+    normals = normalize(np.sum(weights[:, :, np.newaxis] * self.pointNormals[corners], axis=1))
+    degenerate = np.any(np.isnan(normals), axis=1)
+    normals[degenerate] = self.cellNormals[cellIds[degenerate]]
+    return normals
@@ -0,0 +1,134 @@
+"""Min/max occupancy pyramid of label maps, to skip empty space.
+
+The label map is divided into bricks of brickSize voxels per side and the
+smallest and largest label of every brick are kept. Coarser levels merge
+2x2x2 bricks of the level below, up to a single brick over the volume. A
+segment is traced through the coarsest level first and only descends into
+occupied bricks (with any non-zero label), so long stretches of background
+are stepped over in one jump and the voxels of the label map are only read
+inside occupied bricks.
+"""
+
+import numpy as np
+
+from . import geometry
+from . import tracing
+
+
+def brickReduce(array, size, function):
+  """Reduce array ([k, j, i]) over blocks of size elements along every axis
+  with function (np.minimum, np.maximum or np.logical_or). The last block
+  along an axis may be smaller.
+  """
+  for axis in (2, 1, 0):
+    array = function.reduceat(array, np.arange(0, array.shape[axis], size), axis=axis)
+  return array
+
+def mergeIntervals(intervals):
+  """Merge the touching or overlapping rows of intervals, an (N,2) array of
+  [start, end] sorted by start
+  """
+  if len(intervals) < 2:
+    return intervals
+  newInterval = np.ones(len(intervals), dtype=bool)
+  newInterval[1:] = intervals[1:, 0] > np.maximum.accumulate(intervals[:-1, 1]) + 1e-12
+  starts = np.flatnonzero(newInterval)
+  ends = np.append(starts[1:], len(intervals)) - 1
+  return np.stack([intervals[starts, 0], np.maximum.accumulate(intervals[:, 1])[ends]], axis=1)
+
+
+class OccupancyPyramid(object):
+  """Smallest and largest label of every brick of a label map ([k, j, i])
+  and the occupancy of every level of the pyramid. All levels are stored
+  in the flat occupied array, level n being
+  occupied[levelOffsets[n]:levelOffsets[n + 1]] reshaped to levelShapes[n].
+  Building it reads the label map once.
+  """
+
+  def __init__(self, labels, brickSize=8):
+    self.brickSize = brickSize
+    self.shape = np.array(labels.shape)
+    if labels.size == 0:
+      self.minimum = np.zeros((0, 0, 0), dtype=labels.dtype)
+      self.maximum = np.zeros((0, 0, 0), dtype=labels.dtype)
+      self.occupied = np.zeros(0, dtype=bool)
+      self.levelShapes = np.zeros((1, 3), dtype=int)
+      self.levelOffsets = np.zeros(2, dtype=int)
+      return
+
+    self.minimum = brickReduce(labels, brickSize, np.minimum)
+    self.maximum = brickReduce(labels, brickSize, np.maximum)
+    levels = [(self.minimum != 0) | (self.maximum != 0)]
+    while max(levels[-1].shape) > 1:
+      levels.append(brickReduce(levels[-1], 2, np.logical_or))
+    self.occupied = np.concatenate([level.ravel() for level in levels])
+    self.levelShapes = np.array([level.shape for level in levels])
+    self.levelOffsets = np.concatenate([[0], np.cumsum([level.size for level in levels])])
+
+  @property
+  def nbytes(self):
+    return self.minimum.nbytes + self.maximum.nbytes + self.occupied.nbytes
+
+  def level(self, index):
+    """Occupancy of the bricks of level index ([k, j, i]); level 0 are the
+    bricks of brickSize voxels
+    """
+    return self.occupied[self.levelOffsets[index]:self.levelOffsets[index + 1]].reshape(self.levelShapes[index])
+
+  def valueRange(self, lower, upper):
+    """Return (low, high), bounds of the labels in the [k, j, i] block
+    [lower, upper) found from the bricks it overlaps, or None if it is empty
+    """
+    lower = np.maximum(np.asarray(lower) // self.brickSize, 0)
+    upper = np.minimum(-(-np.asarray(upper) // self.brickSize), self.minimum.shape)
+    if np.any(upper <= lower):
+      return None
+    box = tuple(slice(low, high) for low, high in zip(lower, upper))
+    return self.minimum[box].min(), self.maximum[box].max()
+
+  def occupiedIntervals(self, a, b):
+    """Parts of the segment a-b, given in IJK, that lie in occupied bricks.
+    The segment is traced through the coarsest level, then through the
+    occupied bricks of every finer level only.
+    Returns an (N,2) array of [tEntry, tExit], t being the parametric
+    position along the segment in [0, 1].
+    """
+    a = np.asarray(a, dtype=float)
+    d = np.asarray(b, dtype=float) - a
+    intervals = np.array([[0.0, 1.0]])
+    for index in reversed(range(len(self.levelShapes))):
+      occupied = self.level(index)
+      size = self.brickSize * 2 ** index
+      # Brick centers at integer coordinates: brick n holds voxels [n * size, (n + 1) * size)
+      start = (a + 0.5) / size - 0.5
+      direction = d / size
+      parts = [np.zeros((0, 2))]
+      for t0, t1 in intervals:
+        tEntry, tExit, bricks = tracing.traceSegment(occupied.shape[::-1], start + t0 * direction,
+                                                     start + t1 * direction)
+        keep = occupied[bricks[:, 2], bricks[:, 1], bricks[:, 0]]
+        parts.append(t0 + np.stack([tEntry[keep], tExit[keep]], axis=1) * (t1 - t0))
+      intervals = mergeIntervals(np.concatenate(parts))
+      if len(intervals) == 0:
+        break
+    return intervals
+
+  def touches(self, labels, rasToIjk, points):
+    """Whether the RAS polyline points crosses any non-zero voxel of labels.
+    Only the voxels along the occupied parts of each segment are traced,
+    and the search stops at the first labeled voxel. A single point touches
+    the voxel it lies in, read only if its brick is occupied.
+    """
+    ijkPoints = geometry.transformPoints(rasToIjk, geometry.asPoints(points))
+    if len(ijkPoints) == 1:
+      kji = np.rint(ijkPoints[0][::-1]).astype(int)
+      if np.any((kji < 0) | (kji >= self.shape)):
+        return False
+      return bool(self.level(0)[tuple(kji // self.brickSize)] and labels[tuple(kji)] != 0)
+    for a, b in zip(ijkPoints[:-1], ijkPoints[1:]):
+      d = b - a
+      for t0, t1 in self.occupiedIntervals(a, b):
+        ijk = tracing.traceSegment(self.shape[::-1], a + t0 * d, a + t1 * d)[2]
+        if np.any(labels[ijk[:, 2], ijk[:, 1], ijk[:, 0]] != 0):
+          return True
+    return False
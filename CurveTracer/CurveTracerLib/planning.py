@@ -0,0 +1,103 @@
+"""Evaluation of many straight candidate trajectories at once, for entry
+point planning over a skin surface.
+"""
+
+import numpy as np
+import vtk
+
+from . import conversion
+from . import distance
+from . import geometry
+
+# One row per candidate trajectory from an entry point to the target
+CANDIDATE_DTYPE = np.dtype([('vertex', np.int64), ('entry', np.float64, 3), ('length', np.float64),
+                            ('angle', np.float64), ('critical', np.int64), ('clearance', np.float64)])
+
+
+def pointNormals(poly):
+  """Unit normals at the points of poly, from its point data when present,
+  otherwise computed without splitting so they match the points
+  """
+  normals = poly.GetPointData().GetNormals()
+  if normals is None:
+    normalsFilter = vtk.vtkPolyDataNormals()
+    normalsFilter.SetInputData(poly)
+    normalsFilter.SplittingOff()
+    normalsFilter.ComputePointNormalsOn()
+    normalsFilter.ComputeCellNormalsOff()
+    normalsFilter.Update()
+    normals = normalsFilter.GetOutput().GetPointData().GetNormals()
+  return conversion.arrayFromArray(normals)
+
+def evaluateCandidates(labels, rasToIjk, entries, normals, target, criticalLabels=(), fields=None,
+                       maxDistance=20.0, step=0.5, batchSize=1 << 20):
+  """Evaluate the straight trajectories from every entry point to the
+  target. Each line is sampled every step voxels; the samples of many
+  lines are looked up in the label map in one batch of at most batchSize
+  samples.
+  For every candidate, 'angle' is the angle in degrees between the line
+  and the normal at its entry point (0 degrees for a perpendicular entry,
+  NaN without normals), 'critical' is the number of distinct critical
+  labels crossed and 'clearance' the smallest distance in mm between the
+  line and a critical label, up to maxDistance. fields are the
+  distance.DistanceField of the critical labels, computed when not given.
+  Returns a structured array (CANDIDATE_DTYPE) with one row per entry.
+  """
+  entries = geometry.asPoints(entries)
+  target = np.asarray(target, dtype=float)
+  candidates = np.zeros(len(entries), dtype=CANDIDATE_DTYPE)
+  candidates['vertex'] = np.arange(len(entries))
+  candidates['entry'] = entries
+  directions = target - entries
+  candidates['length'] = np.sqrt(np.sum(directions ** 2, axis=1))
+  if len(entries) == 0:
+    return candidates
+
+  if normals is None:
+    candidates['angle'] = np.nan
+  else:
+    with np.errstate(divide='ignore', invalid='ignore'):
+      cosines = np.sum(np.asarray(normals) * directions, axis=1) / candidates['length']
+    candidates['angle'] = np.degrees(np.arccos(np.clip(np.abs(cosines), 0.0, 1.0)))
+
+  criticalLabels = np.unique(np.asarray(criticalLabels, dtype=labels.dtype))
+  if len(criticalLabels) == 0:
+    candidates['clearance'] = maxDistance
+    return candidates
+  if fields is None:
+    spacing = distance.voxelSpacing(rasToIjk)
+    fields = [distance.DistanceField(labels, label, spacing, maxDistance) for label in criticalLabels]
+
+  # Lines are straight in IJK too, so only their end points are transformed
+  ijkEntries = geometry.transformPoints(rasToIjk, entries)
+  ijkTarget = geometry.transformPoints(rasToIjk, target)[0]
+  nOfSamples = int(np.ceil(np.max(np.sqrt(np.sum((ijkTarget - ijkEntries) ** 2, axis=1))) / step)) + 1
+  t = np.linspace(0.0, 1.0, nOfSamples)[np.newaxis, :, np.newaxis]
+  shape = np.array(labels.shape[::-1])
+
+  batch = max(1, batchSize // nOfSamples)
+  for start in range(0, len(entries), batch):
+    a = ijkEntries[start:start+batch, np.newaxis, :]
+    ijk = np.rint(a + t * (ijkTarget - a)).astype(np.intp)
+    samples = np.full(ijk.shape[:2], maxDistance)
+    for field in fields:
+      np.minimum(samples, field.sample(ijk), out=samples)
+    inBounds = np.all((ijk >= 0) & (ijk < shape), axis=2)
+    ijk[~inBounds] = 0
+
+    values = labels[ijk[..., 2], ijk[..., 1], ijk[..., 0]]
+    critical = np.zeros(len(ijk), dtype=np.int64)
+    for label in criticalLabels:
+      critical += np.any((values == label) & inBounds, axis=1)
+    candidates['critical'][start:start+batch] = critical
+    candidates['clearance'][start:start+batch] = np.min(samples, axis=1)
+  return candidates
+
+def rankCandidates(candidates, count=10, maxAngle=90.0):
+  """The count best candidates that cross no critical label and enter at
+  most maxAngle degrees away from the normal, by decreasing clearance
+  and then increasing entry angle
+  """
+  safe = candidates[(candidates['critical'] == 0) & ~(candidates['angle'] > maxAngle)]
+  order = np.lexsort((safe['angle'], -safe['clearance']))
+  return safe[order[:count]]
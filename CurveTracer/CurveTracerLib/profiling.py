@@ -0,0 +1,147 @@
+"""Named timers and counters for the hot paths.
+
+Instrumentation is disabled by default. A disabled Profiler hands out one
+shared no-op timer, so an instrumented block only costs a method call and
+an empty with statement:
+
+  with profiling.profiler.timer('VoxelSampling'):
+    ...
+  profiling.profiler.count('LocatorCacheHit')
+"""
+
+import collections
+import json
+import threading
+import time
+
+import numpy as np
+
+# Latency histogram bin edges in ms, 10 us to 10 s, two bins per decade
+HISTOGRAM_EDGES = 10.0 ** np.arange(-2.0, 4.5, 0.5)
+
+
+class _NullTimer(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+class _Timer(object):
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+    return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class Profiler(object):
+  """Keeps the last maxSamples durations of every timer, the value of every
+  counter and the last maxEvents timed blocks for trace export. Timers and
+  counters may be recorded from worker threads while the main thread reads
+  them; both sides hold the lock.
+  """
+
+  def __init__(self, enabled=False, maxSamples=1000, maxEvents=100000):
+    self.enabled = enabled
+    self.maxSamples = maxSamples
+    self.origin = time.perf_counter()
+    self.samples = {}
+    self.counters = collections.Counter()
+    self.events = collections.deque(maxlen=maxEvents)
+    self.lock = threading.Lock()
+
+  def timer(self, name):
+    """Return a context manager that times its block under name
+    """
+    if not self.enabled:
+      return _NULL_TIMER
+    return _Timer(self, name)
+
+  def count(self, name, n=1):
+    if self.enabled:
+      with self.lock:
+        self.counters[name] += n
+
+  def record(self, name, start, duration):
+    thread = threading.current_thread().ident
+    with self.lock:
+      samples = self.samples.get(name)
+      if samples is None:
+        samples = self.samples[name] = collections.deque(maxlen=self.maxSamples)
+      samples.append(duration)
+      self.events.append((name, start, duration, thread))
+
+  def copyCounters(self):
+    """Copy of the value of every counter"""
+    with self.lock:
+      return dict(self.counters)
+
+  def copySamples(self):
+    """Copy of the durations of every timer"""
+    with self.lock:
+      return {name: list(samples) for name, samples in self.samples.items()}
+
+  def histogram(self, name):
+    """Counts of the durations of name in the HISTOGRAM_EDGES bins (ms)
+    """
+    with self.lock:
+      durations = np.array(self.samples.get(name, ())) * 1000.0
+    return np.histogram(np.clip(durations, HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1]), HISTOGRAM_EDGES)[0]
+
+  def summary(self):
+    """Per timer statistics in ms: calls, mean, median, 95th percentile and
+    maximum of the kept samples
+    """
+    summary = {}
+    for name, samples in self.copySamples().items():
+      durations = np.array(samples) * 1000.0
+      summary[name] = {'calls': len(durations), 'mean': float(np.mean(durations)),
+                       'median': float(np.median(durations)), 'p95': float(np.percentile(durations, 95)),
+                       'max': float(np.max(durations))}
+    return summary
+
+  def trace(self):
+    """Timed blocks and counters in the Trace Event Format, which can be
+    opened in chrome://tracing or Perfetto
+    """
+    with self.lock:
+      timed = list(self.events)
+    events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': thread,
+               'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6}
+              for name, start, duration, thread in timed]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms', 'counters': self.copyCounters(),
+            'summary': self.summary()}
+
+  def exportTrace(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.trace(), f)
+
+  def clear(self):
+    with self.lock:
+      self.origin = time.perf_counter()
+      self.samples.clear()
+      self.counters.clear()
+      self.events.clear()
+
+
+def histogramText(counts):
+  """One block character per bin, scaled to the largest count
+  """
+  blocks = u' ▁▂▃▄▅▆▇█'
+  top = max(np.max(counts), 1) if len(counts) else 1
+  return u''.join(blocks[int(np.ceil(8.0 * count / top))] for count in counts)
+
+# Shared by the logic, the caches and the widget
+profiler = Profiler()
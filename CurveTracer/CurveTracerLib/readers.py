@@ -0,0 +1,147 @@
+"""Readers for the files of a case, usable without Slicer.
+
+Label maps are read from NRRD, trajectories from Slicer markups FCSV and
+models with the VTK readers. All coordinates are returned in RAS.
+"""
+
+import gzip
+import os
+import re
+
+import numpy as np
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+  }
+
+# Flip between LPS and RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def parseVector(text):
+  return [float(v) for v in text.strip().strip('()').split(',')]
+
+def readNrrd(path):
+  """Read a 3D scalar NRRD file.
+  Returns (labels, ijkToRas): the voxels indexed [k, j, i] and the 4x4
+  IJK to RAS matrix. Raw and gzip encodings are supported, with attached
+  or detached data.
+  """
+  with open(path, 'rb') as f:
+    magic = f.readline()
+    if not magic.startswith(b'NRRD'):
+      raise ValueError('%s is not a NRRD file' % path)
+    header = {}
+    while True:
+      line = f.readline()
+      if not line or not line.strip():
+        break
+      line = line.decode('latin-1').rstrip('\r\n')
+      if line.startswith('#') or ':' not in line:
+        continue
+      key, value = line.split(':=', 1) if ':=' in line else line.split(':', 1)
+      header[key.strip().lower()] = value.strip()
+    data = f.read()
+
+  if int(header['dimension']) != 3:
+    raise ValueError('%s: only 3D scalar volumes are supported' % path)
+  sizes = [int(s) for s in header['sizes'].split()]
+
+  dataFile = header.get('data file', header.get('datafile'))
+  if dataFile:
+    with open(os.path.join(os.path.dirname(path), dataFile), 'rb') as f:
+      data = f.read()
+  encoding = header.get('encoding', 'raw').lower()
+  if encoding in ('gzip', 'gz'):
+    data = gzip.decompress(data)
+  elif encoding != 'raw':
+    raise ValueError('%s: unsupported NRRD encoding %s' % (path, encoding))
+
+  dtype = np.dtype(NRRD_TYPES[header['type'].lower()])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('<' if header.get('endian', 'little').lower() == 'little' else '>')
+  labels = np.frombuffer(data, dtype=dtype, count=int(np.prod(sizes))).reshape(sizes[::-1])
+
+  ijkToRas = np.eye(4)
+  if 'space directions' in header:
+    directions = [parseVector(d) for d in re.findall(r'\(([^)]*)\)', header['space directions'])]
+    ijkToRas[:3, :3] = np.array(directions).T
+  elif 'spacings' in header:
+    ijkToRas[:3, :3] = np.diag([float(s) for s in header['spacings'].split()])
+  if 'space origin' in header:
+    ijkToRas[:3, 3] = parseVector(header['space origin'])
+  space = header.get('space', 'right-anterior-superior').lower()
+  if space in ('left-posterior-superior', 'lps'):
+    ijkToRas = LPS_TO_RAS.dot(ijkToRas)
+  return labels, ijkToRas
+
+def readFcsv(path):
+  """Read a Slicer markups fiducial file.
+  Returns (names, points): the fiducial labels and an (N,3) RAS array.
+  """
+  names = []
+  points = []
+  lps = False
+  columns = None
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      if line.startswith('#'):
+        if 'CoordinateSystem' in line:
+          system = line.split('=')[-1].strip()
+          lps = system in ('1', 'LPS')
+        elif line.startswith('# columns'):
+          columns = [c.strip() for c in line.split('=', 1)[1].split(',')]
+        continue
+      values = line.split(',')
+      if columns:
+        row = dict(zip(columns, values))
+        points.append([float(row['x']), float(row['y']), float(row['z'])])
+        names.append(row.get('label', ''))
+      else:
+        points.append([float(v) for v in values[1:4]])
+        names.append(values[11] if len(values) > 11 else '')
+  points = np.array(points, dtype=float).reshape(-1, 3)
+  if lps:
+    points[:, :2] *= -1
+  return names, points
+
+def readModel(path):
+  """Read a mesh (.vtk, .vtp, .stl, .ply or .obj) as vtkPolyData in RAS.
+  Legacy VTK files written by Slicer in LPS are converted.
+  """
+  import vtk
+  extension = os.path.splitext(path)[1].lower()
+  readers = {'.vtk': vtk.vtkPolyDataReader, '.vtp': vtk.vtkXMLPolyDataReader, '.stl': vtk.vtkSTLReader,
+             '.ply': vtk.vtkPLYReader, '.obj': vtk.vtkOBJReader}
+  if extension not in readers:
+    raise ValueError('%s: unsupported model format' % path)
+  reader = readers[extension]()
+  reader.SetFileName(path)
+  reader.Update()
+  poly = reader.GetOutput()
+
+  lps = False
+  if extension == '.vtk':
+    with open(path, 'rb') as f:
+      f.readline()
+      lps = b'SPACE=LPS' in f.readline()
+  if lps:
+    flip = vtk.vtkTransform()
+    flip.Scale(-1.0, -1.0, 1.0)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(flip)
+    transformFilter.SetInputData(poly)
+    transformFilter.Update()
+    poly = transformFilter.GetOutput()
+  return poly
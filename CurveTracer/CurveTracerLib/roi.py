@@ -0,0 +1,97 @@
+"""Cropping of label maps to the region around a trajectory.
+
+A trajectory only touches a thin tube of voxels, so lookups can work on a
+small sub-block of the label map. Crops are zero-copy views whenever
+possible; a block is only materialized when the label map has to be
+resampled or narrowed to a smaller dtype.
+"""
+
+import numpy as np
+
+from . import geometry
+
+
+def narrowestDtype(low, high):
+  """Smallest integer dtype that holds every value in [low, high]
+  """
+  for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+    info = np.iinfo(dtype)
+    if info.min <= low and high <= info.max:
+      return np.dtype(dtype)
+  return np.dtype(np.int64)
+
+def narrowLabels(labels, valueRange=None):
+  """Return labels in the narrowest integer dtype that holds them, as a
+  copy only when that dtype is narrower or labels are not integers.
+  valueRange, (low, high) bounds of the labels when already known, saves
+  scanning them.
+  """
+  if valueRange is None and labels.size:
+    valueRange = (labels.min(), labels.max())
+  dtype = narrowestDtype(*valueRange) if valueRange is not None else np.dtype(np.uint8)
+  if labels.dtype.kind in 'iu' and labels.dtype.itemsize <= dtype.itemsize:
+    return labels
+  return labels.astype(dtype)
+
+def shiftMatrix(rasToIjk, lower):
+  """RAS to IJK matrix of the sub-block starting at voxel lower, [k, j, i]
+  """
+  shift = np.identity(4)
+  shift[:3, 3] = -np.asarray(lower)[::-1]
+  return shift.dot(rasToIjk)
+
+def trajectoryBox(shape, rasToIjk, points, margin=1):
+  """Return (lower, upper), the [k, j, i] bounds of the voxels of a volume
+  of the given shape within margin voxels of the bounding box of points,
+  or None if the box misses the volume
+  """
+  ijk = geometry.transformPoints(rasToIjk, points)
+  if len(ijk) == 0:
+    return None
+  lower = np.maximum(np.floor(np.min(ijk, axis=0)).astype(int)[::-1] - margin, 0)
+  upper = np.minimum(np.ceil(np.max(ijk, axis=0)).astype(int)[::-1] + margin + 1, shape)
+  if np.any(upper <= lower):
+    return None
+  return lower, upper
+
+def cropLabels(labels, rasToIjk, points, margin=1, narrow=False, pyramid=None):
+  """Return (block, blockRasToIjk): a zero-copy view of the voxels within
+  margin voxels of the bounding box of points and its RAS to IJK matrix.
+  Lookups of points inside the box give the same values on the block as
+  on the whole label map. With narrow, a wide dtype is copied into the
+  narrowest integer dtype that holds the block, whose range is read from
+  the occupancy.OccupancyPyramid of labels if given.
+  """
+  box = trajectoryBox(labels.shape, rasToIjk, points, margin)
+  if box is None:
+    return labels[:0, :0, :0], rasToIjk
+  lower, upper = box
+  block = labels[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+  if narrow:
+    block = narrowLabels(block, pyramid.valueRange(lower, upper) if pyramid else None)
+  return block, shiftMatrix(rasToIjk, lower)
+
+def resampleBlock(imageData, outputToInput, lower, upper):
+  """Nearest neighbor resampling of the block [lower, upper) ([k, j, i])
+  of an output lattice whose voxel indices are mapped to the IJK indices
+  of imageData by outputToInput, a vtkAbstractTransform. Voxels that map
+  outside of imageData are 0.
+  Returns the block in the narrowest integer dtype that holds it.
+  """
+  import vtk
+  from . import conversion
+  input = vtk.vtkImageData()
+  input.ShallowCopy(imageData)
+  input.SetOrigin(0.0, 0.0, 0.0)
+  input.SetSpacing(1.0, 1.0, 1.0)
+
+  reslice = vtk.vtkImageReslice()
+  reslice.SetInputData(input)
+  reslice.SetResliceTransform(outputToInput)
+  reslice.SetInterpolationModeToNearestNeighbor()
+  reslice.SetBackgroundLevel(0.0)
+  reslice.SetOutputOrigin(0.0, 0.0, 0.0)
+  reslice.SetOutputSpacing(1.0, 1.0, 1.0)
+  reslice.SetOutputExtent(lower[2], upper[2] - 1, lower[1], upper[1] - 1, lower[0], upper[0] - 1)
+  reslice.Update()
+  return narrowLabels(conversion.arrayFromImageData(reslice.GetOutput()))
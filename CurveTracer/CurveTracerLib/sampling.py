@@ -0,0 +1,43 @@
+"""Batched voxel lookup in label maps.
+
+Label maps are NumPy arrays indexed [k, j, i], as returned by
+slicer.util.arrayFromVolume or conversion.arrayFromImageData.
+"""
+
+import numpy as np
+
+from . import geometry
+
+# One row per target point: its voxel value, whether it lies within the
+# volume and whether it lies inside a labeled structure
+TARGET_DTYPE = np.dtype([('label', object), ('value', np.int64), ('inBounds', np.bool_), ('inside', np.bool_)])
+
+
+def sampleLabels(labels, rasToIjk, points):
+  """Look up the label map at a batch of RAS points in one pass.
+  Returns (values, inBounds); points outside the volume are not read,
+  their value is 0 and their inBounds flag is False.
+  """
+  points = geometry.asPoints(points)
+  ijk = np.rint(geometry.transformPoints(rasToIjk, points)).astype(int)
+
+  inBounds = np.all((ijk >= 0) & (ijk < labels.shape[::-1]), axis=1)
+  values = np.zeros(len(points), dtype=labels.dtype)
+  ijk = ijk[inBounds]
+  values[inBounds] = labels[ijk[:, 2], ijk[:, 1], ijk[:, 0]]
+  return values, inBounds
+
+def targetResults(labels, rasToIjk, points, names):
+  """Voxel lookup for a list of named targets in one call.
+  Returns a structured array (TARGET_DTYPE) with one row per target.
+  Without a label map (labels is None) all targets are reported out of
+  the volume.
+  """
+  results = np.zeros(len(names), dtype=TARGET_DTYPE)
+  results['label'] = names
+  if labels is not None:
+    values, inBounds = sampleLabels(labels, rasToIjk, points)
+    results['value'] = values
+    results['inBounds'] = inBounds
+    results['inside'] = values != 0
+  return results
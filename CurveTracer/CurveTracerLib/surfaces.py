@@ -0,0 +1,182 @@
+"""Surfaces of label map structures, extracted on demand.
+
+Entry angles need a mesh of every structure a trajectory enters. Instead of
+meshing a whole atlas up front, a surface is only extracted for a label the
+trajectory crosses, over a block of voxels around the crossing, and kept in
+a SurfaceCache.
+"""
+
+import collections
+import threading
+import time
+
+import numpy as np
+import vtk
+
+from . import conversion
+from . import distance
+from . import geometry
+from . import profiling
+from . import tracing
+
+# One row per label crossed by a straight trajectory, ordered along it
+LABEL_ANGLE_DTYPE = np.dtype([('label', np.int64), ('angle', np.float64), ('arcLength', np.float64),
+                              ('lower', np.int64, 3), ('upper', np.int64, 3)])
+
+
+def crossingBlocks(labels, rasToIjk, pos0, posN, margin=3, blockSize=32):
+  """Labels crossed by the straight line pos0-posN, ordered by the arc
+  length of their first voxel, and the [k, j, i] block [lower, upper) of
+  voxels around their crossings. Blocks are grown by margin voxels and
+  snapped to multiples of blockSize, so that small moves of the line keep
+  the same blocks.
+  Returns a structured array (LABEL_ANGLE_DTYPE) with angles set to 0.0.
+  """
+  entries, exits, ijk = tracing.traceVoxels(labels.shape[::-1], rasToIjk, [pos0, posN])
+  kji = ijk[:, ::-1]
+  values = labels[kji[:, 0], kji[:, 1], kji[:, 2]]
+  crossed, first = np.unique(values, return_index=True)
+  order = np.argsort(first[crossed != 0])
+  crossed = crossed[crossed != 0][order]
+
+  blocks = np.zeros(len(crossed), dtype=LABEL_ANGLE_DTYPE)
+  shape = np.array(labels.shape)
+  for i, label in enumerate(crossed):
+    voxels = kji[values == label]
+    lower = (np.min(voxels, axis=0) - margin) // blockSize * blockSize
+    upper = -(-(np.max(voxels, axis=0) + margin + 1) // blockSize) * blockSize
+    blocks['label'][i] = label
+    blocks['arcLength'][i] = entries[values == label][0]
+    blocks['lower'][i] = np.maximum(lower, 0)
+    blocks['upper'][i] = np.minimum(upper, shape)
+  return blocks
+
+def labelSurface(block, label, lower, ijkToRas, smoothing=0, decimation=0.0):
+  """Surface of label in block, the voxels of a label map starting at the
+  [k, j, i] voxel lower, in the RAS coordinates of ijkToRas. The block is
+  padded with background so the surface is closed. smoothing is the
+  number of windowed sinc iterations (0 to disable) and decimation the
+  fraction of triangles to remove.
+  """
+  mask = np.zeros(np.array(block.shape) + 2, dtype=np.uint8)
+  mask[1:-1, 1:-1, 1:-1] = block == label
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(mask.shape[::-1])
+  imageData.SetOrigin(np.asarray(lower, dtype=float)[::-1] - 1.0)
+  imageData.GetPointData().SetScalars(conversion.dataArrayFromArray(mask.ravel(), 'Mask'))
+
+  cubes = vtk.vtkDiscreteMarchingCubes()
+  cubes.SetInputData(imageData)
+  cubes.SetValue(0, 1)
+  cubes.ComputeNormalsOff()
+  cubes.ComputeGradientsOff()
+  cubes.ComputeScalarsOff()
+  output = cubes.GetOutputPort()
+
+  if smoothing > 0:
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(output)
+    smoother.SetNumberOfIterations(smoothing)
+    smoother.SetPassBand(0.01)
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    output = smoother.GetOutputPort()
+
+  if decimation > 0.0:
+    decimator = vtk.vtkDecimatePro()
+    decimator.SetInputConnection(output)
+    decimator.SetTargetReduction(decimation)
+    decimator.PreserveTopologyOn()
+    output = decimator.GetOutputPort()
+
+  algorithm = output.GetProducer()
+  algorithm.Update()
+  surface = vtk.vtkPolyData()
+  surface.ShallowCopy(algorithm.GetOutputDataObject(0))
+
+  # Voxel coordinates to RAS
+  if surface.GetNumberOfPoints():
+    points = vtk.vtkPoints()
+    ras = geometry.transformPoints(ijkToRas, conversion.arrayFromPoints(surface.GetPoints()))
+    points.SetData(conversion.dataArrayFromArray(ras, 'Points'))
+    surface.SetPoints(points)
+  return surface
+
+
+class SurfaceCache(object):
+  """Keeps the surfaces of labels, keyed by the content hash of the label
+  map, the label, the block and the extraction parameters, so a surface is
+  only extracted once per label map state. Least recently used surfaces
+  are evicted once their memory exceeds the budget. Like the LocatorCache,
+  it can be shared by worker threads.
+  """
+
+  def __init__(self, memoryBudget=128 * 1024 * 1024):
+    self.memoryBudget = memoryBudget
+    self.entries = collections.OrderedDict()
+    self.memorySize = 0
+    self.hits = 0
+    self.misses = 0
+    self.buildTime = 0.0
+    self.lock = threading.RLock()
+    self.buildLocks = {}
+
+  def getSurface(self, block, label, lower, ijkToRas, smoothing=0, decimation=0.0, labelsHash=None):
+    """Return (key, surface), the labelSurface of label in block and the
+    key it is stored under. labelsHash is the content hash of the label map
+    the block was cut from; without it, the block itself is hashed.
+    """
+    if labelsHash is None:
+      labelsHash = distance.contentHash(block)
+    upper = np.asarray(lower) + block.shape
+    key = (labelsHash, int(label), tuple(int(x) for x in lower), tuple(int(x) for x in upper),
+           tuple(np.round(ijkToRas, 6).ravel()), int(smoothing), float(decimation))
+    with self.lock:
+      buildLock = self.buildLocks.setdefault(key, threading.Lock())
+
+    with buildLock:
+      with self.lock:
+        surface = self.entries.get(key)
+        if surface is not None:
+          self.hits += 1
+          profiling.profiler.count('SurfaceCacheHit')
+          self.entries.move_to_end(key)
+          return key, surface
+        self.misses += 1
+        profiling.profiler.count('SurfaceCacheMiss')
+
+      startTime = time.time()
+      with profiling.profiler.timer('SurfaceBuild'):
+        surface = labelSurface(block, label, lower, ijkToRas, smoothing, decimation)
+      self.buildTime += time.time() - startTime
+
+      with self.lock:
+        self.entries[key] = surface
+        self.memorySize += surface.GetActualMemorySize() * 1024
+        self.evict()
+    return key, surface
+
+  def evict(self):
+    """Drop least recently used surfaces until the cache fits in the budget.
+    The most recent entry is always kept.
+    """
+    with self.lock:
+      while self.memorySize > self.memoryBudget and len(self.entries) > 1:
+        key, surface = self.entries.popitem(last=False)
+        self.buildLocks.pop(key, None)
+        self.memorySize -= surface.GetActualMemorySize() * 1024
+
+  def setMemoryBudget(self, memoryBudget):
+    self.memoryBudget = memoryBudget
+    self.evict()
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.memorySize = 0
+
+  def statistics(self):
+    return {'entries': len(self.entries), 'memorySize': self.memorySize, 'memoryBudget': self.memoryBudget,
+            'hits': self.hits, 'misses': self.misses, 'buildTime': self.buildTime}
@@ -0,0 +1,319 @@
+"""Structures within the radius of a tool swept along a trajectory.
+
+A needle or cannula is not a line: it touches every structure within its
+radius of the trajectory. Labels are found by rasterizing that capsule into
+the label map: candidate voxels are only gathered slice by slice in the
+rectangles around each segment, then kept by their exact distance to the
+trajectory. Meshes are found from the exact distance between the segments
+of the trajectory and the triangles whose bounds, grown by the radius, the
+segments touch. The same distance, bounded by a search radius, gives the
+closest approach of the trajectory to every mesh.
+"""
+
+import numpy as np
+
+from . import boxes
+from . import conversion
+from . import distance
+from . import geometry
+from . import normals
+
+# One row per structure within the radius of the trajectory: the smallest
+# distance between the centerline and the structure (0 when it is crossed),
+# how far the tool reaches into it (radius - distance), the arc length of
+# the closest point and, for labels, the number of voxels inside the tool.
+SWEEP_DTYPE = np.dtype([('source', 'U5'), ('structure', np.int64), ('distance', np.float64),
+                        ('penetration', np.float64), ('arcLength', np.float64), ('voxels', np.int64)])
+
+# One row per mesh: the smallest distance between the trajectory and the
+# mesh, the arc length where it occurs and the closest points on both.
+# Meshes further than the search radius are reported at that distance,
+# with NaN points.
+PROXIMITY_DTYPE = np.dtype([('structure', np.int64), ('distance', np.float64), ('arcLength', np.float64),
+                            ('trajectoryPoint', np.float64, 3), ('surfacePoint', np.float64, 3)])
+
+
+def segmentCandidates(dims, a, b, reach):
+  """Voxels (N,3) of a volume of dims (I, J, K) that may lie within reach
+  voxels along each axis of the IJK segment a-b. The segment is cut into
+  one slice per voxel along its main axis, and every slice gets the
+  rectangle of voxels around its part of the segment.
+  """
+  d = b - a
+  axis = int(np.argmax(np.abs(d)))
+  others = [other for other in range(3) if other != axis]
+  low = max(int(np.ceil(min(a[axis], b[axis]) - reach[axis])), 0)
+  high = min(int(np.floor(max(a[axis], b[axis]) + reach[axis])), dims[axis] - 1)
+  if high < low:
+    return np.zeros((0, 3), dtype=int)
+  slices = np.arange(low, high + 1)
+
+  # Part of the segment within reach of each slice along the main axis
+  if d[axis] != 0:
+    t0 = np.clip((slices - reach[axis] - a[axis]) / d[axis], 0.0, 1.0)
+    t1 = np.clip((slices + reach[axis] - a[axis]) / d[axis], 0.0, 1.0)
+  else:
+    t0 = np.zeros(len(slices))
+    t1 = np.ones(len(slices))
+  p0 = a[others] + t0[:, np.newaxis] * d[others]
+  p1 = a[others] + t1[:, np.newaxis] * d[others]
+  lower = np.maximum(np.ceil(np.minimum(p0, p1) - reach[others]).astype(int), 0)
+  upper = np.minimum(np.floor(np.maximum(p0, p1) + reach[others]).astype(int), dims[others] - 1)
+  sizes = np.maximum(upper - lower + 1, 0)
+  counts = sizes[:, 0] * sizes[:, 1]
+
+  # All voxels of all rectangles at once
+  rows = np.repeat(np.arange(len(slices)), counts)
+  position = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+  ijk = np.zeros((len(rows), 3), dtype=int)
+  ijk[:, axis] = slices[rows]
+  ijk[:, others[0]] = lower[rows, 0] + position // np.maximum(sizes[rows, 1], 1)
+  ijk[:, others[1]] = lower[rows, 1] + position % np.maximum(sizes[rows, 1], 1)
+  return ijk
+
+def capsuleVoxels(shape, rasToIjk, points, radius):
+  """Voxels of a volume of the given shape ([k, j, i]) whose centers lie
+  within radius mm of the RAS polyline points. The candidates of each
+  segment are measured against the whole polyline and kept only by their
+  closest segment, so every voxel is reported once.
+  Returns (ijk, distances, arcLength): the (N,3) voxel indices, their
+  distance to the polyline and the arc length of their closest point.
+  """
+  points = geometry.asPoints(points)
+  inverse = np.linalg.inv(rasToIjk)
+  ijkPoints = geometry.transformPoints(rasToIjk, points)
+  if len(ijkPoints) == 1:
+    ijkPoints = np.concatenate([ijkPoints, ijkPoints])
+  reach = distance.voxelReach(rasToIjk, radius)
+  dims = np.array(shape[::-1])
+  arcStart = geometry.arcLengths(points)[1]
+
+  parts = [(np.zeros((0, 3), dtype=int), np.zeros(0), np.zeros(0))]
+  for i in range(len(ijkPoints) - 1):
+    ijk = segmentCandidates(dims, ijkPoints[i], ijkPoints[i+1], reach)
+    distances, feet, segments = geometry.closestPoints(points, geometry.transformPoints(inverse, ijk))
+    keep = (distances <= radius) & (segments == i)
+    segments = segments[keep]
+    arcLength = arcStart[segments] + np.sqrt(np.sum((feet[keep] - points[segments]) ** 2, axis=1))
+    parts.append((ijk[keep], distances[keep], arcLength))
+  return tuple(np.concatenate(part) for part in zip(*parts))
+
+def sweptLabels(labels, rasToIjk, points, radius):
+  """Labels with voxels within radius mm of the RAS polyline points, as
+  structured array rows (SWEEP_DTYPE) ordered by label. Distances are
+  measured to the voxel centers.
+  """
+  ijk, distances, arcLength = capsuleVoxels(labels.shape, rasToIjk, points, radius)
+  values = labels[ijk[:, 2], ijk[:, 1], ijk[:, 0]]
+  labeled = values != 0
+  values = values[labeled]
+  distances = distances[labeled]
+  arcLength = arcLength[labeled]
+
+  # Sort by label, then by distance, so the first voxel of a label is its closest
+  order = np.lexsort((distances, values))
+  found, first, counts = np.unique(values[order], return_index=True, return_counts=True)
+  rows = np.zeros(len(found), dtype=SWEEP_DTYPE)
+  rows['source'] = 'label'
+  rows['structure'] = found
+  rows['distance'] = distances[order][first]
+  rows['penetration'] = radius - rows['distance']
+  rows['arcLength'] = arcLength[order][first]
+  rows['voxels'] = counts
+  return rows
+
+def dot(u, v):
+  return np.sum(u * v, axis=-1)
+
+def segmentDistances(p, u, q, v):
+  """Squared distances between the segments p + s u and q + t v, s and t in
+  [0, 1], and the parameters s and t of their closest points. Arrays of
+  segments are broadcast.
+  """
+  w = p - q
+  a = dot(u, u)
+  b = dot(u, v)
+  c = dot(v, v)
+  d = dot(u, w)
+  e = dot(v, w)
+  eps = 1e-12
+  safeA = np.where(a > eps, a, 1.0)
+  safeC = np.where(c > eps, c, 1.0)
+  denominator = a * c - b * b
+  parallel = denominator <= eps * np.maximum(a * c, eps)
+
+  # Closest points of the lines, clamped to the first segment, then to the second
+  s = np.where(parallel, 0.0, np.clip((b * e - c * d) / np.where(parallel, 1.0, denominator), 0.0, 1.0))
+  t = (b * s + e) / safeC
+  s = np.where(t < 0.0, np.clip(-d / safeA, 0.0, 1.0), np.where(t > 1.0, np.clip((b - d) / safeA, 0.0, 1.0), s))
+  t = np.clip(t, 0.0, 1.0)
+
+  # Degenerate segments are points
+  s, t = (np.where(a <= eps, 0.0, np.where(c <= eps, np.clip(-d / safeA, 0.0, 1.0), s)),
+          np.where(c <= eps, 0.0, np.where(a <= eps, np.clip(e / safeC, 0.0, 1.0), t)))
+  difference = w + s[..., np.newaxis] * u - t[..., np.newaxis] * v
+  return dot(difference, difference), s, t
+
+def projectedDistances(p, a, b, c):
+  """Squared distances from the points p to the planes of the triangles
+  abc where p projects inside the triangle, infinity elsewhere, and the
+  projections of p
+  """
+  e1 = b - a
+  e2 = c - a
+  n = np.cross(e1, e2)
+  nn = dot(n, n)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    height = dot(p - a, n) / nn
+    foot = p - height[..., np.newaxis] * n - a
+    d00 = dot(e1, e1)
+    d01 = dot(e1, e2)
+    d11 = dot(e2, e2)
+    d20 = dot(foot, e1)
+    d21 = dot(foot, e2)
+    v = (d11 * d20 - d01 * d21) / nn
+    w = (d00 * d21 - d01 * d20) / nn
+  inside = (nn > 0) & (v >= 0.0) & (w >= 0.0) & (v + w <= 1.0)
+  return np.where(inside, height ** 2 * nn, np.inf), foot + a
+
+def segmentCrossings(p, u, a, b, c):
+  """Parameter s in [0, 1] where the segments p + s u cross the triangles
+  abc, NaN where they do not (Moller-Trumbore)
+  """
+  e1 = b - a
+  e2 = c - a
+  h = np.cross(u, e2)
+  determinant = dot(e1, h)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    f = 1.0 / determinant
+    r = p - a
+    v = f * dot(r, h)
+    q = np.cross(r, e1)
+    w = f * dot(u, q)
+    s = f * dot(e2, q)
+    crossing = (np.abs(determinant) > 1e-12) & (v >= 0.0) & (w >= 0.0) & (v + w <= 1.0) & (s >= 0.0) & (s <= 1.0)
+  return np.where(crossing, s, np.nan)
+
+def meshTriangles(poly):
+  """Corners of the triangles of poly as a (T,3,3) array. Cells with fewer
+  than three points are left out.
+  """
+  if poly.GetNumberOfPoints() == 0:
+    return np.zeros((0, 3, 3))
+  corners = normals.cellCorners(poly)
+  corners = corners[corners[:, 0] >= 0]
+  return np.asarray(conversion.arrayFromPoints(poly.GetPoints()), dtype=float)[corners]
+
+def closestPair(points, segments, triangles):
+  """Return (squaredDistance, pair, s, trajectoryPoint, surfacePoint) of
+  the closest of the pairs of segments (indices into the polyline points)
+  and (N,3,3) triangles, s being the parameter along its segment. Ties go
+  to the pair closest to the start of the polyline.
+  """
+  a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+  p = points[segments]
+  u = points[segments + 1] - p
+
+  # Crossed triangles, the end points above the triangles, and the edges,
+  # as (squared distances, parameters along the segment, surface points)
+  crossings = np.nan_to_num(segmentCrossings(p, u, a, b, c), nan=-1.0)
+  candidates = [(np.where(crossings < 0.0, np.inf, 0.0), np.clip(crossings, 0.0, 1.0),
+                 p + np.clip(crossings, 0.0, 1.0)[:, np.newaxis] * u)]
+  for s, end in ((0.0, p), (1.0, p + u)):
+    squared, feet = projectedDistances(end, a, b, c)
+    candidates.append((squared, np.full(len(a), s), feet))
+  for start, end in ((a, b), (b, c), (c, a)):
+    squared, s, t = segmentDistances(p, u, start, end - start)
+    candidates.append((squared, s, start + t[:, np.newaxis] * (end - start)))
+  squaredDistances = np.stack([candidate[0] for candidate in candidates])
+  positions = segments + np.stack([candidate[1] for candidate in candidates])
+  positions[squaredDistances > np.min(squaredDistances)] = np.inf
+  kind, pair = np.unravel_index(np.argmin(positions), positions.shape)
+  s = candidates[kind][1][pair]
+  return squaredDistances[kind, pair], pair, s, p[pair] + s * u[pair], candidates[kind][2][pair]
+
+def meshDistance(poly, points, radius, triangles=None, batchSize=1 << 20):
+  """Return (distance, arcLength, trajectoryPoint, surfacePoint): the
+  smallest distance between the RAS polyline points and the triangles of
+  poly, the arc length of its closest point, and the closest points on the
+  polyline and on the mesh, or None if the mesh is further than radius.
+  The closest corner of the mesh bounds the distance from above: only the
+  pairs of segments and triangles whose bounds, grown by that bound or by
+  radius, touch are measured. The triangles are measured in batches of at
+  most batchSize segment-triangle pairs, and the bound shrinks to the
+  closest pair found so far. Ties go to the point closest to the start of
+  the polyline. triangles are the meshTriangles of poly, if
+  already known.
+  """
+  points = geometry.asPoints(points)
+  if triangles is None:
+    triangles = meshTriangles(poly)
+  if len(points) < 2 or len(triangles) == 0:
+    return None
+  lengths, arcStart = geometry.arcLengths(points)
+  bound = min(radius, np.min(geometry.closestPoints(points, triangles[:, 0], batchSize=batchSize)[0])) + 1e-6
+  best = None
+  batch = max(1, batchSize // (len(points) - 1))
+  for start in range(0, len(triangles), batch):
+    chunk = triangles[start:start + batch]
+    segments, near = np.nonzero(geometry.segmentsTouchBoxes(points, np.min(chunk, axis=1) - bound,
+                                                            np.max(chunk, axis=1) + bound))
+    if len(segments) == 0:
+      continue
+    squared, pair, s, trajectoryPoint, surfacePoint = closestPair(points, segments, chunk[near])
+    if best is None or (squared, segments[pair] + s) < (best[0], best[1] + best[2]):
+      best = (squared, segments[pair], s, trajectoryPoint, surfacePoint)
+      bound = min(bound, np.sqrt(squared) + 1e-6)
+  if best is None:
+    return None
+  squared, segment, s, trajectoryPoint, surfacePoint = best
+  smallest = np.sqrt(squared)
+  if smallest > radius:
+    return None
+  return smallest, arcStart[segment] + s * lengths[segment], trajectoryPoint, surfacePoint
+
+def sweptMeshes(polys, points, radius):
+  """Meshes of polys within radius mm of the RAS polyline points, as
+  structured array rows (SWEEP_DTYPE) whose structure indexes polys
+  """
+  rows = []
+  for index in boxes.nearMeshes(polys, points, radius):
+    found = meshDistance(polys[index], points, radius)
+    if found is not None:
+      rows.append(('model', index, found[0], radius - found[0], found[1], 0))
+  return np.array(rows, dtype=SWEEP_DTYPE)
+
+def farProximities(count, maxDistance):
+  """Rows (PROXIMITY_DTYPE) of count structures further than maxDistance
+  mm, without closest points
+  """
+  rows = np.zeros(count, dtype=PROXIMITY_DTYPE)
+  rows['structure'] = np.arange(count)
+  rows['distance'] = maxDistance
+  rows['trajectoryPoint'] = np.nan
+  rows['surfacePoint'] = np.nan
+  return rows
+
+def meshProximity(index, poly, points, maxDistance, triangles=None):
+  """Closest approach of the RAS polyline points to poly, as a structured
+  array row (PROXIMITY_DTYPE) of structure index. triangles are the
+  meshTriangles of poly, if already known.
+  """
+  rows = farProximities(1, maxDistance)
+  rows['structure'] = index
+  found = meshDistance(poly, points, maxDistance, triangles)
+  if found is not None:
+    rows[0] = (index,) + found
+  return rows[0]
+
+def meshProximities(polys, points, maxDistance, triangles=None):
+  """Closest approach of the RAS polyline points to each of polys, as
+  structured array rows (PROXIMITY_DTYPE) in the order of polys. Meshes
+  whose bounds are further than maxDistance mm are not measured.
+  triangles are the meshTriangles of polys, if already known.
+  """
+  rows = farProximities(len(polys), maxDistance)
+  for index in boxes.nearMeshes(polys, points, maxDistance):
+    rows[index] = meshProximity(index, polys[index], points, maxDistance,
+                                None if triangles is None else triangles[index])
+  return rows
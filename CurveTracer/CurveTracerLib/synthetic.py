@@ -0,0 +1,97 @@
+"""Deterministic synthetic data for tests and benchmarks.
+
+Label maps, meshes and trajectories are generated from a seed, so that
+benchmark runs on different machines and revisions see the same inputs.
+"""
+
+import numpy as np
+
+
+def labelMap(size, nOfLabels=8, dtype=np.uint8, spacing=1.0):
+  """Label map of size^3 voxels with nOfLabels nested ellipsoids centered
+  in the volume, label n + 1 being the n-th (smaller) shell.
+  Returns (labels, rasToIjk) with labels indexed [k, j, i].
+  The volume is filled slice by slice to keep the peak memory at one copy
+  of the label map, even for 1024^3 volumes.
+  """
+  labels = np.zeros((size, size, size), dtype=dtype)
+  center = (size - 1) / 2.0
+  radii = np.array([0.45, 0.35, 0.40]) * size
+  # Squared scale of each shell in ascending order (innermost shell first)
+  scales = ((1.0 - np.arange(nOfLabels) / float(nOfLabels)) ** 2)[::-1]
+
+  j, i = np.mgrid[0:size, 0:size]
+  inPlane = ((i - center) / radii[0]) ** 2 + ((j - center) / radii[1]) ** 2
+  for k in range(size):
+    r2 = inPlane + ((k - center) / radii[2]) ** 2
+    # The label is the number of shells containing the voxel
+    labels[k] = nOfLabels - np.searchsorted(scales, r2, side='left')
+
+  rasToIjk = np.diag([1.0 / spacing, 1.0 / spacing, 1.0 / spacing, 1.0])
+  return labels, rasToIjk
+
+def sphere(nOfTriangles, center=(0.0, 0.0, 0.0), radius=10.0):
+  """Triangulated sphere with approximately nOfTriangles triangles
+  """
+  import vtk
+  resolution = max(4, int(round(np.sqrt(nOfTriangles / 2.0))))
+  source = vtk.vtkSphereSource()
+  source.SetCenter(*center)
+  source.SetRadius(radius)
+  source.SetThetaResolution(resolution)
+  source.SetPhiResolution(resolution + 2)
+  source.Update()
+  return source.GetOutput()
+
+def atlas(nOfStructures, nOfTriangles, extent=100.0, seed=0):
+  """List of nOfStructures spheres of random size and position within a
+  cube of the given extent, with nOfTriangles triangles in total
+  """
+  rng = np.random.RandomState(seed)
+  centers = rng.uniform(0.1 * extent, 0.9 * extent, (nOfStructures, 3))
+  radii = rng.uniform(0.02 * extent, 0.08 * extent, nOfStructures)
+  perStructure = max(8, nOfTriangles // nOfStructures)
+  return [sphere(perStructure, centers[n], radii[n]) for n in range(nOfStructures)]
+
+def trajectory(nOfPoints, entry, target, amplitude=2.0, seed=0):
+  """Gently curved polyline of nOfPoints points from entry to target
+  """
+  rng = np.random.RandomState(seed)
+  entry = np.asarray(entry, dtype=float)
+  target = np.asarray(target, dtype=float)
+  t = np.linspace(0.0, 1.0, nOfPoints)[:, np.newaxis]
+  points = entry + t * (target - entry)
+
+  # Bend the path perpendicular to its direction, keeping both ends fixed
+  direction = (target - entry) / np.sqrt(np.sum((target - entry) ** 2))
+  normal = np.cross(direction, rng.normal(size=3))
+  normal /= np.sqrt(np.sum(normal ** 2))
+  return points + amplitude * np.sin(np.pi * t) * normal
+
+def targets(nOfTargets, low, high, seed=0):
+  """Uniformly distributed (nOfTargets, 3) points within [low, high]
+  """
+  rng = np.random.RandomState(seed)
+  return rng.uniform(low, high, (nOfTargets, 3))
+
+def toolPoses(nOfPoses, entry, target, jitter=0.5, seed=0):
+  """(nOfPoses, 4, 4) tool to RAS matrices of a needle inserted from entry
+  to target, as streamed by a tracker: the tip (the origin) advances along
+  the line with jitter mm of noise and the tool z axis points from entry
+  to target.
+  """
+  rng = np.random.RandomState(seed)
+  entry = np.asarray(entry, dtype=float)
+  target = np.asarray(target, dtype=float)
+  t = np.linspace(0.0, 1.0, nOfPoses)[:, np.newaxis]
+  tips = entry + t * (target - entry) + rng.normal(scale=jitter, size=(nOfPoses, 3))
+
+  z = (target - entry) / np.sqrt(np.sum((target - entry) ** 2))
+  x = np.cross([0.0, 1.0, 0.0] if abs(z[1]) < 0.9 else [1.0, 0.0, 0.0], z)
+  x /= np.sqrt(np.sum(x ** 2))
+  poses = np.tile(np.identity(4), (nOfPoses, 1, 1))
+  poses[:, :3, 0] = x
+  poses[:, :3, 1] = np.cross(z, x)
+  poses[:, :3, 2] = z
+  poses[:, :3, 3] = tips
+  return poses
@@ -0,0 +1,107 @@
+"""Exact voxel traversal of polyline trajectories through label maps."""
+
+import numpy as np
+
+from . import geometry
+
+# One row per run of identical labels along a traced trajectory
+TRACE_DTYPE = np.dtype([('label', np.int64), ('entry', np.float64), ('exit', np.float64), ('voxels', np.int64)])
+
+
+def traceSegment(shape, a, b):
+  """Exact voxel traversal (Amanatides-Woo) of the segment a-b given in IJK,
+  shape being the (I, J, K) dimensions of the volume.
+  All voxel boundary crossings are computed at once and sorted instead of
+  stepping voxel by voxel. Returns (tEntry, tExit, ijk) for every voxel
+  crossed, t being the parametric position along the segment in [0, 1].
+  Parts of the segment outside of the volume are skipped.
+  """
+  shape = np.asarray(shape)
+  d = b - a
+  empty = (np.zeros(0), np.zeros(0), np.zeros((0, 3), dtype=int))
+
+  # Clip the segment against the volume (voxel centers are at integer IJK)
+  moving = d != 0
+  if np.any(~moving & ((a < -0.5) | (a > shape - 0.5))):
+    return empty
+  tLo = (-0.5 - a[moving]) / d[moving]
+  tHi = (shape[moving] - 0.5 - a[moving]) / d[moving]
+  t0 = max([0.0] + list(np.minimum(tLo, tHi)))
+  t1 = min([1.0] + list(np.maximum(tLo, tHi)))
+  if t0 >= t1:
+    return empty
+
+  # Parametric positions of every voxel boundary plane crossed
+  crossings = [np.array([t0, t1])]
+  for axis in np.flatnonzero(moving):
+    p0, p1 = sorted([a[axis] + t0 * d[axis], a[axis] + t1 * d[axis]])
+    planes = np.arange(np.floor(p0 - 0.5) + 1, np.ceil(p1 - 0.5)) + 0.5
+    crossings.append((planes - a[axis]) / d[axis])
+  t = np.unique(np.concatenate(crossings))
+  t = t[(t >= t0) & (t <= t1)]
+
+  # Each interval between two crossings lies in exactly one voxel
+  tEntry = t[:-1]
+  tExit = t[1:]
+  keep = tExit - tEntry > 1e-12
+  tEntry = tEntry[keep]
+  tExit = tExit[keep]
+  tMid = 0.5 * (tEntry + tExit)
+  ijk = np.floor(a + tMid[:, np.newaxis] * d + 0.5).astype(int)
+  ijk = np.clip(ijk, 0, shape - 1)
+  return tEntry, tExit, ijk
+
+def traceVoxels(shape, rasToIjk, points):
+  """Traverse every segment of the RAS polyline points.
+  Returns (entries, exits, ijk): the arc lengths (mm from the first point)
+  at which the path enters and leaves each voxel, and the voxel indices.
+  """
+  points = geometry.asPoints(points)
+  ijkPoints = geometry.transformPoints(rasToIjk, points)
+  lengths, arcStart = geometry.arcLengths(points)
+
+  entries = [np.zeros(0)]
+  exits = [np.zeros(0)]
+  voxels = [np.zeros((0, 3), dtype=int)]
+  for i in range(len(points) - 1):
+    if lengths[i] == 0.0:
+      continue
+    tEntry, tExit, ijk = traceSegment(shape, ijkPoints[i], ijkPoints[i+1])
+    entries.append(arcStart[i] + tEntry * lengths[i])
+    exits.append(arcStart[i] + tExit * lengths[i])
+    voxels.append(ijk)
+  return np.concatenate(entries), np.concatenate(exits), np.concatenate(voxels)
+
+def runLengths(values, entries, exits, voxels):
+  """Merge consecutive voxels with the same label into runs.
+  Returns a structured array (TRACE_DTYPE).
+  """
+  if len(values) == 0:
+    return np.zeros(0, dtype=TRACE_DTYPE)
+
+  # A run ends where the label changes or where the path leaves the volume
+  newRun = np.ones(len(values), dtype=bool)
+  newRun[1:] = (values[1:] != values[:-1]) | (entries[1:] > exits[:-1] + 1e-6)
+  # The voxel at the junction of two segments is visited twice
+  newVoxel = np.ones(len(values), dtype=bool)
+  newVoxel[1:] = np.any(voxels[1:] != voxels[:-1], axis=1)
+
+  starts = np.flatnonzero(newRun)
+  ends = np.append(starts[1:], len(values)) - 1
+  trace = np.zeros(len(starts), dtype=TRACE_DTYPE)
+  trace['label'] = values[starts]
+  trace['entry'] = entries[starts]
+  trace['exit'] = exits[ends]
+  trace['voxels'] = np.add.reduceat(newVoxel.astype(int), starts)
+  return trace
+
+def traceTrajectory(labels, rasToIjk, points):
+  """List every label crossed along the RAS polyline points.
+  Every segment between consecutive points is traversed voxel by voxel.
+  Returns a structured array with one row per run of identical labels:
+  label, entry and exit arc length (mm from the first point) and the
+  number of voxels in the run.
+  """
+  entries, exits, voxels = traceVoxels(labels.shape[::-1], rasToIjk, points)
+  values = labels[voxels[:, 2], voxels[:, 1], voxels[:, 0]]
+  return runLengths(values, entries, exits, voxels)
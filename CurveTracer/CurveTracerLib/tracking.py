@@ -0,0 +1,233 @@
+"""Streaming evaluation of the pose of a tracked tool.
+
+A tracker updates the pose of a needle 30 to 60 times per second. Poses are
+handed to a PoseStream, which evaluates them in a worker thread. Only the
+latest pose waits for the worker: a pose that is replaced before the
+worker gets to it is dropped instead of queued, so the results never lag
+behind the tool. Each pose has a latency budget; a ToolEvaluator skips its
+remaining stages once the budget is spent. The results of the last frames
+and their latencies are kept in a ResultRing.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from . import distance
+from . import geometry
+from . import intersection
+from . import profiling
+from . import tracing
+
+# One row per evaluated pose. Times are in seconds: latency from the
+# arrival of the pose to its result, compute time of the evaluation alone.
+# dropped counts the poses replaced since the previous evaluated one, and
+# complete is False when stages were skipped to stay within the budget.
+FRAME_DTYPE = np.dtype([('frame', np.int64), ('arrival', np.float64), ('latency', np.float64),
+                        ('compute', np.float64), ('dropped', np.int64), ('complete', np.bool_),
+                        ('overBudget', np.bool_)])
+
+
+def toolTrajectory(toolToRas, axis=(0.0, 0.0, 1.0), ahead=100.0, behind=0.0):
+  """Straight trajectory of a tool whose tip is at the origin of toolToRas,
+  a 4x4 matrix, and which points along axis in tool coordinates.
+  Returns the (2,3) RAS points behind mm behind the tip and ahead mm ahead
+  of it.
+  """
+  toolToRas = np.asarray(toolToRas, dtype=float)
+  tip = toolToRas[:3, 3]
+  direction = toolToRas[:3, :3].dot(np.asarray(axis, dtype=float))
+  direction /= np.sqrt(np.dot(direction, direction))
+  return np.array([tip - behind * direction, tip + ahead * direction])
+
+
+class ResultRing(object):
+  """The statistics (FRAME_DTYPE) and results of the last capacity frames.
+  Frames are appended by the worker thread and read by the main thread.
+  """
+
+  def __init__(self, capacity=256):
+    self.frames = np.zeros(capacity, dtype=FRAME_DTYPE)
+    self.results = [None] * capacity
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def append(self, frame, result):
+    with self.lock:
+      index = self.count % len(self.frames)
+      self.frames[index] = frame
+      self.results[index] = result
+      self.count += 1
+
+  def latest(self):
+    """Return (frame, result) of the last frame, or (None, None)
+    """
+    with self.lock:
+      if self.count == 0:
+        return None, None
+      index = (self.count - 1) % len(self.frames)
+      return self.frames[index].copy(), self.results[index]
+
+  def recent(self):
+    """Return (frames, results) of the kept frames, oldest first
+    """
+    with self.lock:
+      nOfFrames = min(self.count, len(self.frames))
+      order = (np.arange(self.count - nOfFrames, self.count)) % len(self.frames)
+      return self.frames[order], [self.results[i] for i in order]
+
+  def statistics(self):
+    """Latency of the kept frames in ms (mean, 95th percentile and
+    maximum), and their number of dropped poses, incomplete frames and
+    frames over budget
+    """
+    frames = self.recent()[0]
+    statistics = {'frames': len(frames), 'dropped': int(np.sum(frames['dropped'])),
+                  'incomplete': int(np.sum(~frames['complete'])), 'overBudget': int(np.sum(frames['overBudget'])),
+                  'mean': 0.0, 'p95': 0.0, 'max': 0.0}
+    if len(frames):
+      latencies = frames['latency'] * 1000.0
+      statistics.update({'mean': float(np.mean(latencies)), 'p95': float(np.percentile(latencies, 95)),
+                         'max': float(np.max(latencies))})
+    return statistics
+
+  def clear(self):
+    with self.lock:
+      self.count = 0
+
+
+class PoseStream(object):
+  """Evaluates the poses pushed by the main thread in one worker thread.
+  evaluate is called there with a pose and the deadline (a
+  time.perf_counter value) of its budget in seconds, and returns
+  (result, complete). Its results and errors are appended to ring as
+  (result, error).
+  """
+
+  def __init__(self, evaluate, budget=1.0 / 30.0, capacity=256):
+    self.evaluate = evaluate
+    self.budget = budget
+    self.ring = ResultRing(capacity)
+    self.condition = threading.Condition()
+    self.pending = None
+    self.frame = 0
+    self.dropped = 0
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='PoseStream')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def push(self, pose):
+    """Hand pose to the worker, replacing the pose still waiting for it.
+    Returns the frame number of pose.
+    """
+    with self.condition:
+      if self.pending is not None:
+        self.dropped += 1
+        profiling.profiler.count('TrackingDropped')
+      self.frame += 1
+      self.pending = (self.frame, pose, time.perf_counter())
+      self.condition.notify()
+      return self.frame
+
+  def run(self):
+    while True:
+      with self.condition:
+        while self.running and self.pending is None:
+          self.condition.wait()
+        if not self.running:
+          return
+        frame, pose, arrival = self.pending
+        self.pending = None
+        dropped = self.dropped
+        self.dropped = 0
+
+      start = time.perf_counter()
+      result = None
+      error = None
+      complete = False
+      try:
+        with profiling.profiler.timer('TrackingFrame'):
+          result, complete = self.evaluate(pose, arrival + self.budget)
+      except Exception as e:
+        error = e
+      end = time.perf_counter()
+      self.ring.append((frame, arrival, end - arrival, end - start, dropped, complete,
+                        end - arrival > self.budget), (result, error))
+
+  def wait(self, frame, timeout=1.0):
+    """Wait until frame or a later one is in the ring, or until timeout
+    seconds have passed. Returns True if it is.
+    """
+    endTime = time.perf_counter() + timeout
+    while time.perf_counter() < endTime:
+      latest = self.ring.latest()[0]
+      if latest is not None and latest['frame'] >= frame:
+        return True
+      time.sleep(0.001)
+    return False
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+    if self.thread is not threading.current_thread():
+      self.thread.join(1.0)
+
+
+class ToolEvaluator(object):
+  """Structures crossed, entry angles and clearance of the trajectory of a
+  tracked tool, from data prepared once on the main thread: the label map
+  (labels, [k, j, i], or None) with its RAS to IJK matrix, a
+  locators.HierarchyLocator over nOfModels
+  meshes with their normals.MeshNormals (or None), and the
+  distance.DistanceField of the clearance labels. The trajectory of a pose
+  is toolTrajectory(pose, axis, ahead, behind).
+  The stages run in this order. The structures are always traced; the
+  other stages are skipped (their result is None) once the deadline has
+  passed.
+  """
+
+  def __init__(self, labels, rasToIjk, hierarchyLocator=None, nOfModels=0, normals=None,
+               fields=(), axis=(0.0, 0.0, 1.0), ahead=100.0, behind=0.0):
+    self.labels = labels
+    self.rasToIjk = rasToIjk
+    self.hierarchyLocator = hierarchyLocator
+    self.nOfModels = nOfModels
+    self.normals = normals
+    self.fields = list(fields)
+    self.axis = axis
+    self.ahead = ahead
+    self.behind = behind
+
+  def evaluate(self, pose, deadline=None):
+    """Return ((points, trace, angles, clearance), complete) for the 4x4
+    tool to RAS matrix pose: the trajectory, its label runs (TRACE_DTYPE),
+    the entry angle into every mesh (0.0 when not hit) and its clearance
+    (CLEARANCE_DTYPE)
+    """
+    points = toolTrajectory(pose, self.axis, self.ahead, self.behind)
+    stages = [self.trace, self.angles, self.clearance]
+    results = [None] * len(stages)
+    for i, stage in enumerate(stages):
+      if i and deadline is not None and time.perf_counter() > deadline:
+        profiling.profiler.count('TrackingSkippedStages', len(stages) - i)
+        return (points,) + tuple(results), False
+      results[i] = stage(points)
+    return (points,) + tuple(results), True
+
+  def trace(self, points):
+    if self.labels is None:
+      return np.zeros(0, dtype=tracing.TRACE_DTYPE)
+    return tracing.traceTrajectory(self.labels, self.rasToIjk, points)
+
+  def angles(self, points):
+    if self.hierarchyLocator is None:
+      return np.zeros(self.nOfModels)
+    return intersection.entryAngles(self.hierarchyLocator, self.nOfModels, points[0], points[-1], self.normals)
+
+  def clearance(self, points):
+    if not self.fields:
+      return np.zeros(0, dtype=distance.CLEARANCE_DTYPE)
+    return distance.trajectoryClearance(self.fields, self.rasToIjk, geometry.asPoints(points))
@@ -0,0 +1,90 @@
+"""Evaluation of many trajectories against one label map and one set of meshes."""
+
+import numpy as np
+
+from . import geometry
+from . import intersection
+from . import roi
+from . import tracing
+
+# One row per passage of a trajectory through a structure: a run of a label
+# or the part of the trajectory between an entry into a model and the next
+# exit. Label runs have no angle; model passages have no voxel count.
+STRUCTURE_CROSSING_DTYPE = np.dtype([('trajectory', np.int64), ('source', 'U5'), ('structure', np.int64),
+                                     ('entry', np.float64), ('exit', np.float64), ('voxels', np.int64),
+                                     ('angle', np.float64)])
+
+
+def labelRuns(trace, trajectory):
+  """Rows (STRUCTURE_CROSSING_DTYPE) of the label runs of a trace
+  (TRACE_DTYPE) of trajectory, without the background
+  """
+  trace = trace[trace['label'] != 0]
+  runs = np.zeros(len(trace), dtype=STRUCTURE_CROSSING_DTYPE)
+  runs['trajectory'] = trajectory
+  runs['source'] = 'label'
+  runs['structure'] = trace['label']
+  runs['entry'] = trace['entry']
+  runs['exit'] = trace['exit']
+  runs['voxels'] = trace['voxels']
+  runs['angle'] = np.nan
+  return runs
+
+def sortCrossings(rows):
+  """Order rows (STRUCTURE_CROSSING_DTYPE) by trajectory and entry
+  """
+  return rows[np.lexsort((rows['entry'], rows['trajectory']))]
+
+def modelPassages(crossings, length):
+  """Pair the crossings (CROSSING_DTYPE) of one trajectory with the models
+  into passages from an entry to the next exit of the same model. A
+  trajectory that starts or ends inside a model enters it at 0 or leaves
+  it at length, with an unknown (NaN) entry angle for the former.
+  Returns a structured array (STRUCTURE_CROSSING_DTYPE).
+  """
+  rows = []
+  for model in np.unique(crossings['model']):
+    start = None
+    angle = np.nan
+    modelCrossings = crossings[crossings['model'] == model]
+    if len(modelCrossings) and not modelCrossings['entering'][0]:
+      start = 0.0
+    for crossing in modelCrossings:
+      if crossing['entering'] and start is None:
+        start = crossing['arcLength']
+        angle = crossing['angle']
+      elif not crossing['entering'] and start is not None:
+        rows.append((0, 'model', model, start, crossing['arcLength'], 0, angle))
+        start = None
+        angle = np.nan
+    if start is not None:
+      rows.append((0, 'model', model, start, length, 0, angle))
+  return np.array(rows, dtype=STRUCTURE_CROSSING_DTYPE)
+
+def evaluateTrajectories(labels, rasToIjk, trajectories, hierarchyLocator=None, normals=None):
+  """Structures crossed by each of trajectories, a list of (N,3) RAS
+  arrays, in one pass sharing the label map and the locator. Labels runs
+  are traced on labels ([k, j, i], or None to skip them); passages through
+  the meshes of hierarchyLocator (a locators.HierarchyLocator, or None)
+  are found from the crossings of every segment, with angles measured
+  against normals (its outward normals.MeshNormals) when given. The
+  structure of a passage is the index of its mesh in the locator.
+  Returns a structured array (STRUCTURE_CROSSING_DTYPE) ordered by
+  trajectory and entry.
+  """
+  parts = [np.zeros(0, dtype=STRUCTURE_CROSSING_DTYPE)]
+  for index, points in enumerate(trajectories):
+    points = geometry.asPoints(points)
+
+    if labels is not None:
+      block, blockRasToIjk = roi.cropLabels(labels, rasToIjk, points)
+      parts.append(labelRuns(tracing.traceTrajectory(block, blockRasToIjk, points), index))
+
+    if hierarchyLocator is not None and len(points) >= 2:
+      crossings = intersection.intersectTrajectory(hierarchyLocator.locator, hierarchyLocator.polyData, points,
+                                                   normals=normals, cellToModel=hierarchyLocator.cellToModel)
+      passages = modelPassages(crossings, geometry.arcLengths(points)[1][-1])
+      passages['trajectory'] = index
+      parts.append(passages)
+
+  return sortCrossings(np.concatenate(parts))
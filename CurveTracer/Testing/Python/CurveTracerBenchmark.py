@@ -0,0 +1,134 @@
+"""Offline benchmarks of the CurveTracer computations.
+
+All inputs are generated by CurveTracerLib.synthetic, so the suite runs
+without network access and without Slicer:
+
+  python CurveTracerBenchmark.py --sizes 64 256 --output results.json
+
+Each case reports its best wall time over the repeats, the throughput
+and the peak memory (NumPy allocations traced by tracemalloc, and the
+resident set size of the process) as one JSON record, so that results of
+two revisions can be compared to catch regressions.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import numpy as np
+
+from CurveTracerLib import intersection, locators, occupancy, roi, sampling, synthetic, tracing
+
+
+def maxResidentMemory():
+  try:
+    import resource
+  except ImportError:
+    return None
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return usage if sys.platform == 'darwin' else usage * 1024
+
+def measure(name, params, function, count, unit, repeats):
+  """Run function repeats times and return a result record.
+  Memory is traced in one extra run, as tracing slows down allocations.
+  """
+  times = []
+  for i in range(repeats):
+    startTime = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - startTime)
+  tracemalloc.start()
+  function()
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  best = min(times)
+  return {'benchmark': name, 'params': params, 'seconds': best, 'meanSeconds': float(np.mean(times)),
+          'throughput': count / best if best > 0 else None, 'unit': unit,
+          'peakTracedMemory': peak, 'maxResidentMemory': maxResidentMemory()}
+
+def labelMapCases(size, nOfPoints, nOfTargets, repeats):
+  labels, rasToIjk = synthetic.labelMap(size)
+  points = synthetic.trajectory(nOfPoints, [0.0, 0.0, 0.0], [size - 1.0] * 3)
+  targets = synthetic.targets(nOfTargets, 0.0, size - 1.0)
+  names = ['F-%d' % (n + 1) for n in range(nOfTargets)]
+  params = {'size': size, 'points': nOfPoints, 'targets': nOfTargets}
+
+  yield measure('GetVoxelValue', params, lambda: sampling.sampleLabels(labels, rasToIjk, points),
+                nOfPoints, 'points/s', repeats)
+  yield measure('TargetTableRefresh', params, lambda: sampling.targetResults(labels, rasToIjk, targets, names),
+                nOfTargets, 'targets/s', repeats)
+  nOfVoxels = len(tracing.traceVoxels(labels.shape[::-1], rasToIjk, points)[0])
+  yield measure('TraceTrajectory', params, lambda: tracing.traceTrajectory(labels, rasToIjk, points),
+                nOfVoxels, 'voxels/s', repeats)
+
+  # The block around the trajectory is narrowed from the value range of the
+  # occupancy bricks instead of scanning it
+  pyramid = occupancy.OccupancyPyramid(labels)
+  nOfBlockVoxels = roi.cropLabels(labels, rasToIjk, points)[0].size
+  yield measure('LabelMapROI', params, lambda: roi.cropLabels(labels, rasToIjk, points, narrow=True),
+                nOfBlockVoxels, 'voxels/s', repeats)
+  yield measure('LabelMapROIPyramid', params,
+                lambda: roi.cropLabels(labels, rasToIjk, points, narrow=True, pyramid=pyramid),
+                nOfBlockVoxels, 'voxels/s', repeats)
+
+def meshCases(nOfTriangles, nOfPoints, repeats):
+  poly = synthetic.sphere(nOfTriangles, radius=40.0)
+  points = synthetic.trajectory(nOfPoints, [0.0, 0.0, 100.0], [5.0, 5.0, 0.0])
+  params = {'triangles': poly.GetNumberOfCells(), 'points': nOfPoints}
+
+  yield measure('BuildLocator', params, lambda: locators.buildLocator(poly), poly.GetNumberOfCells(),
+                'triangles/s', repeats)
+  locator = locators.buildLocator(poly)
+  yield measure('EntryAngle', params, lambda: intersection.entryAngle(locator, poly, points[0], points[-1]),
+                1, 'queries/s', repeats)
+  yield measure('IntersectTrajectory', params, lambda: intersection.intersectTrajectory(locator, poly, points),
+                nOfPoints - 1, 'segments/s', repeats)
+
+def hierarchyCases(nOfTriangles, nOfStructures, repeats):
+  polys = synthetic.atlas(nOfStructures, nOfTriangles, extent=100.0)
+  params = {'triangles': sum(p.GetNumberOfCells() for p in polys), 'structures': nOfStructures}
+  yield measure('BuildHierarchyLocator', params, lambda: locators.HierarchyLocator(polys), params['triangles'],
+                'triangles/s', repeats)
+  hierarchyLocator = locators.HierarchyLocator(polys)
+  yield measure('AnglesTableRefresh', params,
+                lambda: intersection.entryAngles(hierarchyLocator, nOfStructures, [0.0, 0.0, 0.0], [100.0] * 3),
+                nOfStructures, 'structures/s', repeats)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256],
+                      help='label map sizes (voxels per axis), up to 1024')
+  parser.add_argument('--triangles', type=int, nargs='+', default=[1000, 100000],
+                      help='number of mesh triangles, up to 1000000')
+  parser.add_argument('--points', type=int, nargs='+', default=[2, 100, 10000], help='trajectory points')
+  parser.add_argument('--targets', type=int, default=1000, help='target fiducials for the table refresh')
+  parser.add_argument('--structures', type=int, default=150, help='models in the synthetic atlas')
+  parser.add_argument('--repeats', type=int, default=5)
+  parser.add_argument('--output', help='write the results to this JSON file instead of stdout')
+  args = parser.parse_args(argv)
+
+  results = []
+  for size in args.sizes:
+    for nOfPoints in args.points:
+      results.extend(labelMapCases(size, nOfPoints, args.targets, args.repeats))
+  for nOfTriangles in args.triangles:
+    for nOfPoints in args.points:
+      results.extend(meshCases(nOfTriangles, nOfPoints, args.repeats))
+    results.extend(hierarchyCases(nOfTriangles, args.structures, args.repeats))
+
+  report = {'python': sys.version.split()[0], 'numpy': np.__version__, 'results': results}
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+  main()